@@ -0,0 +1,13 @@
+#!/bin/bash
+## starts a headless server, runs the synthetic clients against it, and compares with a baseline report
+## ./benchmark-server.sh [blender args] [clients] [seconds] [baseline.json]
+
+~/blender2.63/blender $1 --background --python ./pyppet/server_api.py --port=8090 --ip=localhost &
+SERVER=$!
+
+python3 ./pyppet/benchmark.py --port=8090 --pid=$SERVER --wait=120 --clients=${2:-20} --duration=${3:-60} \
+	--report=benchmark-$(date +%Y%m%d-%H%M%S).json ${4:+--compare=$4}
+STATUS=$?
+
+kill $SERVER
+exit $STATUS
@@ -17,7 +17,7 @@ import wsgiref.simple_server
 import io, socket, select, pickle, urllib
 import urllib.request
 import urllib.parse
-import hashlib
+import email.utils
 
 #from websocket import websockify
 from websocket import websocksimplify
@@ -33,12 +33,69 @@ from random import *
 import api_gen
 import simple_action_api
 import Physics # for threading LOCK
+import spatial_index
+from uid_registry import UID_Registry
+from geometry_cache import GeometryCache, get_mesh_id, get_geometry_key
+from export_cache import ExportCache
+from world_snapshot import WorldSnapshot, get_transform
+from material_cache import MaterialCache, mesh_is_smooth
+import mesh_extract
+import mesh_stream
+import geometry_codec
+import player_shards
+import zone_router
+from static_assets import StaticAssets
+from proxy_cache import ProxyCache, ProxyError
+import bake_cache
+from bake_cache import BakeCache
+from mesh_stream import MeshStream
 import bender  # for reading .blend files directly
 Bender = bender.Bender()
 
-def introspect_blend( path ): return Bender.load_blend( path )
+def introspect_blend( path ): return Bender.load_blend( path, lazy=True )
 
 DEFAULT_STREAMING_LEVEL_OF_INTEREST_MAX_DISTANCE = 400.0
+SPATIAL_INDEX_CELL_SIZE = DEFAULT_STREAMING_LEVEL_OF_INTEREST_MAX_DISTANCE / 4.0
+SPATIAL_INDEX_REFRESH = 1.0 / 30.0  ## seconds, the index is shared by all players
+WORLD_SNAPSHOT_REFRESH = 1.0 / 60.0  ## seconds, max age of the shared snapshot if the main loop is not building it
+PREGENERATE_COLLADA = '--pregenerate-collada' in sys.argv  ## export lowres and hires collada in the background
+BUNDLE_JAVASCRIPT = '--no-javascript-bundle' not in sys.argv  ## the Three.js stack as one fingerprinted script
+
+## binary object stream - transforms go out as api_gen.TRANSFORM_STREAM records ##
+USE_BINARY_STREAM = '--binary-stream' in sys.argv
+BINARY_STREAM_KEYFRAME = 60  ## every N frames all transform fields are resent
+## in binary stream mode these are only resent in the json when they change ##
+BINARY_STREAM_HEADER_KEYS = ('name', 'parent', 'min', 'max', 'empty', 'mesh_id', 'color', 'on_click', 'on_input')
+## view keys that are sent outside of pak['properties'], changes to these alone do not resend the properties ##
+VIEW_SPECIAL_KEYS = ('location','scale', 'rotation_euler', 'color')
+
+## meshes are sent in chunks over the websocket (mesh_stream.py), --http-geometry downloads each buffer whole instead ##
+USE_MESH_CHUNKS = '--http-geometry' not in sys.argv
+MESH_FRAME_BUDGET = mesh_stream.MESH_FRAME_BUDGET  ## bytes of geometry per player per frame
+for arg in sys.argv:
+	if arg.startswith('--mesh-budget='): MESH_FRAME_BUDGET = int( arg.split('=')[-1] )
+	## quantized geometry (geometry_codec.py), 16 bit positions or --quantize-geometry=N bits ##
+	if arg.startswith('--quantize-geometry'):
+		GeometryCache.quantize_bits = int( arg.split('=')[-1] ) if '=' in arg else 16
+
+## zone partitioning (zone_router.py), --zone=NAME only serves the objects in the group NAME, ##
+## --zone-router=HOST:PORT is the front process that knows the other zones and hands players off, ##
+## --zone-router-public=URL is the router for browsers, if they can not reach it at HOST ##
+ZONE = None
+ZONE_ROUTER = None
+ZONE_ROUTER_PUBLIC = None
+for arg in sys.argv:
+	if arg.startswith('--zone='): ZONE = arg.split('=')[-1]
+	if arg.startswith('--zone-router-public='): ZONE_ROUTER_PUBLIC = arg.split('=', 1)[-1]
+for arg in sys.argv:
+	if arg.startswith('--zone-router='): ZONE_ROUTER = zone_router.ZoneClient( arg.split('=')[-1], ZONE_ROUTER_PUBLIC )
+
+def get_zone_objects():
+	'''
+	the objects of this zone, all objects in the scene if there is no --zone or no group of that name
+	'''
+	if ZONE and ZONE in bpy.data.groups: return bpy.data.groups[ ZONE ].objects
+	return bpy.context.scene.objects
 
 SpecialEdgeColors = {  ## blender edit-mode style
 	'CREASE':[1,0,1],
@@ -87,10 +144,6 @@ def set_host_and_port(h, p):
 	global _host, _port
 	_host = h; _port = p
 
-def get_mesh_id( mesh ):
-	s = mesh.name
-	if mesh.library: s += mesh.library.filepath
-	return hashlib.md5( s.encode('utf-8') ).hexdigest()
 
 ########## ID of zero is a dead object ######
 bpy.types.Object.UID = IntProperty(
@@ -99,24 +152,11 @@ bpy.types.Object.UID = IntProperty(
 
 #############################################
 def get_free_vertices( mesh ):
-	used = []
-	for edge in mesh.edges:
-		a,b = edge.vertices
-		if a not in used: used.append(a)
-		if b not in used: used.append(b)
-	free = []
-	for v in mesh.vertices:
-		if v.index not in used:
-			free.append( v )
-	return free
-
-def mesh_is_smooth( mesh ):
 	'''
-	if any face is smooth, the entire mesh is considered smooth
+	vertices not used by any edge, see mesh_extract.get_loose_geometry for the index arrays
 	'''
-
-	a = [ bool(poly.use_smooth) for poly in mesh.polygons ]
-	return True in a
+	points, lines, loose = mesh_extract.get_loose_geometry( mesh )
+	return [ mesh.vertices[i] for i in points ]
 
 def get_material_config(mat, mesh=None, wrapper=None):
 	'''
@@ -191,19 +231,24 @@ def get_material_config(mat, mesh=None, wrapper=None):
 
 	return cfg
 
+def get_object_material_config( ob ):
+	'''
+	returns (config, version) from the MaterialCache, the version changes when the config does.
+	'''
+	return MaterialCache.get(
+		ob.data.materials[0],
+		get_material_config,
+		mesh=ob.data,
+		wrapper=api_gen.get_wrapped_objects()[ob]
+	)
+
+WorldSnapshot.material_config = get_object_material_config
+
 
 STRICT = True
 def get_object_by_UID( uid ):
 	if type(uid) is str: uid = int( uid.replace('_','') )
-	ids = []
-	ob = None
-	for o in bpy.data.objects:
-		if o.UID:
-			if o.UID == uid: ob = o
-			ids.append( o.UID )
-
-	assert len(ids) == len( set(ids) )
-
+	ob = UID_Registry.get_object( uid )
 	if not ob:
 		print('[ERROR] blender object UID not found', uid)
 		if STRICT: raise RuntimeError
@@ -212,14 +257,11 @@ def get_object_by_UID( uid ):
 def UID( ob ):
 	'''
 	sets and returns simple unique ID for object.
-	note: when merging data, need to check all ID's are unique
-	note: copy object duplicates the UID
+	note: copy object duplicates the UID, uid_registry.py checks for that.
 	'''
-	ids = [o.UID for o in bpy.data.objects]
-	if not ob.UID or ids.count( ob.UID ) > 1:
-		ob.UID = max( ids ) + 1
-	assert ob.UID
-	return ob.UID
+	uid = UID_Registry.get_uid( ob )
+	assert uid
+	return uid
 
 #--------------------------------------------------
 
@@ -300,6 +342,7 @@ SWAP_OBJECT = mathutils.Matrix.Rotation(-math.pi/2, 4, 'X')
 #SWAP_MESH = mathutils.Matrix.Rotation(0, 4, 'X')
 #SWAP_OBJECT = mathutils.Matrix.Rotation(0, 4, 'X')
 ###########################################################
+WorldSnapshot.swap = SWAP_OBJECT
 
 bpy.types.Object.is_lod_proxy = BoolProperty(
 	name='is LOD proxy',
@@ -321,10 +364,11 @@ def _dump_collada_data_helper( data, blank_material=False ):
 		if data.materials: data.materials[0] = BLANK_MATERIAL
 		else: data.materials.append( BLANK_MATERIAL )
 
-#_collada_lock = threading._allocate_lock()
-_collada_lock = Physics.LOCK
+## exports are serialized by ExportCache, the physics lock is only taken when there is no main loop job queue ##
+_collada_lock = threading._allocate_lock()
+ExportCache.fallback_lock = Physics.LOCK
 
-def dump_collada( ob, center=False, lowres=False, use_ctypes=True ):
+def dump_collada( ob, center=False, lowres=False, use_ctypes=True, ratio=0.2 ):
 	_collada_lock.acquire()
 	assert bpy.context.mode !='EDIT'
 	name = ob.name
@@ -345,32 +389,10 @@ def dump_collada( ob, center=False, lowres=False, use_ctypes=True ):
 
 		url = '/tmp/%s(lowres).dae' %name
 
-		## check for pre-generated proxy ##
-		proxy = None
-		for child in ob.children:
-			if child.is_lod_proxy:
-				proxy = child; break
+		## check for pre-generated proxy (create_LOD_proxy) ##
+		proxy = get_LOD_proxy( ob )
 		if not proxy:	# otherwise generate a new one #
-			data = create_LOD( ob )
-			_dump_collada_data_helper( data )
-
-			proxy = bpy.data.objects.new(name='__%s__'%uid, object_data=data)
-			bpy.context.scene.objects.link( proxy )
-			proxy.is_lod_proxy = True
-			proxy.draw_type = 'WIRE'
-
-			try:
-				bpy.ops.object.mode_set( mode='OBJECT' )
-			except:
-				pass
-
-			active = bpy.context.scene.objects.active
-			proxy.select = True
-			bpy.context.scene.objects.active = proxy	# required by smart_project
-			bpy.ops.uv.smart_project()		# no need to be in edit mode
-			proxy.data.update()			# required
-			#bpy.ops.object.shade_smooth()
-			bpy.context.scene.objects.active = active
+			proxy = _new_LOD_proxy( ob, uid, ratio )
 
 
 		proxy.hide_select = False	# if True this blocks selecting even here in python!
@@ -413,7 +435,7 @@ def dump_collada( ob, center=False, lowres=False, use_ctypes=True ):
 		print('[ DUMPING HIRES ]')
 		url = '/tmp/%s(hires).dae' %name
 
-		data = ob.to_mesh(bpy.context.scene, True, "PREVIEW")
+		data = mesh_extract.to_mesh( ob, bpy.context.scene )
 		_dump_collada_data_helper( data )
 
 		############## create temp object for export ############
@@ -457,6 +479,63 @@ def dump_collada( ob, center=False, lowres=False, use_ctypes=True ):
 	_collada_lock.release()
 	return open(url,'rb').read()
 
+ExportCache.exporter = dump_collada
+
+
+def get_LOD_proxy( ob ):
+	for child in ob.children:
+		if child.is_lod_proxy: return child
+
+def _new_LOD_proxy( ob, uid, ratio ):
+	data = create_LOD( ob, ratio )
+	_dump_collada_data_helper( data )
+
+	proxy = bpy.data.objects.new(name='__%s__'%uid, object_data=data)
+	bpy.context.scene.objects.link( proxy )
+	proxy.is_lod_proxy = True
+	proxy.draw_type = 'WIRE'
+
+	try:
+		bpy.ops.object.mode_set( mode='OBJECT' )
+	except:
+		pass
+
+	active = bpy.context.scene.objects.active
+	proxy.select = True
+	bpy.context.scene.objects.active = proxy	# required by smart_project
+	bpy.ops.uv.smart_project()		# no need to be in edit mode
+	proxy.data.update()			# required
+	#bpy.ops.object.shade_smooth()
+	bpy.context.scene.objects.active = active
+	return proxy
+
+def create_LOD_proxy( ob, ratio=0.2 ):
+	'''
+	the first step of a lowres export, decimates and unwraps the LOD proxy and parents it to ob,
+	dump_collada then only exports it. ExportCache runs the two steps on different frames.
+	'''
+	if len(ob.data.vertices) < 12 or get_LOD_proxy( ob ): return
+	_collada_lock.acquire()
+	state = save_selection()
+	for o in bpy.context.scene.objects: o.select = False
+	mods = []
+	for mod in ob.modifiers:  ## same as dump_collada
+		if mod.type in ('ARMATURE', 'SUBSURF') and mod.show_viewport:
+			mod.show_viewport = False
+			mods.append( mod )
+	try:
+		proxy = _new_LOD_proxy( ob, UID(ob), ratio )
+		proxy.name = 'LOD'
+		proxy.rotation_euler.x = -math.pi/2
+		proxy.parent = ob
+		proxy.hide_select = True
+	finally:
+		for mod in mods: mod.show_viewport = True
+		restore_selection( state )
+		_collada_lock.release()
+
+ExportCache.preparer = create_LOD_proxy
+
 
 def create_LOD( ob, ratio=0.2 ):
 	# TODO generate mapping, cache #
@@ -539,6 +618,45 @@ class WebGL(object):
 #------------------------------------------------------------------------------
 
 
+def get_subdiv_levels( ob ):
+	'''
+	subsurf modifiers that are not shown in editmode are done by the client
+	'''
+	ss = 0
+	for mod in ob.modifiers:
+		if mod.type == 'SUBSURF':
+			if mod.show_viewport and mod.subdivision_type == 'CATMULL_CLARK':
+				if not mod.show_in_editmode:
+					ss += mod.levels
+	return ss
+
+def extract_geometry( ob ):
+	'''
+	converts the modifier stack into flat typed arrays of vertices, faces, lines and colors,
+	see mesh_extract.extract_mesh, the result is packed and shared by all players in GeometryCache.
+	'''
+	## catmull clark subsurf is done by the client (see get_subdiv_levels) ##
+	hide = lambda mod: mod.type == 'SUBSURF' and mod.subdivision_type == 'CATMULL_CLARK' and not mod.show_in_editmode
+	data = mesh_extract.to_mesh( ob, bpy.context.scene, matrix=SWAP_MESH, hide=hide )	# flip YZ for Three.js
+	geo = mesh_extract.extract_mesh( data, palette=SpecialEdgeColors )
+	print('--------->ok---extracted-verts:%s'%len(data.vertices))
+	bpy.data.meshes.remove( data )
+	return geo
+
+def get_geometry_header( ob, header ):
+	'''
+	copy of the cached header from GeometryCache, with the settings of this object added
+	'''
+	geo = dict( header )
+	ss = get_subdiv_levels( ob )
+	if ss: geo['subdiv'] = ss
+
+	## use strand material settings to change line width ##
+	if 'lines' in [ a[0] for a in header['layout'] ]:
+		if ob.data.materials and ob.data.materials[0]:
+			geo['linewidth'] = ob.data.materials[0].strand.root_size
+	return geo
+
 def on_custom_websocket_json_message(player, msg): # for monkey-patching
 	print('unknown json message', player, msg)
 
@@ -561,12 +679,24 @@ class Player( object ):
 		if msg['request'] == 'mesh':
 			ob = get_object_by_UID( msg['id'] )
 			#w = api_gen.get_wrapped_objects()[ob]
-			assert ob not in self._mesh_requests
-			self._mesh_requests.append( ob )
+			assert ob not in self.mesh_stream
+			self.mesh_stream.request( ob )
 
 		elif msg['request'] == 'start_object_stream':
 			print('requesting start object stream')
 			self._streaming = True
+
+		elif msg['request'] == 'zone':  ## the client asks to move to another zone
+			GameManager.handoff_player( self, msg['name'] )
+
+		elif msg['request'] == 'handoff':  ## first message after the client moved here from another zone
+			state = None
+			if ZONE_ROUTER:
+				try: state = ZONE_ROUTER.pop_handoff( msg['token'] )
+				except (IOError, socket.error) as err:  ## the player starts fresh
+					print('[zone router] handoff failed', err)
+			if state: self.set_handoff_state( state )
+			else: print('[zone router] no player state for handoff', msg['token'])
 		else:
 			on_custom_websocket_json_message(self, msg)
 
@@ -599,14 +729,14 @@ class Player( object ):
 		self._streaming = False ## client has to send json message to start streaming
 		Player.ID += 1
 		self.uid = Player.ID
-		self.last_update = time.time()  # this is used to limit the rate the client websocket is updated
+		self.last_update = time.time()  # time of the last message stream, the rate is picked by the websocket SendScheduler
 		self.write_ready = True
 		self.address = addr
 		self.websocket = websocket
 		self.token = None
 		self.name = None
 		self.objects = []	## list of objects client in client message stream
-		self._cache = {'invisibles':[]}
+		self._cache = {'invisibles':set()}
 
 		self.camera_stream_target = [None]*3   # pointers to this stay valid
 		self.camera_stream_position = [None]*3 # pointers to this stay valid
@@ -619,9 +749,12 @@ class Player( object ):
 		self.godrays = False
 
 		self._ticker = 0
-		self._mesh_requests = []	## do not pickle?
+		self.binary_stream = USE_BINARY_STREAM
+		self._binary_records = []	## packed transform records for the next binary frame
+		self.mesh_stream = MeshStream( frame_budget=MESH_FRAME_BUDGET )	## mesh requests and chunked transfers, do not pickle
 		self._sent_meshes = []		## clear on login, do not pickle
 		self.eval_queue = [] 		## eval javascript on the client side
+		self.shard = None			## worker index in player shards mode (player_shards.py), the worker streams to the socket
 
 		ip = '_temp(%s:%s)'%self.address
 		if ip not in bpy.data.objects:  ## TODO clean these up on player close
@@ -706,6 +839,40 @@ class Player( object ):
 		else:
 			return self.streaming_boundry.empty_draw_size
 
+	HANDOFF_CAMERA_KEYS = ('camera_randomize', 'camera_focus', 'camera_aperture', 'camera_maxblur', 'godrays')
+
+	def get_handoff_state(self):
+		'''
+		what the player keeps when it moves to another zone instance, passed as json through the zone router.
+		the client drops its objects (the other zone has different ones), but keeps its mesh cache,
+		so the ids of the meshes it has go along and the new zone does not send them again.
+		'''
+		state = {
+			'name':self.name, 'token':self.token,
+			'streaming':self._streaming, 'binary_stream':self.binary_stream,
+			'location':list( self.camera_stream_position ),
+			'focal_point':list( self.camera_stream_target ),
+			'mesh_ids':list( set( get_mesh_id(ob.data) for ob in self._sent_meshes ) ),
+			'zone':ZONE,
+		}
+		for key in self.HANDOFF_CAMERA_KEYS: state[ key ] = getattr( self, key )
+		return state
+
+	def set_handoff_state(self, state):
+		print('[zone router] player %s handed off from zone %s' %(state['name'], state['zone']))
+		self.name = state['name']
+		self.token = state['token']
+		self._streaming = state['streaming']
+		self.binary_stream = state['binary_stream']
+		for key in self.HANDOFF_CAMERA_KEYS: setattr( self, key, state[ key ] )
+		if None not in state['location']: self.set_location( state['location'] )
+		if None not in state['focal_point']: self.set_focal_point( state['focal_point'] )
+		## the client clones these from its mesh cache, they only need their materials ##
+		mesh_ids = set( state['mesh_ids'] )
+		for ob in get_zone_objects():
+			if ob.type == 'MESH' and ob not in self._sent_meshes and get_mesh_id(ob.data) in mesh_ids:
+				self._sent_meshes.append( ob )
+
 	#####################################################################
 	'''
 	MESH_FORMAT = (
@@ -742,68 +909,121 @@ class Player( object ):
 		return '\n'.join( a )
 	'''
 
-	def get_streaming_objects(self, limit=500):
+	def get_streaming_objects(self):
 		'''
-		check all objects in world space, sort by distance to camera.
+		objects within the streaming boundry of this player, nearest first,
+		from the spatial index that is shared by all players.
 		'''
-		r = {}
-		for ob in bpy.context.scene.objects:
-			if ob.name.startswith('_'): continue  ## ignore objects that starts with "_"
-			distance = (self.location - ob.matrix_world.to_translation()).length
-			if distance not in r: r[distance] = []
-			r[distance].append( ob )
-		k = list(r.keys())
-		k.sort()
+		near = GameManager.get_spatial_index().query(
+			self.location, 
+			self.get_streaming_max_distance()
+		)
+		objects = [ ob for d,ob in near ]
+		## the parent of something near must also be sent, even if the parent is far away ##
+		inside = set( objects )
+		for ob in list( objects ):
+			parent = ob.parent
+			while parent and parent not in inside:
+				inside.add( parent )
+				objects.append( parent )
+				parent = parent.parent
 
 		wobjects = api_gen.get_wrapped_objects()
+		invisibles = self._cache['invisibles']
 		visible = []
-		invisible = []
 		turned_invisible = []
-		for d in k:
-			#if d > limit: continue  ## this would cause problems if something distant was the parent of something near
-			for ob in r[ d ]:
-				if ob not in wobjects:
-					if ob.UID:
-						print('WARN object not in wrapped - name: %s - ID: %s' %(ob.name,ob.UID))
-						raise RuntimeError
-					else:
-						continue ## ignore template source objects, and possibly other things not wrapped
-
-				w = wobjects[ ob ]
-				vis = True
-				if 'visible' in w:
-					if w['visible']: vis = True
-					else:
-						vis = False
-						if ob in self._cache['invisibles']:
-							self._cache['invisibles'].remove(ob)
-							turned_invisible.append( ob )
-				if vis:
-					visible.append( ob )
-					if ob in self._cache['invisibles']:
-						self._cache['invisibles'].remove(ob)
+		for ob in objects:
+			if ob not in wobjects:
+				if ob.UID:
+					print('WARN object not in wrapped - name: %s - ID: %s' %(ob.name,ob.UID))
+					raise RuntimeError
 				else:
-					invisible.append( ob )
-					if ob not in self._cache['invisibles']:
-						self._cache['invisibles'].append(ob)
+					continue ## ignore template source objects, and possibly other things not wrapped
 
-		a = {}
-		visible_empties = []
-		for ob in visible:
-			if ob.type == 'MESH':
-				n = len(ob.data.vertices)
-				if n not in a: a[ n ] = []
-				a[n].append( ob )
+			w = wobjects[ ob ]
+			if 'visible' in w and not w['visible']:
+				if ob in invisibles: turned_invisible.append( ob )
+				else: invisibles.add( ob )
 			else:
-				visible_empties.append( ob )
-
-		rank = list( a.keys() ); rank.sort()
+				visible.append( ob )
+				invisibles.discard( ob )
 
+		visible_empties = []
 		visible_meshes = []
-		for n in rank: visible_meshes.extend( a[n] )
+		for ob in visible:
+			if ob.type == 'MESH': visible_meshes.append( ob )
+			else: visible_empties.append( ob )
+		visible_meshes.sort( key=lambda ob: len(ob.data.vertices) )  ## stable sort, keeps nearest first
 
 		return visible_empties + visible_meshes + turned_invisible # + invisible # do not send invisibles
 
+	def pop_binary_stream(self):
+		'''
+		returns the binary frame of transform records built by the last create_message_stream,
+		or None if nothing changed (or binary streaming is off).
+		'''
+		if not self._binary_records: return None
+		frame = api_gen.TRANSFORM_STREAM.pack_frame( self._binary_records )
+		self._binary_records = []
+		return frame
+
+	def pop_geometry_stream(self):
+		'''
+		returns the next binary frame of mesh chunks, the frame budget is shared by all meshes being sent.
+		'''
+		return self.mesh_stream.pop_frame()
+
+	def pop_shard_updates(self, convert=True):
+		'''
+		player shards mode: what only the Blender process can make for this player,
+		javascript to eval and geometry headers for the mesh requests (the client downloads header['url']).
+		returns (updates, converted), only converts a mesh if convert is True.
+		'''
+		updates = {}
+		converted = False
+		if self.eval_queue:
+			updates['eval'] = list( self.eval_queue )
+			while self.eval_queue: self.eval_queue.pop()
+		for ob in list( self.mesh_stream.requests ):
+			key = get_geometry_key( ob )
+			header = GeometryCache.get( key )
+			if header is None:
+				if not convert or converted: continue  ## stays queued for the next tick
+				converted = True
+				header = GeometryCache.store( key, get_mesh_id(ob.data), extract_geometry(ob) )
+			self.mesh_stream.cancel( ob )
+			self._sent_meshes.append( ob )
+			model_config = None
+			if on_mesh_request_model_config: model_config = on_mesh_request_model_config( ob )
+			if 'geometry' not in updates: updates['geometry'] = {}
+			updates['geometry'][ UID(ob) ] = ( get_geometry_header(ob, header), model_config )
+		return updates, converted
+
+	def get_mesh_priority(self, ob):
+		'''
+		see mesh_stream.get_priority, the radius is from the world space bounds
+		'''
+		distance = (ob.matrix_world.to_translation() - self.location).length
+		return mesh_stream.get_priority( distance, ob.dimensions.length * 0.5 )
+
+	def _strip_stream_header(self, ob, pak):
+		'''
+		binary stream mode: the json pak only carries header keys when one of them changed,
+		returns False if nothing is left to send for this object.
+		'''
+		header = []
+		for key in BINARY_STREAM_HEADER_KEYS:
+			v = pak.get( key )
+			if type(v) is list: v = tuple( v )
+			header.append( v )
+		header = tuple( header )
+		if self._cache[ob]['header'] == header:
+			for key in BINARY_STREAM_HEADER_KEYS:
+				if key in pak: pak.pop( key )
+		else:
+			self._cache[ob]['header'] = header
+		return bool( pak )
+
 	def create_message_stream( self, context ):
 		'''
 		this can be tuned perclient fps - limited to 24fps
@@ -830,21 +1050,21 @@ class Player( object ):
 		selection = {} # time : view
 		wobjects = api_gen.get_wrapped_objects()
 
-		sent_mesh = False # only send one mesh at a time - fixes: recv_message, caught exception: RangeError: Maximum call stack size exceeded
+		converted = False # only convert one mesh per frame, the others wait in the queue
 
+		snapshot = GameManager.get_world_snapshot()  ## viewer independent state, shared by all players
 		_objects = self.get_streaming_objects()
+		## requests with the best priority from where the player is now start sending this frame ##
+		starting = self.mesh_stream.select( _objects, self.get_mesh_priority )
 		#for ob in context.scene.objects:
 		for ob in _objects:
-			if ob.name.startswith('_'): continue
 			#if ob.is_lod_proxy: continue # TODO update skipping logic
 			#if ob.type == 'EMPTY' and ob.dupli_type=='GROUP' and ob.dupli_group: ## instances can not have local offsets.
-			#if ob.type not in ('MESH','LAMP'): continue
-			if ob.type not in ('MESH', 'EMPTY'): continue
 			#if ob.hide: continue  ## deprecate?
 
-			if ob.type == 'EMPTY' and not ob.children:
-				#print('skipping empty empty', ob)
-				continue
+			## names starting with "_", types other than MESH and EMPTY, and empty empties are skipped ##
+			shared = snapshot.get( ob )
+			if shared is None: continue
 			## allow mesh without UV's ##
 			#if ob.type=='MESH' and not ob.data.uv_textures:
 			#	#print('WARN: not streaming mesh without uvmapping', ob.name)
@@ -855,7 +1075,8 @@ class Player( object ):
 					'trans':None,
 					'color':None,
 					'props':None,
-					'material':None
+					'material':None,
+					'header':None,
 				}
 
 			if ob not in wobjects:
@@ -864,55 +1085,57 @@ class Player( object ):
 
 			w = wobjects[ ob ]
 			view = w( self ) # this is self and not self.address
-			transob = ob
-			if view().translation_proxy:
-				transob = view().translation_proxy
 
 			# pack into dict for json transfer.
-			pak = {'name':ob.name}
-			if ob.parent:
-				if ob.parent.type == 'CAMERA': pak['parent'] = -1
-				else:
-					assert ob.parent.type in ('MESH', 'EMPTY')
-					pak['parent'] = UID( ob.parent )
-
+			pak = {'name':shared.name}
+			if shared.parent is not None: pak['parent'] = shared.parent
 
-			## this is a special case that makes forces object animation to be shared by all users,
-			## the view().translation_proxy above can proxy something local for a viewer.
-			if ob.parent: # do not swap children
-				loc, rot, scl = transob.matrix_local.decompose()
+			## the transform from the snapshot is shared by all users,
+			## the view().translation_proxy can proxy something local for a viewer.
+			if view().translation_proxy:
+				swap = None if ob.parent else SWAP_OBJECT  # do not swap children
+				loc, rot, scl, state = get_transform( view().translation_proxy.matrix_local, swap )
 			else:
-				loc, rot, scl = (SWAP_OBJECT * transob.matrix_local).decompose()
-
-			## old style was matrix world ##
-			#loc, rot, scl = (SWAP_OBJECT * transob.matrix_world).decompose()
-
-			loc = loc.to_tuple()
-			scl = scl.to_tuple()
-			quat = (rot.w, rot.x, rot.y, rot.z)
-			#rot = tuple( rot.to_euler("YXZ") ) #'XYZ', 'XZY', 'YXZ', 'YZX', 'ZXY', 'ZYX']
-			rot = tuple( rot.to_euler("ZXY") ) #'XYZ', 'XZY', 'YXZ', 'YZX', 'ZXY', 'ZYX']
-
-			rloc = tuple(round(v,3) for v in loc) #(round(v,3) for v in loc) this is a generator
-			rscl = tuple(round(v,3) for v in scl)
-			rrot = tuple(round(v,3) for v in rot)
-			state = ( rloc, rscl, rrot )
+				loc, rot, scl, state = shared.loc, shared.rot, shared.scl, shared.state
+			rloc, rscl, rrot = state
 
-			#send = ob in self._mesh_requests and not sent_mesh
+			#send = ob in starting
 			#if not send and ob.type == 'EMPTY': send = True
 			#send = True
 
-			if self._cache[ob]['trans'] != state or True:
+			if self.binary_stream:
+				if self._cache[ob]['trans'] is None:
+					## first time the client sees this object, it needs the full transform to create it ##
+					pak['pos'] = loc
+					pak['scl'] = scl
+					pak['rot'] = rot
+				else:
+					a,b,c = self._cache[ob]['trans']
+					keyframe = not self._ticker % BINARY_STREAM_KEYFRAME
+					fmt = api_gen.TRANSFORM_STREAM
+					mask = 0
+					if keyframe or rloc != a: mask |= fmt.bits['pos']
+					if keyframe or rrot != c: mask |= fmt.bits['rot']
+					if keyframe or rscl != b: mask |= fmt.bits['scl']
+					if mask:
+						self._binary_records.append(
+							fmt.pack( shared.uid, mask, {'pos':loc, 'rot':rot, 'scl':scl} )
+						)
+				self._cache[ob]['trans'] = state
+
+				if ob.type == 'MESH':
+					pak['min'] = shared.min
+					pak['max'] = shared.max
+
+			elif self._cache[ob]['trans'] != state or True:
 				if self._cache[ob]['trans'] and False:  ## TODO fix me
 					a,b,c = self._cache[ob]['trans']
 				else:
 					a = b = c = None
 
 					if ob.type == 'MESH':
-						x,y,z = ob.bound_box[0]
-						pak['min'] = (x,y,z)
-						x,y,z = ob.bound_box[6]
-						pak['max'] = (x,y,z)
+						pak['min'] = shared.min
+						pak['max'] = shared.max
 
 				if not self._ticker % 2 or True:
 					if rloc != a:
@@ -932,13 +1155,15 @@ class Player( object ):
 
 			###########################
 			if ob.type == 'MESH':
-				msg[ 'meshes' ][ '__%s__'%UID(ob) ] = pak
+				msg[ 'meshes' ][ shared.key ] = pak
 				#pak['min'] = tuple(ob.bound_box[0])
 				#pak['max'] = tuple(ob.bound_box[6])
 
 			elif ob.type == 'EMPTY':
 				pak['empty'] = True
-				msg[ 'meshes' ][ '__%s__'%UID(ob) ] = pak
+				if self.binary_stream and not self._strip_stream_header( ob, pak ):
+					continue
+				msg[ 'meshes' ][ shared.key ] = pak
 				continue
 
 			###########################
@@ -953,55 +1178,59 @@ class Player( object ):
 
 
 			## ensure properties required by callbacks - TODO move this logic somewhere else
-			view['ob'] = UID(ob)
+			view['ob'] = shared.uid
 			view['user'] = self.uid
 
 			a = view()  # calling a view with no args returns wrapper to internal hidden attributes #
-			props = {} #a.properties.copy()
-			for key in view.keys():
-				if key in ('location','scale', 'rotation_euler', 'color'): continue  ## special cases
-				props[ key ] = view[key]
-
-			if 'text_scale' not in props and ob.slow_parent_offset != 0.0:
-				props['text_scale'] = ob.slow_parent_offset * 0.0035  # 0.001 
+			send = ob in starting
+
+			## the properties are only rebuilt and sent when the view or its parent changed ##
+			version = a.get_version()
+			cached = self._cache[ob]['props']  # (version, text_scale)
+			changed = send or cached is None or cached[1] != shared.text_scale
+			if not changed and cached[0] != version:
+				for name in a.changed_since( cached[0] ):
+					if name not in VIEW_SPECIAL_KEYS:
+						changed = True
+						break
+			self._cache[ob]['props'] = (version, shared.text_scale)
+
+			props = None
+			if changed:
+				props = {} #a.properties.copy()
+				for key in view.keys():
+					if key in VIEW_SPECIAL_KEYS: continue  ## special cases
+					props[ key ] = view[key]
+
+				if 'text_scale' not in props and shared.text_scale is not None:
+					props['text_scale'] = shared.text_scale
+				pak['properties'] = props
 
 			## special case for selected ##
 			if 'selected' in view and view['selected']:
 				T = view['selected']
-				selection[ T ] = props
+				selection[ T ] = props  ## None if the properties are not sent this frame
 
 			if 'color' in view:  ## TODO get other animated material options from view
 				pak['color'] = view['color']
 
 
 			##################################################
-			send = ob in self._mesh_requests and not sent_mesh
-
 			#if send:
-			pak['mesh_id'] = get_mesh_id( ob.data )
-
-			_props = str( props )
-			if send or self._cache[ob]['props'] != _props:
-				self._cache[ob]['props'] = _props
-				pak['properties'] = props
+			pak['mesh_id'] = shared.mesh_id
 
 			if send or ob in self._sent_meshes:
 				if not ob.data:
 					print('no ob.data threading bug?')
 					raise RuntimeError
 
-				elif ob.data.materials and ob.data.materials[0]:
-					#color = [ round(x,3) for x in ob.data.materials[0].diffuse_color ]
-					mconfig = get_material_config( 
-						ob.data.materials[0], 
-						mesh=ob.data,
-						wrapper=api_gen.get_wrapped_objects()[ob]
-					)
+				else:
+					## from the MaterialCache, the version only changes when the config does ##
+					mconfig, _mconfig = shared.get_material_config()
 					#if 'color' in view:  ## TODO get other animated material options from view
 					#	mconfig['color'] = view['color']
 
-					_mconfig = str(mconfig)
-					if self._cache[ob]['material'] != _mconfig:
+					if mconfig and self._cache[ob]['material'] != _mconfig:
 						self._cache[ob]['material'] = _mconfig
 						pak['active_material'] = mconfig
 
@@ -1016,107 +1245,36 @@ class Player( object ):
 				print('sending eval', pak['eval'])
 
 			## respond to a mesh data request ##
-			if ob in self._mesh_requests and not sent_mesh:
+			if ob in starting:
 				assert ob.type=='MESH'
-				#if not ob.parent: pass
-				#elif ob.parent and ob.parent in self._sent_meshes:# or ob.parent.type == 'EMPTY':
-				#	pass
-				#else:
-				#	continue
+				mesh_id = shared.mesh_id
+				key = get_geometry_key( ob )
+				header = GeometryCache.get( key )
+				if header is None and not converted:  ## convert once, shared by all players ##
+					converted = True
+					header = GeometryCache.store( key, mesh_id, extract_geometry(ob) )
+					print('--------->ok---cached-geometry:%s bytes'%header['bytes'])
+					if 'codec' in header:
+						print('--------->quantized: ratio %.2f error %.5f' %(header['ratio'], header['error']))
+
+			if ob in starting and header is not None:  ## otherwise it stays queued for the next frame
 				print('-------->sending',ob)
-
-				sent_mesh = True
-				self._mesh_requests.remove(ob)
 				self._sent_meshes.append( ob )
 
-				pak['geometry'] = geo = {
-					'mesh_id'  : get_mesh_id( ob.data ),
-					'triangles': [],
-					'quads'    : [],
-					'vertices' : [],
-					'lines'    : [],
-					#'normals'  : [] # not used
-				}
+				pak['geometry'] = geo = get_geometry_header( ob, header )
+				buff = GeometryCache.get_buffer( key )
+				if USE_MESH_CHUNKS and buff is not None:
+					## the client assembles the chunks from pop_geometry_stream, instead of downloading header['url'] ##
+					geo['chunked'] = True
+					geo['uid'] = shared.uid
+					self.mesh_stream.start( ob, shared.uid, buff )
+				else:
+					self.mesh_stream.cancel( ob )
 				if on_mesh_request_model_config: ## hook for users to overload
 					pak['model_config'] = on_mesh_request_model_config( ob )
 
-				#if 'subsurf' in ob.keys(): ## DEPRECATED
-				#	ss = ob['subsurf']
-				#	assert type(ss) is int
-				#	geo['subdiv'] = ss
-				ss = 0; restore = []
-				for mod in ob.modifiers:
-					if mod.type == 'SUBSURF':
-						if mod.show_viewport and mod.subdivision_type == 'CATMULL_CLARK':
-							if not mod.show_in_editmode:
-								mod.show_viewport = False
-								restore.append( mod )
-								ss += mod.levels
-
-				if ss: geo['subdiv'] = ss
-
-				## convert modifier strack into plain mesh ##
-				data = ob.to_mesh(bpy.context.scene, True, "PREVIEW") # why is this causing a segfault?
-				data.transform( SWAP_MESH )	# flip YZ for Three.js
-				#data.calc_normals() # required?
-				data.calc_tessface()
-
-				for mod in restore: mod.show_viewport = True
-
-				if len(data.vertex_colors):
-					geo['colors'] = []
-					for v in data.vertex_colors:
-						if not v.active_render: continue # only use if on in blender
-						for c in v.data:
-							geo['colors'].append( list(c.color) )
-
-				for vert in data.vertices:
-					x,y,z = vert.co.to_tuple()
-					geo['vertices'].append( 
-						[round(x,3) for x in vert.co.to_tuple()]
-					)
-
-				for tri in data.tessfaces:
-					#geo['normals'].extend( tri.normal.to_tuple() )
-					#for vidx in tri.vertices:
-					#	geo['triangles'].append( vidx )
-					#	#assert geo['vertices'][ vidx*3 ]
-					n = len(tri.vertices)
-					f = [ fidx for fidx in tri.vertices ]
-					if n == 4: geo['quads'].append(f)
-					elif n == 3: geo['triangles'].append(f)
-					else: RuntimeError
-
-				for edge in data.edges:
-					if not edge.is_loose: continue
-					assert len(edge.vertices)==2
-					geo['lines'].append( tuple(edge.vertices) )
-					if 'colors' in geo:
-						if edge.use_edge_sharp:
-							clr = SpecialEdgeColors[ 'SHARP' ]
-						elif edge.use_seam:
-							clr = SpecialEdgeColors[ 'SEAM' ]
-						elif edge.crease > 0.0:
-							clr = SpecialEdgeColors[ 'CREASE' ]
-						elif edge.bevel_weight > 0.0:
-							clr = SpecialEdgeColors[ 'BEVEL' ]
-						else:
-							clr = None
-
-						if clr:
-							geo['colors'][ edge.vertices[0] ] = clr
-							geo['colors'][ edge.vertices[1] ] = clr
-
-				## use strand material settings to change line width ##
-				if len( geo['lines'] ):
-					if ob.data.materials and ob.data.materials[0]:
-						geo['linewidth'] = ob.data.materials[0].strand.root_size
-
-				free_verts = get_free_vertices( data )  ## particles
-				if free_verts:
-					geo['points'] = [v.index for v in free_verts]
-
-				print('--------->ok---sent-verts:%s'%len(data.vertices))
+			if self.binary_stream and not self._strip_stream_header( ob, pak ):
+				msg[ 'meshes' ].pop( shared.key )
 
 		## special case to force only a single selected for the client ##
 		if len(selection) > 1:
@@ -1124,7 +1282,7 @@ class Player( object ):
 			times.sort(); times.reverse()
 			for T in times[ 1: ]:
 				p = selection[T]
-				p.pop('selected')
+				if p: p.pop('selected')
 
 		self._ticker += 1
 		#print('_'*80)
@@ -1139,6 +1297,124 @@ class GameManagerSingleton( object ):
 	def __init__(self):
 		self.RELOAD_TEXTURES = []
 		self.clients = {}	# (ip,port) : player object ## TODO clean up
+		self.spatial_index = spatial_index.UniformGrid( cell_size=SPATIAL_INDEX_CELL_SIZE )
+		self._spatial_index_time = 0
+		self._spatial_index_lock = threading._allocate_lock()
+		self.world_snapshot = None
+		self._world_snapshot_tick = 0
+		self._world_snapshot_lock = threading._allocate_lock()
+		self._shards_published = False
+		self._shard_materials = {}  # object uid : material version sent to the player shards
+
+	def _build_world_snapshot(self):
+		self._world_snapshot_tick += 1
+		## players keep using the old snapshot until the new one is done ##
+		self.world_snapshot = WorldSnapshot( get_zone_objects(), tick=self._world_snapshot_tick )
+
+	def update_world_snapshot(self):
+		'''
+		called once per tick from the main loop, builds the state shared by all players.
+		'''
+		with self._world_snapshot_lock:
+			self._build_world_snapshot()
+		return self.world_snapshot
+
+	def get_world_snapshot(self):
+		'''
+		if the main loop is not building snapshots (or fell behind), the first player to need one builds it.
+		'''
+		snapshot = self.world_snapshot
+		if snapshot is None or time.time() - snapshot.time > WORLD_SNAPSHOT_REFRESH:
+			with self._world_snapshot_lock:
+				if self.world_snapshot is snapshot:  ## nobody else rebuilt it while we waited
+					self._build_world_snapshot()
+			snapshot = self.world_snapshot
+		return snapshot
+
+	def publish_shards(self, pool):
+		'''
+		player shards mode (player_shards.py), called once per tick from the main loop after
+		update_world_snapshot: the snapshot goes into the shared ring, changed properties,
+		materials and the per player updates go to the workers through their queues.
+		'''
+		snapshot = self.get_world_snapshot()
+		index = self.get_spatial_index()
+		wobjects = api_gen.get_wrapped_objects()
+		if not self._shards_published:  ## everything once, then only what changed
+			api_gen.track_touched()
+			touched = set( wobjects.values() )
+			self._shards_published = True
+		else:
+			touched = api_gen.pop_touched()
+
+		records = []
+		for ob, state in snapshot.objects.items():
+			w = wobjects.get( ob )
+			if w is None: continue
+			item = index.items.get( state.uid )
+			wloc = item[0] if item else state.loc
+			visible = not ('visible' in w and not w['visible'])
+			mversion = 0
+			if state.type == 'MESH':
+				mconfig, mversion = state.get_material_config()
+				if mconfig and self._shard_materials.get( state.uid ) != mversion:
+					self._shard_materials[ state.uid ] = mversion
+					pool.broadcast( ('material', state.uid, mversion, mconfig) )
+			records.append( player_shards.pack_object_record(state, wloc, visible, w().get_version(), mversion or 0) )
+		pool.publish( snapshot.tick, records )
+
+		for c in touched:
+			a = c()
+			if isinstance( c, api_gen.View ):
+				player = a.viewer
+				if getattr( player, 'shard', None ) is None: continue
+				uid = UID( a.parent().proxy )
+				pool.send_to( player.address, ('view', player.address, uid, a.get_version(), dict(a.properties)) )
+			elif a.proxy:
+				pool.broadcast( (
+					'props', UID(a.proxy), a.get_version(), dict(a.properties),
+					a.on_click.code if a.on_click else None,
+					a.on_input.code if a.on_input else None,
+				) )
+
+		convert = True  ## one mesh conversion per tick for all players
+		for player in list( self.clients.values() ):
+			if player.shard is None: continue
+			updates, converted = player.pop_shard_updates( convert )
+			if converted: convert = False
+			if updates: pool.send_to( player.address, ('player', player.address, updates) )
+
+	def get_spatial_index(self):
+		'''
+		the index is refreshed at most once per SPATIAL_INDEX_REFRESH,
+		whichever player thread gets here first does the work for everyone.
+		'''
+		if time.time() - self._spatial_index_time > SPATIAL_INDEX_REFRESH:
+			with self._spatial_index_lock:
+				if time.time() - self._spatial_index_time > SPATIAL_INDEX_REFRESH:
+					self.refresh_spatial_index()
+					self._spatial_index_time = time.time()
+		return self.spatial_index
+
+	def refresh_spatial_index(self):
+		'''
+		only wrapped objects are indexed, lamps, cameras and template objects are not streamed
+		and must not be given a UID here (get_streaming_objects raises on unwrapped objects with a UID).
+		'''
+		index = self.spatial_index
+		wobjects = api_gen.get_wrapped_objects()
+		seen = set()
+		with index.lock:
+			for ob in get_zone_objects():
+				if ob.name.startswith('_'): continue  ## ignore objects that starts with "_"
+				if ob not in wobjects: continue
+				uid = UID( ob )  ## wrapped objects already have one
+				seen.add( uid )
+				if PREGENERATE_COLLADA and uid not in index and ob.type == 'MESH' and not ob.is_lod_proxy:
+					ExportCache.pregenerate( ob )
+				index.update( uid, ob.matrix_world.to_translation(), payload=ob )
+			for uid in [ uid for uid in index.items if uid not in seen ]:
+				index.remove( uid )
 
 	def add_player( self, addr, websocket=None ):
 		print('add_player', addr)
@@ -1155,6 +1431,24 @@ class GameManagerSingleton( object ):
 		for p in self.clients.values():
 			if p.websocket is sock: return p
 
+	def handoff_player(self, player, zone):
+		'''
+		moves the player to the server instance of another zone: its state is left at the zone router,
+		and the client reconnects to the new instance with the token to take it.
+		returns False if there is no router, the zone is this one, or the router does not know it.
+		'''
+		if ZONE_ROUTER is None or zone == ZONE: return False
+		try:
+			reply = ZONE_ROUTER.put_handoff( zone, player.get_handoff_state() )
+		except (IOError, socket.error) as err:
+			print('[zone router] handoff failed', err)
+			return False
+		if reply is None: return False
+		token, endpoint = reply
+		host = endpoint['host'] or get_host_and_port()[0]  ## zones without a host run on this host
+		player.eval( 'UserAPI.switch_zone("%s","%s","%s","%s")' %(host, endpoint['port'], endpoint['path'], token) )
+		return True
+
 GameManager = GameManagerSingleton()
 
 ###### required by api_gen ########
@@ -1225,11 +1519,26 @@ class WebsocketHTTP_RequestHandler( websocksimplify.WSRequestHandler ):
 			#SimpleHTTPRequestHandler.do_GET(self) # this is what websockify.py is using, it only calls self.send_head()
 			self.do_get_custom()
 
-	def send_head(self, content_length=None, content_type=None, last_modified=None, require_path=True, redirect=None):
+	def is_not_modified(self, etag=None, last_modified=None):
+		'''
+		checks the conditional request headers, If-None-Match takes priority over If-Modified-Since
+		'''
+		if etag and self.headers.get('If-None-Match'):
+			tags = [ t.strip() for t in self.headers.get('If-None-Match').split(',') ]
+			return '"%s"'%etag in tags or '*' in tags
+		if last_modified and self.headers.get('If-Modified-Since'):
+			t = email.utils.parsedate_tz( self.headers.get('If-Modified-Since') )
+			if t: return int(last_modified) <= email.utils.mktime_tz( t )
+		return False
+
+	def accepts_gzip(self):
+		return 'gzip' in (self.headers.get('Accept-Encoding') or '')
+
+	def send_head(self, content_length=None, content_type=None, last_modified=None, require_path=True, redirect=None, etag=None, cache_control=None, content_encoding=None, vary=None):
 
 		if redirect:  ## in case we need to dynamically redirect clients
 			print('redirecting client to:', redirect)
-			self.send_response(301)
+			self.send_response(302)  ## not 301, browsers would remember it
 			self.send_header("Location", redirect)
 			self.end_headers()
 			return None
@@ -1244,9 +1553,21 @@ class WebsocketHTTP_RequestHandler( websocksimplify.WSRequestHandler ):
 				self.send_error(404, "File not found")
 				return None
 
+		if (etag or last_modified) and self.is_not_modified( etag, last_modified ):
+			self.send_response(304)  ## the caller checks self.last_code and does not write the data
+			if etag: self.send_header("ETag", '"%s"'%etag)
+			self.end_headers()
+			if f: f.close()
+			return None
+
 		###### normal response ######
 		self.send_response(200)
 		self.send_header("Content-type", ctype)
+		if etag:
+			self.send_header("ETag", '"%s"'%etag)
+			self.send_header("Cache-Control", cache_control or "no-cache")  ## revalidate, the url is the same when the content changes
+		if content_encoding: self.send_header("Content-Encoding", content_encoding)
+		if vary: self.send_header("Vary", vary)
 		if f:
 			fs = os.fstat(f.fileno())
 			self.send_header("Content-Length", str(fs[6]))
@@ -1268,31 +1589,48 @@ class WebsocketHTTP_RequestHandler( websocksimplify.WSRequestHandler ):
 		'''
 		path = urllib.parse.unquote(self.path)
 		arg = None
-		if '?' in path: path, arg = path.split('?')
+		if '?' in path: path, arg = path.split('?', 1)
 		print('do_get_custom', path)
-		fpath = os.path.join( SCRIPT_DIR, path[1:] )
 
 		content_length = None # dynamic requests need to set this length
 		content_type = None
+		etag = last_modified = None
+		cache_control = content_encoding = vary = None
 		dynamic = True
 		data = None
+		asset = None
 		if path=='/favicon.ico': content_length = 0
 
+		elif path == '/zone' and ZONE_ROUTER and arg and arg != ZONE:  ## another instance serves that zone
+			host = zone_router.split_host( self.headers.get('Host') ) or None
+			self.send_head( redirect=ZONE_ROUTER.get_url(arg, host) )
+			return
+
 		elif path in ('/', '/zone'):
-			zone = None
-			if path == '/zone': zone = arg
+			zone = ZONE
+			if path == '/zone' and arg: zone = arg
 			data = generate_html_header( websocket_port=get_host_and_port()[-1], websocket_path=zone ).encode('utf-8')
-			content_type = 'text/html; charset=utf-8'
+			asset = StaticAssets.put( '%s?%s'%(path,zone), data, 'text/html; charset=utf-8' )
 
-		elif path.startswith('/javascripts/'):
-			## only serve static javascript files
-			data = open( fpath, 'rb' ).read()
-			content_type = 'text/javascript; charset=utf-8'
-
-		elif path.startswith('/bake/'): pass
+		elif path.startswith( ('/javascripts/', '/textures/', '/sounds/') ):
+			## static files are read, hashed and compressed once, see static_assets.py ##
+			asset = StaticAssets.get( path )
+			if asset is None:
+				self.send_error(404, "File not found")
+				return
+			last_modified = asset.mtime
 
-		elif path.startswith('/textures/'): # special static textures
-			data = open( fpath, 'rb' ).read()
+		elif path.startswith('/bake/'):  ## textures baked by ExternalAPI.bake_image, only what is already in the BakeCache
+			query = bake_cache.parse_bake_query( arg )
+			uid = path.split('/')[-1][ :-4 ]	# strip ".jpg"
+			ob = UID_Registry.get_object( int(uid.replace('_','')) ) if uid.replace('_','').isdigit() else None  ## not get_object_by_UID, that raises in STRICT mode
+			if query is None or ob is None or ob.type != 'MESH':
+				self.send_error(404, "File not found")
+				return
+			bake_type, size = query
+			for key in bake_cache.get_bake_keys( ob, bake_type, lod=path.startswith('/bake/LOD/') ):
+				data = BakeCache.get( key, size )
+				if data: break
 
 		elif path.startswith('/objects/'):
 			assert path.endswith('.dae')  ## TODO deprecate collada
@@ -1302,34 +1640,74 @@ class WebsocketHTTP_RequestHandler( websocksimplify.WSRequestHandler ):
 			uid = name[ : -4 ]
 			ob = get_object_by_UID( uid )
 			if ob:
-				data = dump_collada( ob, ) #center=arg=='hires' )
-
-		elif path.startswith('/sounds/'):
-			print('requesting sound')
-			data = open( fpath, 'rb' ).read()
+				etag = ExportCache.get_key( ob )
+				if not self.is_not_modified( etag ):
+					path = ExportCache.get( ob, key=etag )  ## waits for the main loop to export it
+					if path:
+						data = open( path, 'rb' ).read()
+						last_modified = os.path.getmtime( path )
+
+		elif path.startswith('/geometry/'):  ## packed buffers from GeometryCache
+			assert path.endswith('.bin')
+			content_type = 'application/octet-stream'
+			data = GeometryCache.get_buffer( path.split('/')[-1][ : -4 ] )
+			if data is None:
+				self.send_error(404, "Geometry not cached")
+				return
+
+		elif path == '/stats':  ## cache and per player websocket stats
+			content_type = 'application/json; charset=utf-8'
+			stats = { 'geometry':GeometryCache.get_stats(), 'export':ExportCache.get_stats(), 'material':MaterialCache.get_stats() }
+			stats['assets'] = StaticAssets.get_stats()
+			if ZONE: stats['zone'] = ZONE
+			stats['proxy'] = ProxyCache.get_stats()
+			stats['bake'] = BakeCache.get_stats()
+			if GameManager.world_snapshot: stats['world'] = GameManager.world_snapshot.get_stats()
+			stats['mesh_stream'] = dict( ('%s:%s'%p.address, p.mesh_stream.get_stats()) for p in list(GameManager.clients.values()) )
+			if hasattr( ExternalAPI, 'get_websocket_stats' ):
+				stats['players'] = ExternalAPI.get_websocket_stats()
+			data = json.dumps( stats ).encode('utf-8')
 
 		elif path == '/test':
 			content_type = 'text/html; charset=utf-8'
 			data = TESTING 
 
-		elif path.startswith('/proxy/'): ## proxy images and other data
-			url = path.split('/proxy/')[-1]
-			assert url.startswith( ('http://', 'https://') )
-			f = urllib.request.urlopen(url)
-			data = f.read()
-			f.close()
+		elif path.startswith('/proxy/'): ## proxy images and other data, cached and shared by all clients (proxy_cache.py)
+			url = path.split('/proxy/',1)[-1]
+			if arg: url += '?' + arg
+			try: entry = ProxyCache.get( url )
+			except ProxyError as err:
+				self.send_error( 502 if err.status < 400 else err.status, err.reason )
+				return
+			content_type = entry.content_type
+			etag = entry.get_etag()
+			cache_control = 'public, max-age=%s' %max( 0, int(entry.expires - time.time()) )
+			if not self.is_not_modified( etag ): data = entry.data
 
 		else: print('warn: unknown request url', path)
 
+		if asset:  ## 304 if the browser has it, otherwise the gzip variant when the browser takes it
+			etag = asset.etag
+			content_type = asset.content_type
+			cache_control = asset.cache_control
+			data = None
+			if not self.is_not_modified( etag, last_modified ):
+				data, content_encoding = asset.get_data( self.accepts_gzip() )
+			if asset.gzip: vary = 'Accept-Encoding'
 
 		if data: content_length = len( data )
 		self.send_head( 
 			content_length=content_length, 
 			content_type=content_type,
-			require_path=not dynamic 
+			last_modified=last_modified,
+			require_path=not dynamic,
+			etag=etag,
+			cache_control=cache_control,
+			content_encoding=content_encoding,
+			vary=vary,
 		)
 		## it is now safe to write data ##
-		if data:
+		if data and self.last_code != 304:
 			self.wfile.write(data)
 			self.wfile.flush() # maybe not required, but its ok to flush twice.
 		print('web request complete')
@@ -1423,9 +1801,12 @@ def generate_html_header(title='webgl', external_three=False, websocket_port=808
 		'postprocessing/DotScreenPass.js',
 
 	)
-	#if external_three:
-	for x in three:
-		h.append( '<script type="text/javascript" src="/javascripts/%s"></script>' %x )
+	if BUNDLE_JAVASCRIPT:  ## one request, cached by the browser until one of the files changes
+		url = StaticAssets.bundle( 'three', [ '/javascripts/%s'%x for x in three ] )
+		h.append( '<script type="text/javascript" src="%s"></script>' %url )
+	else:
+		for x in three:
+			h.append( '<script type="text/javascript" src="/javascripts/%s"></script>' %x )
 
 	if dancer:
 		h.append( '<script src="/javascripts/dancer/dancer.js"></script> ' )
@@ -1449,6 +1830,7 @@ def generate_javascript( websocket_path ):
 	## TODO get this from place where api is set ##
 	h.append( api_gen.generate_javascript() )
 	print(h[-1])
+	h.append( geometry_codec.generate_javascript() )
 
 	#if not external_three:
 	#	for x in three:
@@ -1461,10 +1843,10 @@ def generate_javascript( websocket_path ):
 	h.append( 'var HOST = "%s";' %_h )
 	h.append( 'var HOST_PORT = "%s";' %_p )
 
-	h.append( 'var MAX_PROGRESSIVE_TEXTURE = 512;' )
-	h.append( 'var MAX_PROGRESSIVE_NORMALS = 512;' )
-	h.append( 'var MAX_PROGRESSIVE_DISPLACEMENT = 512;' )
-	h.append( 'var MAX_PROGRESSIVE_DEFAULT = 256;' )
+	## the sizes textures are baked at, smaller sizes come from the same bake (bake_cache.py) ##
+	for type in ('TEXTURE', 'NORMALS', 'DISPLACEMENT'):
+		h.append( 'var MAX_PROGRESSIVE_%s = %s;' %(type, bake_cache.get_max_size(type)) )
+	h.append( 'var MAX_PROGRESSIVE_DEFAULT = %s;' %bake_cache.MAX_PROGRESSIVE_DEFAULT )
 
 	if websocket_path:
 		h.append( 'var WEBSOCKET_PATH = "%s";'%websocket_path )
@@ -1472,7 +1854,7 @@ def generate_javascript( websocket_path ):
 		h.append( 'var WEBSOCKET_PATH = undefined;' )
 
 
-	h.append( open( os.path.join(SCRIPT_DIR,'client.js'), 'rb' ).read().decode('utf-8') )
+	h.append( StaticAssets.get_text( '/client.js' ) )  ## only read again when the file changes
 
 	h.append( insert_custom_javascript() )
 
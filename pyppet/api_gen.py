@@ -1,14 +1,15 @@
 # API Generator with binary data packing
 # Copyright Brett Hartshorn 2012-2013
 # License: "New" BSD
-import os, sys, time
+import os, sys, time, math
 import inspect, struct, ctypes, random
-import collections
-try: import bpy, mathutils
+import collections, itertools, threading
+try: import mathutils
 except ImportError: pass
 
 from nbge import *
 from animation_api import *
+from uid_registry import UID_Registry
 
 
 on_create_object_view_callback = None  ## for monkey patching, should accept keywoard args: object, wrapper, scripts
@@ -129,11 +130,44 @@ def generate_api( a, **kw ):
 
 
 
+ACTION_QUEUE_JAVASCRIPT = '''
+var _action_queue_ = [];
+var _action_flush_timer_ = null;
+var _action_flush_ms_ = 10; // actions queued within this time are sent as one frame
+function _queue_action_( arr ) {
+	_action_queue_.push( arr );
+	if (_action_flush_timer_ === null) {
+		_action_flush_timer_ = setTimeout( _flush_actions_, _action_flush_ms_ );
+	}
+}
+function _flush_actions_() {
+	_action_flush_timer_ = null;
+	if (_action_queue_.length == 1) {
+		ws.send( _action_queue_[0] );
+	} else if (_action_queue_.length > 1) {
+		var batch = [%s]; // batch marker, see CallbackFunction.decode_batch
+		for (var i=0; i < _action_queue_.length; i++) {
+			var a = _action_queue_[i];
+			batch.push( a.length & 255, (a.length >> 8) & 255 );
+			batch = batch.concat( a );
+		}
+		ws.send( batch );
+	}
+	_action_queue_ = [];
+	ws.flush(); // ensure the servers gets the frame whole
+}
+'''
+
 def generate_javascript():
 	g = '_callbacks_'
-	a = ['var %s = {};'%g]
+	a = ['var %s = {};'%g, ACTION_QUEUE_JAVASCRIPT %CallbackFunction.BATCH_MARKER]
 	for cb in CallbackFunction.CALLBACKS.values():
 		a.append( cb.generate_javascript(g) )
+
+	g = '_stream_decoders_'
+	a.append( 'var %s = {};'%g )
+	for fmt in StreamRecordFormat.FORMATS.values():
+		a.append( fmt.generate_javascript(g) )
 	return '\n'.join( a )
 
 
@@ -174,6 +208,28 @@ class ContainerInternal(object):
 	def __getattr__(self, name): return getattr(self.__dict__['__object_view'], '_Container__'+name)
 
 
+_property_versions = itertools.count(1)  ## global, so versions of views and their parents can be compared
+_property_versions_lock = threading._allocate_lock()
+_touched_containers = None  ## containers changed since pop_touched, None until track_touched is called
+
+def track_touched():
+	'''
+	start keeping the changed containers, for player_shards.py that sends only what changed to its workers
+	'''
+	global _touched_containers
+	with _property_versions_lock:
+		if _touched_containers is None: _touched_containers = set()
+
+def pop_touched():
+	'''
+	returns the containers changed since the last call, and starts a new set
+	'''
+	global _touched_containers
+	with _property_versions_lock:
+		touched = _touched_containers or set()
+		if _touched_containers is not None: _touched_containers = set()
+	return touched
+
 class Container(object):
 	#__properties = {} # global to all subclasses (if they do not provide their own)
 	#__viewers    = {} # global to all subclasses - thanks Miran.
@@ -185,6 +241,8 @@ class Container(object):
 
 	def __init__(self, **kw):
 		self.__properties = {}
+		self.__version = 0   # version of the last property change
+		self.__changes = collections.OrderedDict()  # name : version, most recent change last
 		self.__subproperties = {}
 		self.__viewers = {}
 		self.__eval_queue = []
@@ -207,6 +265,42 @@ class Container(object):
 	def __eval(self, *args):
 		if args: self.__eval_queue.extend( args )
 
+	def __touch(self, name):
+		'''
+		marks a property as changed, called by __setitem__ (and so by animation ticks)
+		'''
+		with _property_versions_lock:
+			version = next( _property_versions )
+			self.__changes.pop( name, None )
+			self.__changes[ name ] = version
+			self.__version = version
+			if _touched_containers is not None: _touched_containers.add( self )
+
+	def __get_version(self):
+		'''
+		version of the last change, including upstream properties of the parent.
+		'''
+		version = self.__version
+		if self.__allow_upstream_properties and self.__parent:
+			version = max( version, self.__parent.__get_version() )
+		return version
+
+	def __changed_since(self, version):
+		'''
+		names of the properties changed after version, the cost is the number of changes.
+		'''
+		names = []
+		with _property_versions_lock:
+			for name in reversed( self.__changes ):
+				if self.__changes[ name ] <= version: break
+				names.append( name )
+		allow = self.__allow_upstream_properties
+		if allow and self.__parent:
+			for name in self.__parent.__changed_since( version ):
+				if (allow is True or name in allow) and name not in self.__properties:
+					names.append( name )
+		return names
+
 	def __call__(self, viewer=None, reset=False ):
 		'''
 		The Container only contains data attributes to keep scripting these objects simple.
@@ -329,7 +423,11 @@ class Container(object):
 			#
 			#else:
 
+			old = self.__properties.get( name, self )  ## self is never a value, it means missing
 			self.__properties[ name ] = value
+			## animations edit lists in place and then reassign them, so the same object counts as a change ##
+			if old != value or (value is old and type(value) in (list, dict)): self.__touch( name )
+
 			p = self.__proxy
 			if self.__sproxy and name in self.__sproxy_attrs: p = self.__sproxy
 
@@ -664,40 +762,61 @@ class CallbackFunction(object):
 			assert self.struct_format.count('s')==1  # only a single variable length string is allowed at the end
 			assert self.struct_format.endswith('s')
 			self.sends_string_data = True
+			self.struct = struct.Struct( self.struct_format[:-1] )  ## packed data before the string
 		else:
 			self.sends_string_data = False
+			self.struct = struct.Struct( self.struct_format )
+
+		## (name, unpacker or None) for the packed arguments, in order ##
+		self._decoders = []
+		for name in self.arguments:
+			ctype = self.arg_types[ name ]
+			if ctype is ctypes.c_char_p: continue
+			if ctype in self.TYPES: self._decoders.append( (name, ctype) )
+			else: self._decoders.append( (name, None) )
 
 
 	def decode_args( self, data ):
 		'''
 		returns keyword args, (callback needs full keyword typed args)
+		data can be bytes or a memoryview
 		'''
 		kw = {}
-		fmt = self.struct_format
-
-		if fmt.endswith('s'): # special case, read one variable length string
-			fmt = fmt[:-1]
-			header = struct.calcsize( fmt ); print('header', header)
-			string = data[ header : ].decode('utf-8'); print('string', string)
-			data = data[ : header ]; print('data', data)
-			#a = struct.unpack('%ss'%len(string), string)[0].decode('utf-8')
-			#print(a)
-			kw[ self.arguments[-1] ] = string
-
-		if data: # packed data can precede variable length string data
-			args = struct.unpack( fmt, data )  ## unpack data
-
-			for i,name in enumerate( self.arguments ):  ## check for UID's and replace them with real objects
-				if name in kw: continue
-				ctype = self.arg_types[name]
-				if ctype in self.TYPES:
+		header = self.struct.size
+
+		if self.sends_string_data: # special case, read one variable length string
+			kw[ self.arguments[-1] ] = bytes( data[ header : ] ).decode('utf-8')
+
+		if header: # packed data can precede variable length string data
+			args = self.struct.unpack_from( data, 0 )  ## unpack data
+			for i, (name, ctype) in enumerate( self._decoders ):  ## check for UID's and replace them with real objects
+				if ctype is None:
+					kw[ name ] = args[i]  ## already unpacked above
+				else:
 					## the user must provide the unpacker function, takes UID and returns a object
 					kw[ name ] = self.TYPES[ ctype ]['unpacker']( args[i] )
-				else:
-					kw[ name ] = args[i]  ## already unpacked above
 
 		return kw
 
+	BATCH_MARKER = 1  ## first byte of a websocket frame with many actions
+	_batch_length = struct.Struct('<H')
+
+	@classmethod
+	def decode_batch( cls, data ):
+		'''
+		a batch frame from the generated javascript is the marker byte,
+		then for each action: uint16 length, function code byte, packed args.
+		yields (code, args) where args is a memoryview of the frame
+		'''
+		view = memoryview( data )
+		offset = 1
+		end = len( view )
+		while offset + 3 <= end:
+			length = cls._batch_length.unpack_from( view, offset )[0]
+			offset += 2
+			yield chr( view[offset] ), view[ offset+1 : offset+length ]
+			offset += length
+
 
 
 	def size_of(self, T):
@@ -767,18 +886,143 @@ class CallbackFunction(object):
 			#r.append('	ws.send_string( txt );')
 			r.append('	arr = arr.concat( txt.split("").map(function(c){return c.charCodeAt(0);}) );')
 
-		r.append('  ws.send( arr ); // send packed data to server')
-
-		r.append('  ws.flush(); // ensure the servers gets the frame whole')
+		r.append('  _queue_action_( arr ); // sent with other actions in a single frame')
 		r.append('  return arr;')
 		r.append( '  }')
 
 		return '\n'.join(r)
 
+
+##########################################################################
+
+class StreamRecordFormat(object):
+	'''
+	Fixed layout binary records for the server to client object stream.
+	Each record is: UID (uint16), dirty bitmask (uint8), then only the fields
+	whose bit is set in the mask, in the order they are defined.
+	A whole frame is: null byte, format code byte, then the packed records.
+
+	fields is a sequence of: (name, type, count, quantize)
+		quantize can be None, or a multiplier applied before packing into integer types,
+		the generated javascript decoder divides by the same value.
+	'''
+	FORMATS = {} ## byte-code : record format
+
+	_type_to_struct_format = {
+		'float32': 'f',
+		'int32'  : 'i',
+		'uint32' : 'I',
+		'int16'  : 'h',
+		'uint16' : 'H',
+		'uint8'  : 'B',
+	}
+	_type_limits = {
+		'int32'  : (-2**31, 2**31-1),
+		'uint32' : (0, 2**32-1),
+		'int16'  : (-2**15, 2**15-1),
+		'uint16' : (0, 2**16-1),
+		'uint8'  : (0, 255),
+	}
+	_type_to_js_getter = {
+		'float32': 'getFloat32',
+		'int32'  : 'getInt32',
+		'uint32' : 'getUint32',
+		'int16'  : 'getInt16',
+		'uint16' : 'getUint16',
+		'uint8'  : 'getUint8',
+	}
+
+	def __init__(self, name, code, fields):
+		assert code not in self.FORMATS
+		assert len(fields) <= 8  ## the dirty mask is a single byte
+		self.FORMATS[ code ] = self
+		self.name = name
+		self.code = code
+		self.fields = []
+		self.bits = {}  ## field name : mask bit
+		for i, field in enumerate(fields):
+			fname, ftype, count, quantize = field
+			assert ftype in self._type_to_struct_format
+			if quantize: assert ftype != 'float32'
+			self.fields.append( field )
+			self.bits[ fname ] = 1 << i
+
+		self.all_bits = (1 << len(fields)) - 1
+		self._structs = {}  ## mask : precompiled struct.Struct
+
+	def get_struct(self, mask):
+		if mask not in self._structs:
+			fmt = '<HB'
+			for i, (fname, ftype, count, quantize) in enumerate(self.fields):
+				if mask & (1 << i):
+					fmt += self._type_to_struct_format[ ftype ] * count
+			self._structs[ mask ] = struct.Struct( fmt )
+		return self._structs[ mask ]
+
+	def pack(self, uid, mask, values):
+		'''
+		values is a dict of field name : tuple, only fields in the mask are packed.
+		'''
+		args = [ uid, mask ]
+		for i, (fname, ftype, count, quantize) in enumerate(self.fields):
+			if not mask & (1 << i): continue
+			if quantize:
+				lo, hi = self._type_limits[ ftype ]
+				args.extend( [ max(lo, min(hi, int(round(v*quantize)))) for v in values[fname] ] )
+			else:
+				args.extend( values[fname] )
+		return self.get_struct( mask ).pack( *args )
+
+	def pack_frame(self, records):
+		'''
+		records is a list of packed records from self.pack
+		'''
+		return bytes([0, ord(self.code)]) + b''.join( records )
+
+	def generate_javascript(self, global_container_name):
+		'''
+		Generate a javascript function that takes the frame bytes (after the null byte)
+		and returns a list of decoded records.
+		'''
+		r = ['//generated stream decoder: %s' %self.name]
+		r.append( '%s["%s"] = function ( bytes ) {'%(global_container_name, self.code) )
+		r.append( '  var view = new DataView( new Uint8Array(bytes).buffer );' )
+		r.append( '  var offset = 1; // skip format code' )
+		r.append( '  var records = [];' )
+		r.append( '  while (offset < view.byteLength) {' )
+		r.append( '    var rec = {};' )
+		r.append( '    rec.UID = view.getUint16(offset, true); offset += 2;' )
+		r.append( '    rec.mask = view.getUint8(offset); offset += 1;' )
+		for i, (fname, ftype, count, quantize) in enumerate(self.fields):
+			getter = self._type_to_js_getter[ ftype ]
+			size = struct.calcsize( self._type_to_struct_format[ftype] )
+			r.append( '    if (rec.mask & %s) {'%(1 << i) )
+			r.append( '      rec.%s = [];'%fname )
+			for j in range(count):
+				if quantize:
+					r.append( '      rec.%s.push( view.%s(offset, true) / %s ); offset += %s;'%(fname, getter, float(quantize), size) )
+				else:
+					r.append( '      rec.%s.push( view.%s(offset, true) ); offset += %s;'%(fname, getter, size) )
+			r.append( '    }' )
+		r.append( '    records.push( rec );' )
+		r.append( '  }' )
+		r.append( '  return records;' )
+		r.append( '  }' )
+		return '\n'.join(r)
+
+## object transform stream - rotation is quantized to int16 over -pi..pi ##
+TRANSFORM_STREAM = StreamRecordFormat(
+	'transform', 't',
+	(
+		('pos', 'float32', 3, None),
+		('rot', 'int16', 3, 32767 / math.pi),
+		('scl', 'float32', 3, None),
+	)
+)
+
 #####################################################################################
 def get_blender_object_by_uid(uid):
-	for o in bpy.data.objects:
-		if o.UID == uid: return o
+	return UID_Registry.get_object( uid )
 
 register_type( BlenderProxy, get_blender_object_by_uid )
 
@@ -0,0 +1,298 @@
+# Bake Cache - content addressed texture bakes, encoded and mipmapped on a worker pool
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import os, io, time, hashlib, tempfile, threading, subprocess, traceback, multiprocessing
+import concurrent.futures
+from geometry_cache import get_geometry_key
+try: from PIL import Image
+except ImportError: Image = None
+
+'''
+a texture is baked once at the largest size the client will ask for (MAX_PROGRESSIVE), then every
+smaller power of two size is made from it, so the progressive requests from the client
+(64, 128, 256...) are all served by one bake.
+each size is encoded as a JPEG and as a 128 colour PNG and the smaller one is kept,
+Three.js ignores the file extension and loads the data even if a png is called a jpg.
+without PIL the same is done with ImageMagick's convert, still on the worker pool.
+'''
+
+## largest size the client requests progressively, the server injects these into the page ##
+MAX_PROGRESSIVE = {'TEXTURE':512, 'NORMALS':512, 'DISPLACEMENT':512}
+MAX_PROGRESSIVE_DEFAULT = 256
+MIN_MIP_SIZE = 32
+JPEG_QUALITY = 75
+PNG_COLORS = 128
+GAMMA = {'DISPLACEMENT':0.36}  ## brightens the displacement maps, as convert -gamma does
+BAKE_WORKERS = max( 2, multiprocessing.cpu_count() )
+BAKE_SETTINGS = {'margin':4, 'normalize':True}
+
+def get_max_size( type ):
+	return MAX_PROGRESSIVE.get( type, MAX_PROGRESSIVE_DEFAULT )
+
+def get_mip_sizes( size, min_size=MIN_MIP_SIZE ):
+	'''
+	size and every half of it down to min_size, largest first
+	'''
+	sizes = [ size ]
+	while size // 2 >= min_size:
+		size //= 2
+		sizes.append( size )
+	return sizes
+
+def get_bake_key( ob, type, extra_objects=(), settings=BAKE_SETTINGS ):
+	'''
+	hash of what goes into a bake: the mesh and modifiers (get_geometry_key), the world matrix,
+	the materials and their images, the objects baked to this one, and the bake settings.
+	note: for AO and SHADOW the other objects in the scene are not part of the key.
+	'''
+	h = hashlib.md5()
+	h.update( ('%s|%s|%s' %(type, get_geometry_key(ob), sorted(settings.items()))).encode('utf-8') )
+	h.update( str([tuple(row) for row in ob.matrix_world]).encode('utf-8') )
+	for mat in ob.data.materials:
+		if not mat: continue
+		h.update( ('%s%s%s' %(mat.name, tuple(mat.diffuse_color), tuple(mat.specular_color))).encode('utf-8') )
+		for slot in mat.texture_slots:
+			if slot and slot.texture and getattr( slot.texture, 'image', None ):
+				img = slot.texture.image
+				h.update( ('%s%s%s' %(img.name, img.filepath, tuple(img.size))).encode('utf-8') )
+	for o in extra_objects:
+		h.update( get_geometry_key(o).encode('utf-8') )
+		h.update( str([tuple(row) for row in o.matrix_world]).encode('utf-8') )
+	return '%s-%s' %(ob.name, h.hexdigest()[:16])
+
+def get_bake_keys( ob, type, lod=False ):
+	'''
+	the keys ExternalAPI.bake_image uses for /bake/<UID>.jpg, most specific first: for /bake/LOD/<UID>.jpg
+	the LOD proxy child is baked with ob as the extra object, ob itself if it has no proxy.
+	'''
+	keys = []
+	if lod:
+		for child in ob.children:
+			if getattr( child, 'is_lod_proxy', False ):
+				keys.append( get_bake_key(child, type, [ob]) )
+				break
+	keys.append( get_bake_key(ob, type) )
+	return keys
+
+def parse_bake_query( arg ):
+	'''
+	"TYPE|SIZE|REFRESH" returns (type, size), or None if it is malformed
+	'''
+	parts = (arg or '').split('|')
+	if len(parts) < 2 or not parts[1].isdigit() or not parts[0].isalpha(): return None
+	return parts[0].upper(), int( parts[1] )
+
+def _gamma_table( gamma, bands ):
+	table = [ int(round( 255 * (i/255.0) ** (1.0/gamma) )) for i in range(256) ]
+	return table * bands
+
+def encode_image( img, gamma=None ):
+	'''
+	returns (data, ext, other) the smaller of a JPEG and a 128 colour PNG of the PIL image,
+	other is the size of the larger one.
+	'''
+	if gamma: img = img.point( _gamma_table(gamma, len(img.getbands())) )
+	jpg = io.BytesIO()
+	img.convert( 'RGB' ).save( jpg, 'JPEG', quality=JPEG_QUALITY, optimize=True )
+	png = io.BytesIO()
+	if 'A' in img.getbands(): q = img.convert( 'RGBA' ).quantize( PNG_COLORS, method=2 )  ## fast octree keeps alpha
+	else: q = img.convert( 'RGB' ).quantize( PNG_COLORS )
+	q.save( png, 'PNG', optimize=True )
+	jpg = jpg.getvalue(); png = png.getvalue()
+	if len(png) < len(jpg): return png, 'png', len(jpg)
+	return jpg, 'jpg', len(png)
+
+def encode_with_convert( source, size, gamma=None ):
+	'''
+	ImageMagick fallback when PIL is not installed, same result as encode_image
+	'''
+	args = [ '-resize', '%sx%s' %(size,size) ]
+	if gamma: args += [ '-gamma', str(gamma) ]
+	out = {}
+	for ext, opts in ( ('jpg', ['-quality', str(JPEG_QUALITY)]), ('png', ['-colors', str(PNG_COLORS)]) ):
+		out[ ext ] = subprocess.check_output( ['convert', source] + args + opts + ['%s:-' %ext] )
+	if len(out['png']) < len(out['jpg']): return out['png'], 'png', len(out['jpg'])
+	return out['jpg'], 'jpg', len(out['png'])
+
+
+class BakeCacheSingleton(object):
+	'''
+	Bakes are files in path: <key>-<size>.source.png is what blender saved, and <key>-<size>.jpg (or .png)
+	the encoded sizes. The blender api is not thread safe, so the bake itself is done by the caller
+	(core.BlenderHack.bake_image), only the encoding runs on the pool.
+	'''
+	MAX_FILES = 2048   ## encoded sizes
+	MAX_SOURCES = 256  ## what blender saved, only removed when nothing is being encoded from it
+
+	def __init__(self, path=None, workers=BAKE_WORKERS):
+		self.path = path or os.path.join( tempfile.gettempdir(), 'texture-cache' )
+		self.pool = concurrent.futures.ThreadPoolExecutor( workers )  ## PIL releases the GIL while it encodes
+		self.pending = {}  # (key, size) : Future
+		self.files = {}    # (key, size) : path of the encoded file
+		self.lock = threading._allocate_lock()
+		self.hits = 0
+		self.bakes = 0
+		self.encoded = 0
+		self.source_bytes = 0   ## what blender saved
+		self.encoded_bytes = 0  ## all encoded sizes
+		self.saved_bytes = 0    ## the larger candidate minus the one kept
+		self.encode_time = 0.0
+
+	def get_source_path(self, key, size):
+		if not os.path.isdir( self.path ): os.makedirs( self.path )
+		return os.path.join( self.path, '%s-%s.source.png' %(key, size) )
+
+	def lookup(self, key, size):
+		'''
+		returns the path of the encoded file or None
+		'''
+		path = self.files.get( (key, size) )
+		if path and os.path.isfile( path ): return path
+		for ext in ('jpg', 'png'):
+			path = os.path.join( self.path, '%s-%s.%s' %(key, size, ext) )
+			if os.path.isfile( path ):
+				self.files[ (key, size) ] = path
+				return path
+		return None
+
+	def find_source(self, key, size):
+		'''
+		returns (path, bake size) of a source at least as large as size, or (None, None)
+		'''
+		for s in sorted( set([size, max(MAX_PROGRESSIVE.values()), MAX_PROGRESSIVE_DEFAULT]), reverse=True ):
+			if s < size: continue
+			path = os.path.join( self.path, '%s-%s.source.png' %(key, s) )
+			if os.path.isfile( path ): return path, s
+		return None, None
+
+	def get(self, key, size, timeout=60.0):
+		'''
+		returns the encoded data, waits for it if it is being encoded, or None if it is not baked
+		'''
+		with self.lock: future = self.pending.get( (key, size) )
+		if future:
+			try: future.result( timeout )
+			except Exception: traceback.print_exc()
+		path = self.lookup( key, size )
+		if path is None: return None
+		self.hits += 1
+		with open( path, 'rb' ) as f: return f.read()
+
+	def submit(self, key, source, size, bake_size, gamma=None):
+		'''
+		queues the encoding of size first, then the rest of the mip chain of bake_size,
+		returns the future of size.
+		'''
+		self.source_bytes += os.path.getsize( source )
+		sizes = get_mip_sizes( bake_size )
+		if size not in sizes: sizes.append( size )
+		sizes.remove( size )
+		first = None
+		for s in [ size ] + sizes:
+			with self.lock:
+				future = self.pending.get( (key, s) )
+				new = future is None
+				if new: future = self.pending[ (key, s) ] = self.pool.submit( self._encode, key, source, s, bake_size, gamma )
+			if new: future.add_done_callback( lambda f, k=(key,s): self._done(k) )
+			if first is None: first = future
+		return first
+
+	def _done(self, k):
+		with self.lock: self.pending.pop( k, None )
+
+	def _encode(self, key, source, size, bake_size, gamma):
+		start = time.time()
+		try:
+			if Image:
+				img = Image.open( source )
+				img.load()
+				if size != bake_size:
+					img = img.resize( (size, size), getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS )
+				data, ext, other = encode_image( img, gamma )
+			else:
+				data, ext, other = encode_with_convert( source, size, gamma )
+		except Exception:  ## serve what blender saved, not nothing
+			traceback.print_exc()
+			try:
+				with open( source, 'rb' ) as f: data = f.read()
+			except IOError:  ## the source is gone too, bake_image bakes it again
+				traceback.print_exc()
+				return None
+			ext = 'png'; other = len(data)
+		path = os.path.join( self.path, '%s-%s.%s' %(key, size, ext) )
+		tmp = '%s.%s.tmp' %(path, threading.get_ident())
+		with open( tmp, 'wb' ) as f: f.write( data )
+		os.replace( tmp, path )  ## readers never see a partial file
+		other_path = os.path.join( self.path, '%s-%s.%s' %(key, size, 'jpg' if ext == 'png' else 'png') )
+		if os.path.isfile( other_path ): os.remove( other_path )  ## from a bake with refresh
+		self.files[ (key, size) ] = path
+		self.encoded += 1
+		self.encoded_bytes += len(data)
+		self.saved_bytes += other - len(data)
+		self.encode_time += time.time() - start
+		self.prune()
+		return path
+
+	def prune(self):
+		names = os.listdir( self.path )
+		sources = [ n for n in names if n.endswith('.source.png') ]
+		encoded = [ n for n in names if n.endswith( ('.jpg', '.png') ) and not n.endswith('.source.png') ]
+		self._remove_oldest( encoded, len(encoded) - self.MAX_FILES )
+		if len(sources) > self.MAX_SOURCES:
+			with self.lock: busy = set( key for key,size in self.pending )
+			sources = [ n for n in sources if n[ :-len('.source.png') ].rsplit('-', 1)[0] not in busy ]
+			self._remove_oldest( sources, len(sources) + len(busy) - self.MAX_SOURCES )
+
+	def _remove_oldest(self, names, count):
+		if count <= 0: return
+		paths = [ os.path.join(self.path, n) for n in names ]
+		paths.sort( key=os.path.getmtime )
+		for path in paths[ :count ]:
+			try: os.remove( path )
+			except OSError: pass
+
+	def get_stats(self):
+		return {
+			'pending':len(self.pending), 'hits':self.hits, 'bakes':self.bakes, 'encoded':self.encoded,
+			'source_bytes':self.source_bytes, 'encoded_bytes':self.encoded_bytes, 'saved_bytes':self.saved_bytes,
+			'encode_time':round( self.encode_time, 3 ),
+		}
+
+BakeCache = BakeCacheSingleton()
+
+
+if __name__ == '__main__':
+	import shutil
+	assert get_mip_sizes( 512 ) == [512, 256, 128, 64, 32] and get_mip_sizes( 20 ) == [20]
+	assert parse_bake_query( 'AO|64|True' ) == ('AO', 64) and parse_bake_query( 'TEXTURE' ) is None and parse_bake_query( 'AO|x' ) is None
+	if Image is None:
+		print('bake cache test skipped, PIL is not installed')
+	else:
+		root = tempfile.mkdtemp()
+		B = BakeCacheSingleton( root, workers=4 )
+		img = Image.new( 'RGBA', (256,256) )
+		img.putdata( [ (x, y, (x*y) % 256, 255) for y in range(256) for x in range(256) ] )
+		source = B.get_source_path( 'cube-0123', 256 )
+		img.save( source )
+		assert B.get( 'cube-0123', 64 ) is None
+
+		B.submit( 'cube-0123', source, 64, 256, gamma=GAMMA['DISPLACEMENT'] ).result()
+		data = B.get( 'cube-0123', 64 )
+		assert Image.open( io.BytesIO(data) ).size == (64, 64)
+		for size in (256, 128, 32): assert Image.open( io.BytesIO(B.get('cube-0123', size)) ).size == (size, size)
+		assert B.find_source( 'cube-0123', 128 ) == (source, 256) and B.find_source( 'cube-0123', 1024 ) == (None, None)
+		assert B.encoded == 4 and B.saved_bytes > 0 and not B.pending
+
+		for name in ('old-a', 'old-b'): img.save( B.get_source_path(name, 64) )
+		B.MAX_SOURCES = 1
+		B.pending[ ('cube-0123', 64) ] = None  ## sources with queued encodes are kept
+		B.prune()
+		assert os.path.isfile( source ) and not os.path.isfile( B.get_source_path('old-a', 64) )
+		assert B.lookup( 'cube-0123', 64 )  ## encoded files do not count against MAX_SOURCES
+		B.pending.clear()
+
+		flat = Image.new( 'RGB', (128,128), (200,10,10) )  ## the png wins for flat colours
+		assert encode_image( flat )[1] == 'png'
+		shutil.rmtree( root )
+		print('bake cache test done', B.get_stats())
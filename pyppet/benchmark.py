@@ -0,0 +1,529 @@
+# Benchmark - synthetic websocket clients and a json report of the streaming performance
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import os, sys, time, json, math, zlib, socket, select, struct, random, base64, hashlib, platform, subprocess
+import http.client, multiprocessing
+
+'''
+the clients speak the same protocol as client.js, without a browser:
+	camera frames - null byte then 6 little endian floats (location and focal point), 8 times a second
+	{"request":"start_object_stream"} - once connected
+	{"request":"mesh", "id":name} - for every object with a mesh_id that is not in the mesh cache
+	binary actions - the on_click function code, then the user and object UID as uint32
+and they fly between random waypoints in the scene. Run with python3 while a server is up:
+
+	python3 benchmark.py --port=8080 --pid=SERVER_PID --clients=50 --duration=60 --report=out.json
+	python3 benchmark.py ... --compare=baseline.json   ## exits with 1 if a metric got worse than --threshold
+
+latency in the report is: connect (tcp and handshake), first frame (start_object_stream to the first
+object stream frame), mesh (request to the last byte of the geometry), and the gaps between frames.
+with --pid the cpu time of the server process is sampled, and divided by the ticks of the world snapshot
+from /stats to get the server cpu per tick.
+'''
+
+REPORT_VERSION = 1
+CAMERA_RATE = 8.0  ## per second, as update_player_view in client.js
+RECV_SIZE = 65536
+
+## metric : True if higher is better, used by compare ##
+COMPARE_METRICS = (
+	('frames_per_second', True),
+	('frame_gap_ms_p95', False),
+	('connect_ms_p95', False),
+	('first_frame_ms_p95', False),
+	('mesh_ms_p50', False),
+	('mesh_ms_p95', False),
+	('kbytes_per_client_per_second', None),  ## changes are reported, not a regression either way
+	('server_cpu_percent', False),
+	('server_cpu_ms_per_tick', False),
+	('disconnected', False),
+)
+
+def percentile( values, p ):
+	if not values: return None
+	values = sorted( values )
+	k = (len(values) - 1) * p / 100.0
+	f = int( math.floor(k) ); c = min( f + 1, len(values) - 1 )
+	return values[f] + (values[c] - values[f]) * (k - f)
+
+def mask_frame( payload, opcode=2 ):
+	'''
+	client to server frames must be masked
+	'''
+	header = bytearray( [0x80 | opcode] )
+	n = len(payload)
+	if n <= 125: header.append( 0x80 | n )
+	elif n < 65536: header += bytes( [0x80 | 126] ) + struct.pack( '>H', n )
+	else: header += bytes( [0x80 | 127] ) + struct.pack( '>Q', n )
+	key = os.urandom( 4 )
+	masked = bytes( b ^ key[i % 4] for i, b in enumerate(payload) )
+	return bytes( header ) + key + masked
+
+
+class SyntheticClient(object):
+	'''
+	one websocket connection, its position in the scene and what it has received
+	'''
+	def __init__(self, index, host, port, path='', deflate=False, area=100.0, height=2.0, speed=5.0, click_rate=0.0, seed=None):
+		self.index = index
+		self.host = host
+		self.port = port
+		self.path = path
+		self.deflate = deflate
+		self.area = area
+		self.height = height
+		self.speed = speed
+		self.click_rate = click_rate
+		self.random = random.Random( seed if seed is not None else index )
+		self.sock = None
+		self.inflate = None
+		self.buffer = b''
+		self.closed = False
+		self.closed_at = None
+		self.error = None
+		self.location = self.random_waypoint()
+		self.waypoint = self.random_waypoint()
+		self.objects = {}     # name : mesh_id
+		self.mesh_cache = set()
+		self.requested = {}   # name : time of the mesh request
+		self.pending = {}     # geometry uid : [name, bytes, received]
+		self.clickable = {}   # name : (code, user uid, object uid)
+		self.http = None      ## for the geometry urls without --mesh-chunks
+		self.stats = {
+			'connect_ms':None, 'first_frame_ms':None, 'frames':0, 'binary_frames':0, 'chunk_frames':0,
+			'wire_bytes':0, 'payload_bytes':0, 'sent_bytes':0, 'frame_gaps_ms':[], 'mesh_ms':[],
+			'meshes_requested':0, 'meshes_received':0, 'http_geometry_bytes':0, 'objects':0,
+			'clicks':0, 'camera_frames':0,
+		}
+		self._stream_started = None
+		self._last_frame = None
+		self._next_camera = 0.0
+		self._next_click = None
+		self._prev_time = None
+
+	def random_waypoint(self):
+		a = self.area * 0.5
+		return [ self.random.uniform(-a, a), self.random.uniform(-a, a), self.height ]
+
+	def connect(self, timeout=10.0):
+		start = time.time()
+		sock = socket.create_connection( (self.host, self.port), timeout )
+		key = base64.b64encode( os.urandom(16) ).decode('ascii')
+		request = [
+			'GET /%s HTTP/1.1' %self.path, 'Host: %s:%s' %(self.host, self.port),
+			'Upgrade: websocket', 'Connection: Upgrade', 'Sec-WebSocket-Key: %s' %key,
+			'Sec-WebSocket-Version: 13', 'Sec-WebSocket-Protocol: binary', 'Origin: http://%s:%s' %(self.host, self.port),
+		]
+		if self.deflate: request.append( 'Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits' )
+		sock.sendall( ('\r\n'.join(request) + '\r\n\r\n').encode('ascii') )
+		data = b''
+		while b'\r\n\r\n' not in data:
+			chunk = sock.recv( 4096 )
+			if not chunk: raise IOError( 'handshake closed' )
+			data += chunk
+		head, self.buffer = data.split( b'\r\n\r\n', 1 )
+		head = head.decode('latin-1')
+		if ' 101 ' not in head.split('\r\n')[0]: raise IOError( 'handshake failed: %s' %head.split('\r\n')[0] )
+		accept = base64.b64encode( hashlib.sha1( (key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode('ascii') ).digest() ).decode('ascii')
+		if accept not in head: raise IOError( 'bad Sec-WebSocket-Accept' )
+		if 'permessage-deflate' in head: self.inflate = zlib.decompressobj( -15 )
+		sock.setblocking( False )
+		self.sock = sock
+		now = time.time()
+		self.stats['connect_ms'] = (now - start) * 1000.0
+		self.send_json( {'request':'start_object_stream'} )
+		self._stream_started = self._prev_time = now
+		if self.click_rate: self._next_click = now + self.random.expovariate( self.click_rate )
+
+	def fileno(self): return self.sock.fileno()
+
+	def send(self, payload):
+		data = mask_frame( payload )
+		self.stats['sent_bytes'] += len(data)
+		try:
+			self.sock.setblocking( True )
+			self.sock.sendall( data )
+			self.sock.setblocking( False )
+		except socket.error as err:
+			self.close( err )
+
+	def send_json(self, ob):
+		self.send( json.dumps(ob).encode('utf-8') )
+
+	def close(self, error=None):
+		if self.closed: return
+		self.closed = True
+		self.closed_at = time.time()
+		self.error = str(error) if error else None
+		try: self.sock.close()
+		except socket.error: pass
+
+	## incoming ##
+	def on_readable(self):
+		try: data = self.sock.recv( RECV_SIZE )
+		except socket.error as err:
+			if getattr( err, 'errno', None ) in (11, 35): return  ## EAGAIN
+			return self.close( err )
+		if not data: return self.close( 'server closed' )
+		self.stats['wire_bytes'] += len(data)
+		self.buffer += data
+		while self.parse_frame(): pass
+
+	def parse_frame(self):
+		buf = self.buffer
+		if len(buf) < 2: return False
+		b1, b2 = buf[0], buf[1]
+		n = b2 & 0x7f; offset = 2
+		if n == 126:
+			if len(buf) < 4: return False
+			n = struct.unpack_from( '>H', buf, 2 )[0]; offset = 4
+		elif n == 127:
+			if len(buf) < 10: return False
+			n = struct.unpack_from( '>Q', buf, 2 )[0]; offset = 10
+		if len(buf) < offset + n: return False
+		payload = buf[ offset : offset+n ]
+		self.buffer = buf[ offset+n : ]
+		opcode = b1 & 0x0f
+		if opcode == 0x8: self.close( 'server sent close' ); return False
+		if opcode in (1, 2):
+			if b1 & 0x40: payload = self.inflate.decompress( payload + b'\x00\x00\xff\xff' )
+			self.on_message( payload )
+		return True
+
+	def on_message(self, payload):
+		now = time.time()
+		self.stats['payload_bytes'] += len(payload)
+		if payload and payload[0] == 0:
+			self.stats['binary_frames'] += 1
+			if len(payload) > 1 and chr(payload[1]) == 'g': self.on_geometry_chunks( payload, now )
+			return
+		msg = json.loads( payload.decode('utf-8') )
+		if 'meshes' not in msg: return  ## one json message per server tick once streaming
+		self.stats['frames'] += 1
+		if self.stats['first_frame_ms'] is None: self.stats['first_frame_ms'] = (now - self._stream_started) * 1000.0
+		if self._last_frame is not None: self.stats['frame_gaps_ms'].append( (now - self._last_frame) * 1000.0 )
+		self._last_frame = now
+		for name, pak in msg.get('meshes', {}).items():
+			if name not in self.objects:
+				self.objects[ name ] = pak.get('mesh_id')
+				self.stats['objects'] += 1
+				if not pak.get('empty') and pak.get('mesh_id') not in self.mesh_cache and name not in self.requested:
+					self.requested[ name ] = now
+					self.stats['meshes_requested'] += 1
+					self.send_json( {'request':'mesh', 'id':name} )
+			if 'mesh_id' in pak: self.objects[ name ] = pak['mesh_id']
+			geo = pak.get('geometry')
+			if geo:
+				if geo.get('chunked'):
+					self.pending[ geo['uid'] ] = [ name, geo['bytes'], 0 ]
+					if not geo['bytes']: self.on_mesh_loaded( name, now )
+				elif 'url' in geo:
+					self.stats['http_geometry_bytes'] += len( self.get_url(geo['url']) )
+					self.on_mesh_loaded( name, time.time() )
+			props = pak.get('properties')
+			if pak.get('on_click') and props and 'ob' in props and 'user' in props:
+				self.clickable[ name ] = (pak['on_click'], props['user'], props['ob'])
+
+	def on_geometry_chunks(self, payload, now):
+		self.stats['chunk_frames'] += 1
+		offset = 2
+		while offset + 10 <= len(payload):
+			uid, start, n = struct.unpack_from( '<HII', payload, offset )
+			offset += 10 + n
+			p = self.pending.get( uid )
+			if p is None: continue
+			p[2] += n
+			if p[2] >= p[1]:
+				self.pending.pop( uid )
+				self.on_mesh_loaded( p[0], now )
+
+	def on_mesh_loaded(self, name, now):
+		self.stats['meshes_received'] += 1
+		if self.objects.get( name ): self.mesh_cache.add( self.objects[name] )
+		if name in self.requested: self.stats['mesh_ms'].append( (now - self.requested.pop(name)) * 1000.0 )
+
+	def get_url(self, url):
+		if self.http is None: self.http = http.client.HTTPConnection( self.host, self.port, timeout=10.0 )
+		try:
+			self.http.request( 'GET', url )
+			return self.http.getresponse().read()
+		except (http.client.HTTPException, socket.error):
+			self.http.close(); self.http = None
+			return b''
+
+	## outgoing ##
+	def update(self, now):
+		'''
+		moves towards the waypoint, sends the camera at CAMERA_RATE and clicks at click_rate
+		'''
+		dt = now - self._prev_time
+		self._prev_time = now
+		d = [ self.waypoint[i] - self.location[i] for i in range(3) ]
+		dist = math.sqrt( sum(x*x for x in d) )
+		step = self.speed * dt
+		if dist <= step:
+			self.location = list( self.waypoint )
+			self.waypoint = self.random_waypoint()
+		else:
+			self.location = [ self.location[i] + d[i] / dist * step for i in range(3) ]
+
+		if now >= self._next_camera:
+			self._next_camera = now + 1.0 / CAMERA_RATE
+			self.stats['camera_frames'] += 1
+			self.send( b'\x00' + struct.pack('<ffffff', *(self.location + self.waypoint)) )
+
+		if self._next_click and now >= self._next_click:
+			self._next_click = now + self.random.expovariate( self.click_rate )
+			if self.clickable:
+				code, user, ob = self.clickable[ self.random.choice( sorted(self.clickable) ) ]
+				self.stats['clicks'] += 1
+				self.send( code.encode('latin-1') + struct.pack('<II', user, ob) )
+
+	def get_stats(self, end):
+		'''
+		rates are over the time this client was connected
+		'''
+		duration = (self.closed_at or end) - self._stream_started if self._stream_started else 0.0
+		s = dict( self.stats )
+		gaps = s.pop( 'frame_gaps_ms' )
+		mesh = s.pop( 'mesh_ms' )
+		s['index'] = self.index
+		s['closed'] = self.closed
+		s['seconds'] = duration
+		s['error'] = self.error
+		s['frames_per_second'] = s['frames'] / duration if duration else 0.0
+		s['frame_gap_ms_p50'] = percentile( gaps, 50 )
+		s['frame_gap_ms_p95'] = percentile( gaps, 95 )
+		s['frame_gap_ms_p99'] = percentile( gaps, 99 )
+		s['mesh_ms_p50'] = percentile( mesh, 50 )
+		s['mesh_ms_p95'] = percentile( mesh, 95 )
+		s['mesh_ms'] = [ round(x, 2) for x in mesh ]
+		s['kbytes_per_second'] = s['wire_bytes'] / 1024.0 / duration if duration else 0.0
+		return s
+
+
+def run_clients( config ):
+	'''
+	runs the clients of one process for config['duration'] seconds, returns their stats.
+	clients connect one at a time spread over config['ramp'] seconds.
+	'''
+	indices = config['indices']
+	clients = [ SyntheticClient(
+		i, config['host'], config['port'], config['path'], config['deflate'],
+		config['area'], config['height'], config['speed'], config['click_rate'], config['seed'] + i,
+	) for i in indices ]
+	start = time.time()
+	ramp = config['ramp']
+	connect_at = [ start + ramp * n / max(1, len(clients)) for n in range(len(clients)) ]
+	end = start + ramp + config['duration']
+	waiting = list( zip(connect_at, clients) )
+	active = []
+	while time.time() < end:
+		now = time.time()
+		while waiting and waiting[0][0] <= now:
+			c = waiting.pop(0)[1]
+			try:
+				c.connect()
+				active.append( c )
+			except (IOError, socket.error) as err:
+				c.error = 'connect: %s' %err
+				c.closed = True
+		active = [ c for c in active if not c.closed ]
+		if active:
+			readable = select.select( active, [], [], 0.01 )[0]
+			for c in readable: c.on_readable()
+			now = time.time()
+			for c in active:
+				if not c.closed: c.update( now )
+		else: time.sleep( 0.01 )
+	now = time.time()
+	results = [ c.get_stats(now) for c in clients ]
+	for c in clients: c.close()
+	return results
+
+
+class ServerMonitor(object):
+	'''
+	samples /stats and the cpu time of the server process (from /proc) every interval seconds
+	'''
+	def __init__(self, host, port, pid=None):
+		self.host = host
+		self.port = port
+		self.pid = pid
+		self.samples = []
+		self.last_stats = None
+		self.clock_ticks = os.sysconf( 'SC_CLK_TCK' ) if hasattr( os, 'sysconf' ) else 100
+
+	def get_cpu_time(self):
+		if not self.pid: return None
+		try:
+			with open( '/proc/%s/stat' %self.pid ) as f: fields = f.read().rsplit(')', 1)[-1].split()
+		except IOError: return None
+		return ( int(fields[11]) + int(fields[12]) ) / float( self.clock_ticks )  ## utime + stime
+
+	def get_stats(self):
+		try:
+			conn = http.client.HTTPConnection( self.host, self.port, timeout=5.0 )
+			conn.request( 'GET', '/stats' )
+			r = conn.getresponse()
+			data = r.read()
+			conn.close()
+			if r.status != 200: return None
+			return json.loads( data.decode('utf-8') )
+		except (http.client.HTTPException, socket.error, ValueError):
+			return None
+
+	def wait(self, timeout):
+		end = time.time() + timeout
+		while time.time() < end:
+			if self.get_stats() is not None: return True
+			time.sleep( 0.5 )
+		return False
+
+	def sample(self):
+		stats = self.get_stats()
+		if stats: self.last_stats = stats
+		tick = stats.get('world', {}).get('tick') if stats else None
+		self.samples.append( {'time':time.time(), 'cpu':self.get_cpu_time(), 'tick':tick} )
+
+	def get_summary(self, start, end):
+		s = [ x for x in self.samples if start <= x['time'] <= end + 1.0 ]
+		summary = {'server_cpu_percent':None, 'server_cpu_ms_per_tick':None, 'server_ticks_per_second':None}
+		if len(s) < 2: return summary
+		a, b = s[0], s[-1]
+		dt = b['time'] - a['time']
+		if a['cpu'] is not None and b['cpu'] is not None and dt:
+			summary['server_cpu_percent'] = (b['cpu'] - a['cpu']) / dt * 100.0
+		if a['tick'] is not None and b['tick'] is not None and b['tick'] > a['tick']:
+			summary['server_ticks_per_second'] = (b['tick'] - a['tick']) / dt
+			if a['cpu'] is not None and b['cpu'] is not None:
+				summary['server_cpu_ms_per_tick'] = (b['cpu'] - a['cpu']) * 1000.0 / (b['tick'] - a['tick'])
+		return summary
+
+
+def summarize( clients ):
+	def values( key ): return [ c[key] for c in clients if c[key] is not None ]
+	gaps = values( 'frame_gap_ms_p95' )
+	mesh = [ x for c in clients for x in c['mesh_ms'] ]
+	n = float( len(clients) or 1 )
+	return {
+		'clients':len(clients),
+		'disconnected':len( [c for c in clients if c['closed']] ),
+		'frames_per_second':sum( values('frames_per_second') ) / n,
+		'frame_gap_ms_p95':percentile( gaps, 50 ),  ## the typical client's p95
+		'connect_ms_p50':percentile( values('connect_ms'), 50 ),
+		'connect_ms_p95':percentile( values('connect_ms'), 95 ),
+		'first_frame_ms_p95':percentile( values('first_frame_ms'), 95 ),
+		'mesh_ms_p50':percentile( mesh, 50 ),
+		'mesh_ms_p95':percentile( mesh, 95 ),
+		'meshes_received':sum( values('meshes_received') ),
+		'kbytes_per_client_per_second':sum( values('kbytes_per_second') ) / n,
+		'total_kbytes_per_second':sum( values('kbytes_per_second') ),
+		'clicks':sum( values('clicks') ),
+	}
+
+def get_environment():
+	env = {'python':platform.python_version(), 'platform':platform.platform(), 'cpus':multiprocessing.cpu_count()}
+	try:
+		env['git'] = subprocess.check_output(
+			['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT,
+		).decode('ascii').strip()
+	except (OSError, subprocess.CalledProcessError):
+		env['git'] = None
+	return env
+
+def compare( report, baseline, threshold=10.0 ):
+	'''
+	returns (lines, regressions), a metric regressed if it got worse by more than threshold percent
+	'''
+	lines = []; regressions = []
+	a = baseline['summary']; b = report['summary']
+	for key, higher_is_better in COMPARE_METRICS:
+		old = a.get( key ); new = b.get( key )
+		if old is None or new is None:
+			lines.append( '%-32s %12s %12s' %(key, '-' if old is None else round(old, 2), '-' if new is None else round(new, 2)) )
+			continue
+		change = (new - old) / float(old) * 100.0 if old else (0.0 if new == old else 100.0)
+		worse = False
+		if higher_is_better is not None:
+			worse = (change < -threshold) if higher_is_better else (change > threshold)
+			if key == 'disconnected': worse = new > old
+		if worse: regressions.append( key )
+		lines.append( '%-32s %12.2f %12.2f %+8.1f%% %s' %(key, old, new, change, 'REGRESSION' if worse else '') )
+	return lines, regressions
+
+def run( config ):
+	monitor = ServerMonitor( config['host'], config['port'], config['pid'] )
+	if not monitor.wait( config['wait'] ):
+		raise IOError( 'server at %s:%s is not answering /stats' %(config['host'], config['port']) )
+
+	shares = []
+	for p in range( config['processes'] ):
+		c = dict( config ); c['indices'] = list( range(p, config['clients'], config['processes']) )
+		if c['indices']: shares.append( c )
+	pool = multiprocessing.Pool( len(shares) )
+	async_result = pool.map_async( run_clients, shares )
+
+	start = time.time()
+	measure_start = start + config['ramp']
+	while not async_result.ready():
+		monitor.sample()
+		async_result.wait( config['sample'] )
+	monitor.sample()
+	end = time.time()
+	clients = sorted( [ c for share in async_result.get() for c in share ], key=lambda c: c['index'] )
+	pool.close()
+
+	summary = summarize( clients )
+	summary.update( monitor.get_summary(measure_start, end) )
+	return {
+		'version':REPORT_VERSION,
+		'time':time.strftime( '%Y-%m-%d %H:%M:%S' ),
+		'config':dict( (k,v) for k,v in config.items() if k != 'indices' ),
+		'environment':get_environment(),
+		'summary':summary,
+		'server':{'samples':monitor.samples, 'stats':monitor.last_stats},
+		'clients':clients,
+	}
+
+def print_summary( report ):
+	for key, value in sorted( report['summary'].items() ):
+		if isinstance( value, float ): value = round( value, 2 )
+		print( '%-32s %s' %(key, value) )
+
+
+DEFAULTS = {
+	'host':'localhost', 'port':8080, 'path':'', 'pid':None, 'clients':10, 'duration':30.0, 'ramp':5.0,
+	'processes':1, 'area':100.0, 'height':2.0, 'speed':5.0, 'click_rate':0.0, 'deflate':False,
+	'sample':1.0, 'wait':30.0, 'seed':0, 'report':None, 'compare':None, 'threshold':10.0,
+}
+
+def parse_args( argv ):
+	config = dict( DEFAULTS )
+	for arg in argv:
+		if not arg.startswith('--'): continue
+		key, _, value = arg[2:].partition('=')
+		key = key.replace('-', '_')
+		if key not in config: raise SystemExit( 'unknown option --%s' %key )
+		default = DEFAULTS[ key ]
+		if isinstance( default, bool ): config[ key ] = value in ('', '1', 'true', 'True')
+		elif isinstance( default, int ) or key == 'pid': config[ key ] = int( value )
+		elif isinstance( default, float ): config[ key ] = float( value )
+		else: config[ key ] = value
+	return config
+
+
+if __name__ == '__main__':
+	config = parse_args( sys.argv[1:] )
+	report = run( config )
+	print_summary( report )
+	if config['report']:
+		with open( config['report'], 'w' ) as f: json.dump( report, f, indent=1, sort_keys=True )
+		print( 'report written to', config['report'] )
+	if config['compare']:
+		with open( config['compare'] ) as f: baseline = json.load( f )
+		lines, regressions = compare( report, baseline, config['threshold'] )
+		print( '%-32s %12s %12s' %('metric', 'baseline', 'now') )
+		for line in lines: print( line )
+		if regressions: sys.exit( 1 )
@@ -23,9 +23,13 @@ class Bender(object):
 	def __init__(self):
 		self.dbs = collections.OrderedDict()
 
-	def load_blend(self, path):
-		bf = import_blend.load( path )
-		rna_db = rna.RNA_Database( bf.database )
+	def load_blend(self, path, lazy=False):
+		'''
+		lazy mode memory maps the file and only decodes what is accessed,
+		use it to quickly inspect large .blend files.
+		'''
+		bf = import_blend.load( path, lazy=lazy )
+		rna_db = rna.RNA_Database( bf.database, blenderfile=bf )
 		self.dbs[path] = rna_db
 		return rna_db
 
@@ -8,9 +8,11 @@ and converts the data into simple Python objects.
 
 '''
 
-import os, sys
+import os, sys, mmap
 import struct
 import collections
+try: import numpy
+except ImportError: numpy = None  ## only required for BlenderFile.get_array
 
 DEBUG = '--debug' in sys.argv
 
@@ -115,6 +117,24 @@ class Block(object):
 			## read raw bytes ##
 			self.data = file.read( self.size )
 
+	@classmethod
+	def from_buffer(cls, view, offset, block_format_struct):
+		'''
+		only the header is unpacked, block.data is a memoryview slice of the mmap (no copy)
+		'''
+		block = cls.__new__( cls )
+		a = block_format_struct.unpack_from( view, offset )
+		block.code = bytes(a[0]).decode().split('\0')[0]
+		block.size = block.address = block.sdna_index = block.count = block.offset = block.data = None
+		if block.code != 'ENDB':
+			block.size = a[1]
+			block.address = a[2]
+			block.sdna_index = a[3]
+			block.count = a[4]
+			block.offset = offset + block_format_struct.size
+			block.data = view[ block.offset : block.offset + block.size ]
+		return block
+
 	def debug(self):
 		for n in 'code size address sdna_index count offset'.split():
 			print('%s = %s'%(n, getattr(self,n)))
@@ -166,7 +186,7 @@ class BlenderFile(object):
 			for i in range(x):
 				r.append( [] )
 				for j in range(y):
-					v = a[ i*j ]
+					v = a[ i*y + j ]
 					r[-1].append( v )
 			return r
 
@@ -177,11 +197,15 @@ class BlenderFile(object):
 			raise NotImplemented
 
 
-	def __init__(self, file, lazy_attributes=False):
+	def __init__(self, file, lazy_attributes=False, lazy=False):
 		'''
 		loading with lazy_attributes is faster if you only want
 		to read minimal data from a .blend
+
+		lazy mode memory maps the file and only indexes the block headers,
+		objects are created when first looked up, and their fields are decoded on attribute access.
 		'''
+		self.lazy = lazy
 		self._unpack_cache = {}		# format : struct.Struct
 		self.header = Header( file )
 		if self.header.endianess == 'LITTLE':
@@ -202,76 +226,61 @@ class BlenderFile(object):
 		self.blocks = []
 		self.SDNA = None
 
-		block = Block(file, self.header.block_format_struct)
+		if lazy:
+			self._mmap = mmap.mmap( file.fileno(), 0, access=mmap.ACCESS_READ )
+			self._view = memoryview( self._mmap )
+			offset = file.tell()
+			block = Block.from_buffer( self._view, offset, self.header.block_format_struct )
+		else:
+			block = Block(file, self.header.block_format_struct)
+
 		while block.code != 'ENDB':
 			if block.code == 'DNA1':
 				self.SDNA = SDNA(block, self)
 			else:
 				self.blocks.append( block )
-			block.debug()
-			print('-'*80)
-			block = Block( file, self.header.block_format_struct)
+			if DEBUG:
+				block.debug()
+				print('-'*80)
+			if lazy:
+				offset = block.offset + block.size
+				block = Block.from_buffer( self._view, offset, self.header.block_format_struct )
+			else:
+				block = Block( file, self.header.block_format_struct)
 
-		print('num blocks', len(self.blocks))
+		if DEBUG: print('num blocks', len(self.blocks))
 		assert self.SDNA
 
 		self.objects = {}  # address : object
-		types = {}
-
-		## TODO FIXME - for some reason too much or too little bytes are unpacked
-		## this might be caused by *void being read as zero bytes
 		self.invalid_objects = []
+		self.blocks_by_address = {}  # address : block
+		for block in self.blocks:
+			assert block.address not in self.blocks_by_address
+			self.blocks_by_address[ block.address ] = block
+
+		if lazy:
+			addresses = {}  # type name : [ addresses ]
+			for block in self.blocks:
+				proto = self.SDNA.prototypes[ block.sdna_index ]
+				if (block.size == proto.size and block.count == 1) or (block.size < proto.size and proto.name == 'Link'):
+					if proto.name not in addresses: addresses[ proto.name ] = []
+					addresses[ proto.name ].append( block.address )
+			self.database = LazyDatabase( self, addresses )
+			return
+
+		types = {}
 
 		for block in self.blocks:
 			proto = self.SDNA.prototypes[ block.sdna_index ]
 			assert block.address not in self.objects
-			size = len(block.data)
-
-			if size == proto.size and block.count==1:  ## normal struct
-				ob = proto( block.data )
-				self.objects[ block.address ] = ob
-				if proto.name not in types: types[ proto.name ] = []
-				types[proto.name].append(ob)
-
-			elif size > proto.size:  ## if size is larger than the typedef, then it is an array of struct
-				items = []
-				num = int(size / proto.size)
-				if num != block.count:
-					## this only happens with 4 blocks in the default scene,
-					## blocks: REND, TEST, and two DATA blocks
-					## they all have an sdna_index of zero, so thats probably wrong as well.
-					print('WARN: block array count != len(bytes)/proto.size')
-					print('size/proto.size = %s | block.count = %s' %(num,block.count))
-					num = int(block.count)
-
-				for i in range( num ):
-					a = i * proto.size
-					b = a + proto.size
-					o = proto( block.data[a:b] )
-					items.append( o )
-				self.objects[ block.address ] = tuple( items )
-
-			elif size < proto.size and proto.name == 'Link':
-				## a Link struct is a special case where the block size be less than the sdna struct size,
-				## this must mean that the "next" pointer is null, as a quick fix we just pad the data
-				## with null bytes.
-				#print('LINK HACK!', block.count)
-				diff = proto.size - size
-				ob = proto( block.data+(NULL_CHAR*diff) )
-				self.objects[ block.address ] = ob
+			ob = self.objects[ block.address ] = self._create_object( block )
+			if type(ob) is not tuple:
 				if proto.name not in types: types[ proto.name ] = []
 				types[proto.name].append(ob)
 
-			else:
-				#self.invalid_objects.append( block )
-				#self.objects[ block.address ] = 'INVALID(required-size=%s, size=%s)'%(proto.size,size)
-				print( proto.name )
-				raise RuntimeError
-
-
 		for name in types:
 			items = types[name]
-			print(name, len(items))
+			if DEBUG: print(name, len(items))
 			if not lazy_attributes:
 				for ob in items:
 					with ob:
@@ -284,6 +293,124 @@ class BlenderFile(object):
 			print('ERROR: invalid blocks or dna-structures: %s' %len(self.invalid_objects))
 			raise RuntimeError
 
+	def _create_object(self, block):
+		proto = self.SDNA.prototypes[ block.sdna_index ]
+		size = block.size
+
+		if size == proto.size and block.count==1:  ## normal struct
+			return proto( block.data )
+
+		elif size > proto.size:  ## if size is larger than the typedef, then it is an array of struct
+			num = int(size / proto.size)
+			if num != block.count:
+				## this only happens with 4 blocks in the default scene,
+				## blocks: REND, TEST, and two DATA blocks
+				## they all have an sdna_index of zero, so thats probably wrong as well.
+				if DEBUG:
+					print('WARN: block array count != len(bytes)/proto.size')
+					print('size/proto.size = %s | block.count = %s' %(num,block.count))
+				num = int(block.count)
+
+			if self.lazy:
+				return StructArray( proto, block.data, num )
+			items = []
+			for i in range( num ):
+				a = i * proto.size
+				b = a + proto.size
+				o = proto( block.data[a:b] )
+				items.append( o )
+			return tuple( items )
+
+		elif size < proto.size and proto.name == 'Link':
+			## a Link struct is a special case where the block size be less than the sdna struct size,
+			## this must mean that the "next" pointer is null, as a quick fix we just pad the data
+			## with null bytes.
+			diff = proto.size - size
+			return proto( bytes(block.data)+(NULL_CHAR*diff) )
+
+		else:
+			print( proto.name )
+			raise RuntimeError
+
+	def get_array(self, address):
+		'''
+		returns the block at the old memory address as a numpy structured array,
+		this is a view of the block data (no copy), and read only in lazy mode.
+		'''
+		assert numpy
+		block = self.blocks_by_address.get( address )
+		if block is None: return None
+		proto = self.SDNA.prototypes[ block.sdna_index ]
+		count = min( block.count, block.size // proto.size )
+		return numpy.frombuffer( block.data, dtype=proto.get_dtype(), count=count )
+
+	def get_object(self, address):
+		'''
+		returns the object (or tuple/StructArray for arrays of struct) at the old memory address,
+		in lazy mode the object is created on first lookup.
+		'''
+		ob = self.objects.get( address )
+		if ob is None and self.lazy:
+			block = self.blocks_by_address.get( address )
+			if block is not None:
+				ob = self.objects[ address ] = self._create_object( block )
+		return ob
+
+
+class LazyDatabase(dict):
+	'''
+	type name : list of objects, the objects of a type are created on first access
+	'''
+	def __init__(self, blenderfile, addresses):
+		dict.__init__(self, [(name,None) for name in addresses])
+		self._blenderfile = blenderfile
+		self._addresses = addresses
+
+	def __getitem__(self, name):
+		items = dict.__getitem__(self, name)
+		if items is None:
+			items = [ self._blenderfile.get_object(address) for address in self._addresses[name] ]
+			dict.__setitem__(self, name, items)
+		return items
+
+	def get(self, name, default=None):
+		if name in self: return self[ name ]
+		return default
+
+	def values(self): return [ self[name] for name in self ]
+
+	def items(self): return [ (name,self[name]) for name in self ]
+
+
+class StructArray(object):
+	'''
+	lazy array of struct for lazy mode, acts like the tuple returned in normal mode,
+	items are created on access from memoryview slices of the block.
+	'''
+	def __init__(self, proto, data, count):
+		self.proto = proto
+		self.data = data  ## memoryview of the block
+		self.count = count
+		self._items = {}
+
+	def __len__(self): return self.count
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return tuple( self[i] for i in range(*index.indices(self.count)) )
+		if index < 0: index += self.count
+		if not 0 <= index < self.count: raise IndexError(index)
+		if index not in self._items:
+			a = index * self.proto.size
+			self._items[ index ] = self.proto( self.data[ a : a+self.proto.size ] )
+		return self._items[ index ]
+
+	def __iter__(self):
+		for i in range(self.count): yield self[ i ]
+
+	def __repr__(self):
+		return '<StructArray %s[%s]>' %(self.proto.name, self.count)
+
 
 class Object(object):
 	def __init__(self, dna, data):
@@ -345,6 +472,12 @@ class Object(object):
 	def __dir__(self):
 		return list(self.__dna.fields.keys())
 
+	def get_address(self, name):
+		'''
+		returns the old memory address of a pointer field, see BlenderFile.get_array
+		'''
+		return self.__dna.get_address(self.__data, name)
+
 	def __getitem__(self, key):
 		return getattr(self, key)
 
@@ -372,6 +505,62 @@ class DNA_Struct(object):
 		self.fields = fields
 		self.blenderfile = blenderfile
 		self.size = size  ## total size of all fields - for debugging
+		self.layout = {}  ## field name : compiled struct.Struct
+		self.compile()
+		self._dtype = None
+
+	def compile(self):
+		'''
+		precompile the struct.Struct used to unpack each field
+		'''
+		bf = self.blenderfile
+		for name in self.fields:
+			dna = self.fields[ name ]
+			if dna.is_method: continue
+			elif dna.is_pointer: s = bf._pointer_struct
+			elif dna.type in bf.UNPACK_CODES:
+				fmt = bf._endian + str(dna.array_length) + bf.UNPACK_CODES[ dna.type ]
+				if fmt not in bf._unpack_cache: bf._unpack_cache[ fmt ] = struct.Struct( fmt )
+				s = bf._unpack_cache[ fmt ]
+			elif dna.type == 'char':
+				fmt = str(dna.array_length) + 's'
+				if fmt not in bf._unpack_cache: bf._unpack_cache[ fmt ] = struct.Struct( fmt )
+				s = bf._unpack_cache[ fmt ]
+			else: continue
+			self.layout[ name ] = s
+
+	NUMPY_CODES = { 'H':'u2', 'h':'i2', 'I':'u4', 'i':'i4', 'Q':'u8', 'q':'i8', 'f':'f4' }
+	def get_dtype(self):
+		'''
+		numpy structured dtype generated from the SDNA field offsets,
+		pointers are unsigned ints, char arrays are bytes and nested structs are nested dtypes.
+		'''
+		if self._dtype is None:
+			bf = self.blenderfile
+			names = []; formats = []; offsets = []
+			for name in self.fields:
+				dna = self.fields[ name ]
+				shape = tuple( dna.dimensions )
+				if dna.is_pointer or dna.is_method:
+					fmt = bf._endian + 'u%s' %bf.header.pointer_size
+				elif dna.type in bf.UNPACK_CODES:
+					fmt = bf._endian + self.NUMPY_CODES[ bf.UNPACK_CODES[dna.type] ]
+				elif dna.type == 'char':
+					fmt = 'S%s' %dna.array_length
+					shape = ()
+				elif dna.type in bf.SDNA.structures:
+					fmt = bf.SDNA.structures[ dna.type ].get_dtype()
+				else: continue
+				names.append( name )
+				formats.append( (fmt, shape) if shape else fmt )
+				offsets.append( dna.offset )
+			self._dtype = numpy.dtype({'names':names, 'formats':formats, 'offsets':offsets, 'itemsize':self.size})
+		return self._dtype
+
+	def get_address(self, data, name):
+		dna = self.fields[ name ]
+		assert dna.is_pointer
+		return self.layout[ name ].unpack_from( data, dna.offset )[0]
 
 	def get(self, data, name):
 		assert name in self.fields
@@ -389,28 +578,24 @@ class DNA_Struct(object):
 		if dna.is_method:
 			pass
 		elif dna.is_pointer and not dna.is_method:
-			ptr = self.blenderfile.unpack_pointer(data,offset)  ## special case for pointer
+			ptr = self.layout[ name ].unpack_from(data, offset)[0]  ## special case for pointer
 			if not ptr:
 				return None
-			elif ptr not in self.blenderfile.objects:  ## TODO fixme
-				#print('ERROR invalid pointer', name, ptr)
-				#raise RuntimeError
-				## this might be an index into a pointer?
-				return None
-			else:
-				return self.blenderfile.objects[ ptr ]
+			## TODO fixme - invalid pointers return None, this might be an index into a pointer?
+			return self.blenderfile.get_object( ptr )
 
 		elif dna.type in self.blenderfile.UNPACK_CODES:
-			return self.blenderfile.unpack(
-				dna.type, 
-				data, 
-				offset,
-				array=dna.array_length,
-				dimensions=dna.dimensions)
+			a = self.layout[ name ].unpack_from( data, offset )
+			if dna.array_length == 1:
+				return a[0]
+			elif len(dna.dimensions) == 2:
+				x,y = dna.dimensions
+				return [ list(a[i*y : (i+1)*y]) for i in range(x) ]
+			else:
+				return list( a )
 
 		elif dna.type == 'char':
-			s = struct.Struct(str(dna.array_length)+'s')
-			a = s.unpack_from(data, offset)[0]
+			a = self.layout[ name ].unpack_from(data, offset)[0]
 			return a.split(NULL_CHAR)[0].decode("iso-8859-1")
 
 		elif dna.type in self.blenderfile.SDNA.structures:
@@ -583,9 +768,9 @@ class SDNA(object):
 
 
 ## API ##
-def load(path):
+def load(path, lazy=False):
 	file = open( os.path.expanduser(path), 'rb')
-	return BlenderFile( file )
+	return BlenderFile( file, lazy=lazy )
 
 
 
@@ -6,7 +6,8 @@ class RNA_Database(object):
 	'''
 	similar to Blender's bpy.data API
 	'''
-	def __init__(self, dna_db):
+	def __init__(self, dna_db, blenderfile=None):
+		self.blenderfile = blenderfile
 		self.objects = {}
 		self.meshes = {}
 		self.cameras = {}
@@ -68,3 +69,17 @@ class RNA_Database(object):
 			#if link and link.next:
 			#	mesh.materials[ link.next.name ] = link.next
 
+	MESH_ARRAYS = { 'vertices':'mvert', 'edges':'medge', 'loops':'mloop', 'polygons':'mpoly' }
+	def get_mesh_arrays(self, mesh):
+		'''
+		returns a dict of numpy structured arrays for the mesh (requires numpy),
+		these are views of the .blend data, example:
+			vertices['co'] is a (N,3) float32 array
+			loops['v'] are the vertex indices (uint32 as in the SDNA)
+		'''
+		assert self.blenderfile
+		arrays = {}
+		for name in self.MESH_ARRAYS:
+			address = mesh.get_address( self.MESH_ARRAYS[name] )
+			if address: arrays[ name ] = self.blenderfile.get_array( address )
+		return arrays
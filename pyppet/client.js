@@ -95,6 +95,7 @@ var UserAPI = {
 	position_tweens : {},  // object : tween
 	scale_tweens : {},
 	rotation_tweens : {},
+	pending_parents : {}, // object name : parent UID (or -1 for the camera)
 	camera_controllers : {},
 	camera : null,
 	objects : Objects,
@@ -107,11 +108,33 @@ var UserAPI = {
 	skybox_cubemap : null,
 
 	start_object_stream : function() {
+		UserAPI.streaming = true; // asked for again after a zone handoff
 		ws.send_string(
 			JSON.stringify({request : "start_object_stream"})
 		);
 		ws.flush();
 	},
+	request_zone : function( name ) {
+		// the server answers with UserAPI.switch_zone if there is a zone router that knows the zone //
+		UserAPI.send_message( {request:"zone", name:name} );
+	},
+	switch_zone : function( host, port, path, token ) {
+		// another server instance serves the zone, the objects are dropped but the mesh cache is kept //
+		console.log('switching to zone:'+path+' at '+host+':'+port);
+		for (var name in Objects) {
+			var o = Objects[ name ];
+			if (o.parent) { o.parent.remove( o ); }
+			delete Objects[ name ];
+		}
+		UserAPI.pending_parents = {};
+		UserAPI.pending_geometry = {};
+		UserAPI.handoff_token = token;
+		HOST = host;
+		HOST_PORT = port;
+		WEBSOCKET_PATH = path;
+		ws.close();
+		UserAPI.create_websocket();
+	},
 	on_draw_html_link : function( line, params ) {
 		var p = clone( params );
 		p.scale *= 0.5;
@@ -323,6 +346,35 @@ var UserAPI = {
 		);
 	},
 
+	resolve_parent : function(name) {
+		var o = UserAPI.objects[ name ];
+		var parent = UserAPI.pending_parents[ name ];
+		if (parent == -1) {
+			UserAPI.camera.add( o );
+			delete UserAPI.pending_parents[ name ];
+		} else {
+			var pid = '__'+parent+'__';
+			if (pid in UserAPI.objects) {
+				UserAPI.objects[ pid ].add( o );
+				delete UserAPI.pending_parents[ name ];
+			} else {
+				console.log( 'waiting for parent: '+parent );
+			}
+		}
+	},
+	on_stream_records : function(code, records) {
+		// binary transform records, see api_gen.py TRANSFORM_STREAM //
+		if (code != 't') { return; }
+		for (var i=0; i<records.length; i++) {
+			var rec = records[ i ];
+			var name = '__'+rec.UID+'__';
+			var o = UserAPI.objects[ name ];
+			if (o === undefined) { continue; }
+			if (rec.pos) { tween_position( o, name, rec.pos ); }
+			if (rec.scl) { tween_scale( o, name, rec.scl ); }
+			if (rec.rot) { tween_rotation( o, name, rec.rot ); }
+		}
+	},
 	get_object_by_id : function(id) {
 		return Objects['__'+id+'__'];
 	},
@@ -510,27 +562,110 @@ var UserAPI = {
 		mesh.active_material = mat;
 		return mat;
 	},
+	pending_geometry : {}, // UID : chunked geometry being received, see mesh_stream.py
+	load_geometry : function(header, name) {
+		// packed geometry is shared by all players, the json only has the header (geometry_cache.py) //
+		if (header.chunked) {
+			// the buffer follows in binary chunk frames, see on_geometry_chunks //
+			UserAPI.pending_geometry[ header.uid ] = {
+				header:header, name:name, received:0,
+				bytes:new Uint8Array( header.bytes )
+			};
+			if (header.bytes == 0) { UserAPI.on_geometry_chunks( [] ); }
+			return;
+		}
+		var xhr = new XMLHttpRequest();
+		xhr.open( 'GET', header.url, true );
+		xhr.responseType = 'arraybuffer';
+		xhr.onload = function() {
+			if (xhr.status != 200) {
+				console.log('failed to load geometry', header.url);
+				return;
+			}
+			UserAPI.on_geometry_loaded( header, name, xhr.response );
+		};
+		xhr.send();
+	},
+	on_geometry_chunks : function(bytes) {
+		// chunk records: UID (uint16), byte offset (uint32), length (uint32), then the data //
+		var data = new Uint8Array( bytes );
+		var view = new DataView( data.buffer );
+		var offset = 1; // skip format code
+		while (offset < view.byteLength) {
+			var uid = view.getUint16(offset, true);
+			var start = view.getUint32(offset+2, true);
+			var length = view.getUint32(offset+6, true);
+			offset += 10;
+			var p = UserAPI.pending_geometry[ uid ];
+			if (p !== undefined) {
+				p.bytes.set( data.subarray(offset, offset+length), start );
+				p.received += length;
+			}
+			offset += length;
+		}
+		for (var uid in UserAPI.pending_geometry) {
+			var p = UserAPI.pending_geometry[ uid ];
+			if (p.received >= p.header.bytes) {
+				delete UserAPI.pending_geometry[ uid ];
+				UserAPI.on_geometry_loaded( p.header, p.name, p.bytes.buffer );
+			}
+		}
+	},
+	on_geometry_loaded : function(header, name, buffer) {
+		var o = UserAPI.objects[ name ];
+		if (o === undefined) {
+			console.log('geometry loaded for missing object', name);
+			return;
+		}
+		var mesh = UserAPI.create_geometry( UserAPI.unpack_geometry(header, buffer), name ); // TODO check model_config
+		o.add( mesh );
+		o.meshes.push( mesh );
+		if (o.pending_material) {
+			UserAPI.set_material( mesh, o.pending_material );
+			delete o.pending_material;
+		}
+	},
+	unpack_geometry : function(header, buffer) {
+		if (header.codec == 'quantized') { // see geometry_codec.py
+			return _geometry_decoder_( header, buffer );
+		}
+		var pak = {triangles:[], quads:[], vertices:[], lines:[]};
+		for (var key in header) {
+			pak[ key ] = header[ key ];
+		}
+		for (var i=0; i < header.layout.length; i ++) {
+			var l = header.layout[i]; // name, array type, byte offset, length
+			if (l[1] == 'Float32Array') {
+				pak[ l[0] ] = new Float32Array( buffer, l[2], l[3] );
+			} else {
+				pak[ l[0] ] = new Uint32Array( buffer, l[2], l[3] );
+			}
+		}
+		return pak;
+	},
 	create_geometry : function(pak, name) {
 		//console.log('creating new geometry');
 
 		var geometry = new THREE.Geometry();
 
-		for ( var i = 0; i < pak.vertices.length; i ++ ) {
-			var x = pak.vertices[i][0];
-			var y = pak.vertices[i][1];
-			var z = pak.vertices[i][2];
+		// pak is from unpack_geometry, all arrays are flat typed arrays //
+		var colors = pak.colors;
+		for ( var i = 0; i < pak.vertices.length; i += 3 ) {
+			var x = pak.vertices[i];
+			var y = pak.vertices[i+1];
+			var z = pak.vertices[i+2];
 			var vec = new THREE.Vector3( x,y,z );
 			geometry.vertices.push(vec);
 		}
-		for ( var i = 0; i < pak.triangles.length; i ++ ) {
-			var f = pak.triangles[i];
-			var face = new THREE.Face3( f[0], f[1], f[2] );
+		for ( var i = 0; i < pak.triangles.length; i += 3 ) {
+			var f = pak.triangles;
+			var face = new THREE.Face3( f[i], f[i+1], f[i+2] );
 
-			if (pak.colors) {
+			if (colors) {
 				for ( var j=0; j<3; j++) {
-					var rgb = pak.colors[ f[j] ];
+					var c = f[i+j] * 3;
 					var clr = new THREE.Color();
-					clr.setRGB( rgb[0], rgb[1], rgb[2] );
+					clr.setRGB( colors[c], colors[c+1], colors[c+2] );
 					face.vertexColors.push( clr );
 
 				}
@@ -538,14 +673,14 @@ var UserAPI = {
 			geometry.faces.push( face );
 
 		}
-		for ( var i = 0; i < pak.quads.length; i ++ ) {
-			var f = pak.quads[i];
-			var face = new THREE.Face4( f[0], f[1], f[2], f[3] );
-			if (pak.colors) {
+		for ( var i = 0; i < pak.quads.length; i += 4 ) {
+			var f = pak.quads;
+			var face = new THREE.Face4( f[i], f[i+1], f[i+2], f[i+3] );
+			if (colors) {
 				for ( var j=0; j<4; j++) {
-					var rgb = pak.colors[ f[j] ];
+					var c = f[i+j] * 3;
 					var clr = new THREE.Color();
-					clr.setRGB( rgb[0], rgb[1], rgb[2] );
+					clr.setRGB( colors[c], colors[c+1], colors[c+2] );
 					face.vertexColors.push( clr );
 
 				}
@@ -562,7 +697,7 @@ var UserAPI = {
 
 		if (pak.subdiv) {
 			var subsurf = new THREE.SubdivisionModifier( pak.subdiv );
-			if (pak.colors) {
+			if (colors) {
 				subsurf.useOldVertexColors = true;  // enable vertex colors
 			}
 			subsurf.modify( geometry );
@@ -599,35 +734,29 @@ var UserAPI = {
 				linewidth: linewidth // note mrdoob - this should have been "lineWidth"
 			} );
 
-			for ( var i = 0; i < pak.lines.length; i ++ ) {
-				var aidx = pak.lines[i][0];
-				var bidx = pak.lines[i][1];
+			for ( var i = 0; i < pak.lines.length; i += 2 ) {
+				var aidx = pak.lines[i] * 3;
+				var bidx = pak.lines[i+1] * 3;
 
-				var x = pak.vertices[aidx][0];
-				var y = pak.vertices[aidx][1];
-				var z = pak.vertices[aidx][2];
+				var x = pak.vertices[aidx];
+				var y = pak.vertices[aidx+1];
+				var z = pak.vertices[aidx+2];
 				var vec = new THREE.Vector3( x,y,z );
 				linegeom.vertices.push(vec);
 
-				var x = pak.vertices[bidx][0];
-				var y = pak.vertices[bidx][1];
-				var z = pak.vertices[bidx][2];
+				var x = pak.vertices[bidx];
+				var y = pak.vertices[bidx+1];
+				var z = pak.vertices[bidx+2];
 				var vec = new THREE.Vector3( x,y,z );
 				linegeom.vertices.push(vec);
 
-				if (pak.colors) {
-					var r = pak.colors[aidx][0];
-					var g = pak.colors[aidx][1];
-					var b = pak.colors[aidx][2];
+				if (colors) {
 					var clr = new THREE.Color();
-					clr.setRGB(r,g,b);
+					clr.setRGB( colors[aidx], colors[aidx+1], colors[aidx+2] );
 					linegeom.colors.push(clr);
 
-					var r = pak.colors[bidx][0];
-					var g = pak.colors[bidx][1];
-					var b = pak.colors[bidx][2];
 					var clr = new THREE.Color();
-					clr.setRGB(r,g,b);
+					clr.setRGB( colors[bidx], colors[bidx+1], colors[bidx+2] );
 					linegeom.colors.push(clr);
 
 				}
@@ -647,10 +776,10 @@ var UserAPI = {
 			var pgeom = new THREE.Geometry();
 
 			for ( var i = 0; i < pak.points.length; i ++ ) {
-				var idx = pak.points[i];
-				var x = pak.vertices[idx][0];
-				var y = pak.vertices[idx][1];
-				var z = pak.vertices[idx][2];
+				var idx = pak.points[i] * 3;
+				var x = pak.vertices[idx];
+				var y = pak.vertices[idx+1];
+				var z = pak.vertices[idx+2];
 				var vec = new THREE.Vector3( x,y,z );
 				pgeom.vertices.push(vec);
 			}
@@ -1169,6 +1298,22 @@ function tween_scale( o, name, scl ) {
 	}
 }
 
+function tween_rotation( o, name, rot ) {
+	if ( name in UserAPI.rotation_tweens == false ) {
+		var tween = new TWEEN.Tween(o.rotation);
+		var vec = new THREE.Vector3(rot[0], rot[1], rot[2]);
+		UserAPI.rotation_tweens[ name ] = {'vector':vec, 'tween':tween};
+		tween.to( vec, 500 );
+		tween.start();
+
+	} else {
+		var tween = UserAPI.rotation_tweens[ name ].tween;
+		var vector = UserAPI.rotation_tweens[ name ].vector;
+		vector.set( rot[0], rot[1], rot[2] );
+		start_tween_if_needed( tween );
+	}
+}
+
 function on_mouse_up( event ) {
 	if ( INTERSECTED ) {
 		var a = UserAPI.objects[ INTERSECTED.name ];
@@ -1737,19 +1882,15 @@ var PreviousMessage = null;
 
 
 function on_binary_message( bytes ) {
-	var buffer = new ArrayBuffer(2);
-	//var intView = new Int32Array(buffer);
-	var view = new Int16Array( buffer );
-	var bytesView = new Uint8Array(buffer);
-	//var floatView = new Float32Array(buffer);
-	bytesView[0] = bytes[0];
-	bytesView[1] = bytes[1];
-	//bytesView[2] = bytes[2];
-	//bytesView[3] = bytes[3];
-	//var arr = Array.apply([], floatView);
-	//camera.position.x = floatView[0];
-	//camera.position.x = view[0] * (1.0/32768.0);
-
+	// first byte is the stream format code, decoders are generated by api_gen.py //
+	var code = String.fromCharCode( bytes[0] );
+	if (code == 'g') { // mesh chunks, see mesh_stream.py
+		UserAPI.on_geometry_chunks( bytes );
+	} else if (code in _stream_decoders_) {
+		UserAPI.on_stream_records( code, _stream_decoders_[ code ]( bytes ) );
+	} else {
+		console.log( 'unknown binary stream format: '+code );
+	}
 }
 
 var _msg;
@@ -1761,6 +1902,11 @@ function on_json_message( data ) {
 	}
 	if (!UserAPI.initialized) {return}
 
+	// children that arrived before their parent //
+	for (var name in UserAPI.pending_parents) {
+		UserAPI.resolve_parent( name );
+	}
+
 	// ensure that all objects have been created //
 	for (var name in msg['meshes']) {
 		var pak = msg['meshes'][ name ];
@@ -1803,24 +1949,15 @@ function on_json_message( data ) {
 		var o = UserAPI.objects[ name ];
 
 		if (o.parent === undefined && pak.parent !== undefined) {
-			if (pak.parent == -1) {
-				UserAPI.camera.add( o );
-			} else {
-				var pid = '__'+pak.parent+'__';
-				if (pid in UserAPI.objects) {
-					//console.log( 'ADDING-> '+pak.parent );
-					UserAPI.objects[ pid ].add( o );
-				} else {
-					console.log( 'waiting for parent: '+pak.parent );
-				}
-			}
-
+			// the parent is only sent once in binary stream mode, so remember it until it can be resolved //
+			UserAPI.pending_parents[ name ] = pak.parent;
+		}
+		if (name in UserAPI.pending_parents) {
+			UserAPI.resolve_parent( name );
 		}
 
 		if (pak.geometry) { // request_mesh response
-			var mesh = UserAPI.create_geometry( pak.geometry, name ); // TODO check model_config
-			UserAPI.objects[ name ].add( mesh );
-			UserAPI.objects[ name ].meshes.push( mesh );
+			UserAPI.load_geometry( pak.geometry, name );
 		}
 
 		if (pak.properties) {
@@ -1859,22 +1996,7 @@ function on_json_message( data ) {
 			//o.rotation.z = pak.rot[2];
 			//o.rotation.setEulerFromQuaternion( pak.quat );
 
-			if ( name in UserAPI.rotation_tweens == false ) {
-				var tween = new TWEEN.Tween(o.rotation);
-				var vec = new THREE.Vector3(pak.rot[0], pak.rot[1], pak.rot[2]);
-				UserAPI.rotation_tweens[ name ] = {'vector':vec, 'tween':tween};
-				tween.to( vec, 500 );
-				tween.start();
-
-			} else {
-				var tween = UserAPI.rotation_tweens[ name ].tween;
-				var vector = UserAPI.rotation_tweens[ name ].vector;
-				vector.set( pak.rot[0], pak.rot[1], pak.rot[2] );
-				//UserAPI.on_interpolate_scale( name, tween, vector );
-				//tween.start();
-				start_tween_if_needed( tween );
-
-			}
+			tween_rotation( o, name, pak.rot );
 
 		}
 
@@ -1894,7 +2016,9 @@ function on_json_message( data ) {
 
 		if (pak.active_material) {
 
-			if (pak.active_material.type != o.meshes[0].material.type) {
+			if (o.meshes.length == 0) { // geometry is still downloading
+				o.pending_material = pak.active_material;
+			} else if (pak.active_material.type != o.meshes[0].material.type) {
 				UserAPI.set_material( o.meshes[0], pak.active_material );
 			} else {
 				UserAPI.update_material( o.meshes[0], pak.active_material );
@@ -3874,18 +3998,24 @@ function on_message(e) {
 }
 
 UserAPI['create_websocket'] = function() {
-	ws = new Websock(); 	// from the websockify API
+	var sock = ws = new Websock(); 	// from the websockify API
 	ws.on('message', on_message);
 
 	function on_open(e) {
 		console.log(">> WebSockets.onopen");
-		window.setInterval( update_player_view, 1000/8.0 );
+		if (UserAPI.handoff_token) { // moved here from another zone, the server takes the player state from the zone router
+			UserAPI.send_message( {request:"handoff", token:UserAPI.handoff_token} );
+			UserAPI.handoff_token = null;
+			if (UserAPI.streaming) { UserAPI.start_object_stream(); }
+		}
+		if (!UserAPI.view_interval) { UserAPI.view_interval = window.setInterval( update_player_view, 1000/8.0 ); }
 
 	}
 	ws.on('open', on_open);
 
 	function on_close(e) {
 		console.log(">> WebSockets.onclose");
+		if (sock !== ws) { return; } // the old socket of a zone handoff
 		UserAPI.compositor.film.uniforms['nIntensity'].value = 0.8;
 	}
 	ws.on('close', on_close);
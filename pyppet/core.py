@@ -45,6 +45,9 @@ import math
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 if SCRIPT_DIR not in sys.path: sys.path.append( SCRIPT_DIR )
 
+import bake_cache
+from bake_cache import BakeCache
+
 PYPPET_LITE = 'pyppet-lite' in sys.argv
 
 
@@ -309,27 +312,35 @@ class BlenderHack( object ):
 	BAKE_BYTES = 0
 	## can only be called from inside the ImageEditor redraw callback ##
 	def bake_image( self, ob, type='AO', size=64, refresh=False, extra_objects=[] ):
+		'''
+		the bake is done once at the largest progressive size of the type (bake_cache.py),
+		the requested size and the smaller ones are encoded from it on the BakeCache worker pool.
+		size and refresh can be strings from the url: /bake/<UID>.jpg?TYPE|SIZE|REFRESH
+		returns the encoded data, or None if the encoding failed or timed out.
+		'''
 		assert type in self.BAKE_MODES
-		width = height = size
-		name = ob.name
-		path_dir = '/tmp/texture-cache'
-		if not os.path.isdir( path_dir ): os.makedirs( path_dir )
-		path = os.path.join(
-			path_dir, 
-			'%s.%s.%s' %(name,size,type),
-		)
+		size = int(size)
+		refresh = refresh in (True, 'True', 'true', '1')
+		key = bake_cache.get_bake_key( ob, type, extra_objects )
 
-		if not refresh and os.path.isfile(path+'.png'):
+		data = None if refresh else BakeCache.get( key, size )
+		if data:
 			print('FAST CACHE RETURN')
+			self.BAKE_BYTES += len(data)
+			return data
 
-		elif refresh or not os.path.isfile(path+'.png'):
+		path, bake_size = BakeCache.find_source( key, size )
+		if refresh or path is None:
 			if not self._image_editor_handle:
 				print('_'*80)
 				print('ERROR: you must open a "UV/Image editor" to bake textures')
 				print('_'*80)
 				return bytes(1)
 
-			print('---------- baking image ->', ob.name)
+			bake_size = max( size, bake_cache.get_max_size(type) )
+			path = BakeCache.get_source_path( key, bake_size )
+			width = height = bake_size
+			print('---------- baking image ->', ob.name, bake_size)
 
 			bpy.ops.object.mode_set( mode='OBJECT' )
 
@@ -361,8 +372,8 @@ class BlenderHack( object ):
 			bpy.ops.object.mode_set( mode='OBJECT' )	# must be in object mode for multires baking
 
 			bpy.context.scene.render.bake_type = type
-			bpy.context.scene.render.bake_margin = 4
-			bpy.context.scene.render.use_bake_normalize = True
+			bpy.context.scene.render.bake_margin = bake_cache.BAKE_SETTINGS['margin']
+			bpy.context.scene.render.use_bake_normalize = bake_cache.BAKE_SETTINGS['normalize']
 			#self.context.scene.render.use_bake_selected_to_active = False	# required
 			bpy.context.scene.render.use_bake_lores_mesh = False		# should be True
 			bpy.context.scene.render.use_bake_multires = False
@@ -376,41 +387,25 @@ class BlenderHack( object ):
 			res = bpy.ops.object.bake_image()
 			print('bpy.ops.object.bake_image', res)
 
-			#img = bpy.data.images[-1]
-			#img.file_format = 'jpg'
-			#img.filepath_raw = '/tmp/%s.jpg' %ob.name
-			#img.save()
 			bpy.ops.image.save_as(
-				filepath = path+'.png',
+				filepath = path,
 				check_existing=False,
 			)
+			BakeCache.bakes += 1
 
-			for ob in restore: ob.select=True
+			for o in restore: o.select=True
 			bpy.context.scene.objects.active = restore_active
 			ob.hide_select = restore_hide_select
 
-			## 128 color PNG can beat JPG by half ##
-			if type == 'DISPLACEMENT':
-				os.system( 'convert "%s.png" -quality 75 -gamma 0.36 "%s.jpg"' %(path,path) )
-				os.system( 'convert "%s.png" -colors 128 -gamma 0.36 "%s.png"' %(path,path) )
-			else:
-				os.system( 'convert "%s.png" -quality 75 "%s.jpg"' %(path,path) )
-				os.system( 'convert "%s.png" -colors 128 "%s.png"' %(path,path) )
-
-		## blender saves png's with high compressision level
-		## for simple textures, the PNG may infact be smaller than the jpeg
-		## check which one is smaller, and send that one, 
-		## Three.js ignores the file extension and loads the data even if a png is called a jpg.
-		pngsize = os.stat( path+'.png' ).st_size
-		jpgsize = os.stat( path+'.jpg' ).st_size
-		if pngsize < jpgsize:
-			print('sending png data - bytes:', pngsize)
-			self.BAKE_BYTES += pngsize
-			return open( path+'.png', 'rb' ).read()
-		else:
-			print('sending jpg data - bytes:', jpgsize)
-			self.BAKE_BYTES += jpgsize
-			return open( path+'.jpg', 'rb' ).read()
+		## JPEG or 128 color PNG, whichever is smaller, and the mip chain, without blocking on the other sizes ##
+		BakeCache.submit( key, path, size, bake_size, gamma=bake_cache.GAMMA.get(type) )
+		data = BakeCache.get( key, size )
+		if not data:
+			print('ERROR: bake encoding failed', ob.name, type, size)
+			return None
+		print('sending baked data - bytes:', len(data))
+		self.BAKE_BYTES += len(data)
+		return data
 
 
 
@@ -0,0 +1,166 @@
+# Export Cache - content addressed disk cache and job queue for collada exports
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import os, time, hashlib, tempfile, threading, collections, traceback
+from geometry_cache import get_geometry_key
+
+
+class ExportJob(object):
+	def __init__(self, key, name, lowres, ratio):
+		self.key = key
+		self.name = name  ## object name, the object may be removed before the job runs
+		self.lowres = lowres
+		self.ratio = ratio
+		self.prepared = False  ## the LOD proxy step of a lowres export is done
+		self.path = None
+		self.done = threading.Event()
+
+
+class ExportCacheSingleton(object):
+	'''
+	Exports are stored on disk as <key>.dae, the key is a hash of the mesh data, modifier stack,
+	world matrix, materials and LOD options, so a cached file is never stale and survives restarts.
+
+	The blender api is not thread safe, so exports are not done in a thread pool,
+	instead the http threads submit jobs and the main loop runs them between frames with process_jobs.
+	Concurrent requests for the same key share one job.
+
+	note: a single step can not be interrupted, the frame it runs in is as long as that step.
+	A lowres export is split in two (the LOD proxy with preparer, then the collada with exporter)
+	that run on different frames, a hires export is one step.
+	'''
+	MAX_FILES = 512
+
+	def __init__(self, path=None):
+		self.path = path or os.path.join( tempfile.gettempdir(), 'pyppet-export-cache' )
+		self.jobs = {}   # key : ExportJob
+		self.queue = collections.deque()
+		self.lock = threading._allocate_lock()
+		self.exporter = None  ## function( ob, lowres, ratio ) that returns bytes, set by Server.py
+		self.preparer = None  ## function( ob, ratio ) that makes the LOD proxy of a lowres export, set by Server.py
+		self.main_thread = None  ## set on the first call to process_jobs
+		self.fallback_lock = threading._allocate_lock()  ## held when exporting outside of the main loop
+		self.hits = 0
+		self.misses = 0
+
+	def get_key(self, ob, lowres=False, ratio=0.2):
+		h = hashlib.md5()
+		h.update( get_geometry_key(ob).encode('utf-8') )
+		h.update( str([tuple(row) for row in ob.matrix_world]).encode('utf-8') )
+		for mat in ob.data.materials:
+			if mat: h.update( ('%s%s' %(mat.name, tuple(mat.diffuse_color))).encode('utf-8') )
+		if lowres: h.update( ('lowres:%s' %ratio).encode('utf-8') )
+		return h.hexdigest()
+
+	def get_path(self, key):
+		return os.path.join( self.path, '%s.dae' %key )
+
+	def lookup(self, key):
+		path = self.get_path( key )
+		if os.path.isfile( path ): return path
+
+	def submit(self, ob, lowres=False, ratio=0.2, key=None):
+		'''
+		queue an export, returns the pending job or None if the file is already cached
+		'''
+		if key is None: key = self.get_key( ob, lowres, ratio )
+		if self.lookup( key ): return None
+		with self.lock:
+			job = self.jobs.get( key )
+			if job is None:
+				job = self.jobs[ key ] = ExportJob( key, ob.name, lowres, ratio )
+				self.queue.append( job )
+		return job
+
+	def pregenerate(self, ob, ratio=0.2):
+		'''
+		queue lowres and hires exports without waiting for them
+		'''
+		self.submit( ob, lowres=True, ratio=ratio )
+		self.submit( ob, lowres=False )
+
+	def get(self, ob, lowres=False, ratio=0.2, key=None, timeout=60.0):
+		'''
+		returns the path of the cached export, blocks until the main loop has exported it.
+		'''
+		if key is None: key = self.get_key( ob, lowres, ratio )
+		path = self.lookup( key )
+		if path:
+			self.hits += 1
+			return path
+		self.misses += 1
+
+		job = self.submit( ob, lowres, ratio, key=key )
+		if job is None: return self.lookup( key )
+		if self.main_thread is None:  ## nothing is processing the queue, export in this thread
+			with self.fallback_lock: self._run( job )
+		elif self.main_thread == threading.current_thread():
+			self._run( job )
+		elif not job.done.wait( timeout ):
+			print('[export cache] timeout waiting for', job.name)
+		return job.path
+
+	def process_jobs(self, budget=0.02):
+		'''
+		called from the main loop, runs queued export steps until the time budget is used up,
+		the budget is checked between steps (see the class note).
+		'''
+		self.main_thread = threading.current_thread()
+		start = time.time()
+		while self.queue and time.time() - start < budget:
+			job = self.queue.popleft()
+			if job.lowres and not job.prepared and self.preparer:
+				self._prepare( job )
+				with self.lock: self.queue.append( job )  ## exported on a later frame
+			else:
+				self._run( job )
+
+	def _prepare(self, job):
+		import bpy
+		job.prepared = True
+		try:
+			ob = bpy.data.objects.get( job.name )
+			if ob and not self.lookup( job.key ): self.preparer( ob, job.ratio )
+		except Exception:  ## the exporter makes the proxy itself
+			traceback.print_exc()
+
+	def _run(self, job):
+		import bpy
+		if job.done.is_set(): return
+		try:
+			ob = bpy.data.objects.get( job.name )
+			path = self.lookup( job.key )
+			if ob and not path:
+				data = self.exporter( ob, lowres=job.lowres, ratio=job.ratio )
+				path = self._write( job.key, data )
+			job.path = path
+		except Exception:
+			traceback.print_exc()
+		with self.lock:
+			self.jobs.pop( job.key, None )
+			if job in self.queue: self.queue.remove( job )
+		job.done.set()
+
+	def _write(self, key, data):
+		if not os.path.isdir( self.path ): os.makedirs( self.path )
+		path = self.get_path( key )
+		tmp = '%s.%s.tmp' %(path, threading.get_ident())
+		with open( tmp, 'wb' ) as f: f.write( data )
+		os.replace( tmp, path )  ## readers never see a partial file
+		self.prune()
+		return path
+
+	def prune(self):
+		files = [ os.path.join(self.path,n) for n in os.listdir(self.path) if n.endswith('.dae') ]
+		if len(files) <= self.MAX_FILES: return
+		files.sort( key=os.path.getmtime )
+		for path in files[ : len(files) - self.MAX_FILES ]:
+			try: os.remove( path )
+			except OSError: pass
+
+	def get_stats(self):
+		return {'queued':len(self.queue), 'hits':self.hits, 'misses':self.misses}
+
+
+ExportCache = ExportCacheSingleton()
@@ -0,0 +1,213 @@
+# Geometry Cache - server wide cache of packed mesh buffers
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import sys, struct, hashlib, array, threading
+try: import bpy
+except ImportError: bpy = None
+
+
+## name, struct format, items per element (all little endian 4 byte types) ##
+GEOMETRY_LAYOUT = (
+	('vertices',  'f', 3),
+	('colors',    'f', 3),
+	('triangles', 'I', 3),
+	('quads',     'I', 4),
+	('lines',     'I', 2),
+	('points',    'I', 1),
+)
+_layout_js_types = { 'f':'Float32Array', 'I':'Uint32Array' }
+
+def get_mesh_id( mesh ):
+	s = mesh.name
+	if mesh.library: s += mesh.library.filepath
+	return hashlib.md5( s.encode('utf-8') ).hexdigest()
+
+def _hash_foreach( h, collection, attr, typecode, size ):
+	arr = array.array( typecode, [0] ) * (len(collection) * size)
+	if len(arr): collection.foreach_get( attr, arr )
+	h.update( arr.tobytes() )
+
+def get_modifier_hash( ob, h=None ):
+	'''
+	hash of the modifier stack settings, including the names and transforms of target objects
+	'''
+	if h is None: h = hashlib.md5()
+	for mod in ob.modifiers:
+		for prop in mod.bl_rna.properties:
+			if prop.identifier == 'rna_type': continue
+			v = getattr( mod, prop.identifier, None )
+			if prop.type == 'POINTER':
+				if bpy and isinstance( v, bpy.types.Object ):
+					h.update( v.name.encode('utf-8') )
+					h.update( str([tuple(row) for row in v.matrix_world]).encode('utf-8') )
+				continue
+			elif prop.type == 'COLLECTION': continue
+			if isinstance( v, set ): v = tuple(sorted(v))
+			elif hasattr( v, '__len__' ) and not isinstance( v, str ): v = tuple(v)
+			h.update( ('%s=%r;' %(prop.identifier, v)).encode('utf-8') )
+	return h.hexdigest()
+
+def get_geometry_key( ob ):
+	'''
+	content addressed key: get_mesh_id plus a hash of the base mesh and modifier stack,
+	so edits to the mesh produce a new key and stale entries are never served.
+	note: deformation from an armature pose is not part of the key.
+	'''
+	mesh = ob.data
+	h = hashlib.md5()
+	h.update( struct.pack('<III', len(mesh.vertices), len(mesh.edges), len(mesh.polygons)) )
+	_hash_foreach( h, mesh.vertices, 'co', 'f', 3 )
+	_hash_foreach( h, mesh.edges, 'vertices', 'I', 2 )
+	_hash_foreach( h, mesh.loops, 'vertex_index', 'I', 1 )
+	_hash_foreach( h, mesh.polygons, 'loop_total', 'I', 1 )
+	for vc in mesh.vertex_colors:
+		if not vc.active_render: continue
+		_hash_foreach( h, vc.data, 'color', 'f', 3 )
+		## special edge colors ##
+		_hash_foreach( h, mesh.edges, 'use_edge_sharp', 'B', 1 )
+		_hash_foreach( h, mesh.edges, 'use_seam', 'B', 1 )
+		_hash_foreach( h, mesh.edges, 'crease', 'f', 1 )
+		_hash_foreach( h, mesh.edges, 'bevel_weight', 'f', 1 )
+	get_modifier_hash( ob, h )
+	return '%s-%s' %(get_mesh_id(mesh), h.hexdigest()[:16])
+
+def pack_geometry( geo ):
+	'''
+	packs the lists of a geometry dict into a single little endian buffer,
+	the values can also be flat array.array's (typecode must match GEOMETRY_LAYOUT).
+	returns (buffer, layout) where layout is a list of [name, array type, byte offset, length]
+	'''
+	parts = []; layout = []; offset = 0
+	for name, fmt, n in GEOMETRY_LAYOUT:
+		if name not in geo: continue
+		flat = geo[ name ]
+		if isinstance( flat, array.array ):  ## already flat, from mesh_extract
+			assert flat.itemsize == 4
+			if sys.byteorder == 'big':
+				flat = array.array( flat.typecode, flat ); flat.byteswap()
+			b = flat.tobytes()
+		else:
+			if n != 1: flat = [ x for item in flat for x in item ]
+			b = struct.pack( '<%s%s' %(len(flat), fmt), *flat )
+		parts.append( b )
+		layout.append( [name, _layout_js_types[fmt], offset, len(flat)] )
+		offset += len(b)
+	return b''.join( parts ), layout
+
+
+class GeometryCacheSingleton(object):
+	'''
+	Meshes converted for the webGL client are packed once and shared by all players,
+	the client gets a small header over the websocket and downloads the buffer from
+	the http server at header['url'].
+	If quantize_bits is set the buffers are encoded with geometry_codec.py instead,
+	the header then also has the codec, its error bound and the compression ratio.
+	'''
+	MAX_VERSIONS = 4  ## cached keys per mesh_id, oldest are dropped
+	quantize_bits = None  ## position bit depth of the quantized codec, None sends raw float32 and uint32
+
+	def __init__(self):
+		self.entries = {}   # key : (header, buffer)
+		self.versions = {}  # mesh_id : [ keys ]
+		self.lock = threading._allocate_lock()
+		self.hits = 0
+		self.misses = 0
+		self.bytes = 0
+
+	def get(self, key):
+		'''
+		returns the header for key or None
+		'''
+		entry = self.entries.get( key )
+		if entry:
+			self.hits += 1
+			return entry[0]
+		self.misses += 1
+
+	def get_buffer(self, key):
+		entry = self.entries.get( key )
+		if entry: return entry[1]
+
+	def store(self, key, mesh_id, geo):
+		'''
+		packs the geometry dict and returns its header
+		'''
+		info = None
+		if self.quantize_bits:
+			import geometry_codec  ## not at the top, it imports this module
+			buff, layout, info = geometry_codec.encode_geometry( geo, self.quantize_bits )
+		else:
+			buff, layout = pack_geometry( geo )
+		header = {
+			'mesh_id': mesh_id,
+			'key'    : key,
+			'url'    : '/geometry/%s.bin' %key,
+			'layout' : layout,
+			'bytes'  : len(buff),
+		}
+		if info: header.update( info )
+		with self.lock:
+			if key not in self.entries: self.bytes += len(buff)
+			self.entries[ key ] = (header, buff)
+			if mesh_id not in self.versions: self.versions[ mesh_id ] = []
+			keys = self.versions[ mesh_id ]
+			if key in keys: keys.remove( key )
+			keys.append( key )
+			while len(keys) > self.MAX_VERSIONS:
+				old = keys.pop(0)
+				self.bytes -= len( self.entries.pop(old)[1] )
+		return header
+
+	def invalidate(self, mesh_id):
+		with self.lock:
+			for key in self.versions.pop( mesh_id, [] ):
+				self.bytes -= len( self.entries.pop(key)[1] )
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.versions.clear()
+			self.bytes = 0
+
+	def get_stats(self):
+		return {'entries':len(self.entries), 'bytes':self.bytes, 'hits':self.hits, 'misses':self.misses}
+
+
+GeometryCache = GeometryCacheSingleton()
+
+if bpy and hasattr(bpy, 'app'):
+	@bpy.app.handlers.persistent
+	def _on_load( *args ): GeometryCache.clear()
+	bpy.app.handlers.load_post.append( _on_load )
+
+
+if __name__ == '__main__':
+	geo = {
+		'vertices' : [ [0,0,0], [1,0,0], [1,1,0], [0,1,0] ],
+		'triangles': [ [0,1,2] ],
+		'quads'    : [ [0,1,2,3] ],
+		'lines'    : [],
+		'points'   : [ 3 ],
+	}
+	buff, layout = pack_geometry( geo )
+	for name, jstype, offset, length in layout:
+		fmt = '<%s%s' %(length, {'Float32Array':'f', 'Uint32Array':'I'}[jstype])
+		flat = struct.unpack_from( fmt, buff, offset )
+		if name == 'points': assert list(flat) == geo[name]
+		else: assert list(flat) == [x for item in geo[name] for x in item]
+
+	flat = dict( geo, lines=array.array('I',[0,1,2,3]), points=array.array('I',[3]) )
+	assert pack_geometry( flat ) == pack_geometry( dict(geo, lines=[(0,1),(2,3)]) )
+
+	C = GeometryCacheSingleton()
+	h = C.store( 'a-1', 'a', geo )
+	assert C.get('a-1') is h and C.get_buffer('a-1') == buff
+	for i in range(2, 10): C.store( 'a-%s'%i, 'a', geo )
+	assert len(C.entries) == C.MAX_VERSIONS and 'a-1' not in C.entries
+	C.invalidate( 'a' )
+	assert not C.entries and C.bytes == 0
+	C.quantize_bits = 16
+	h = C.store( 'q-1', 'q', geo )
+	assert h['codec'] == 'quantized' and h['bytes'] < len(buff) and [l[0] for l in h['layout']] == [l[0] for l in layout]
+	print('geometry cache test done', len(buff), C.get_stats())
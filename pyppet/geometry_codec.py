@@ -0,0 +1,213 @@
+# Geometry Codec - quantized positions, varint indices and 8bit colors for the mesh stream
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import struct, array
+from geometry_cache import GEOMETRY_LAYOUT
+try: import numpy
+except ImportError: numpy = None
+
+'''
+encoded layout entries are: [name, encoding, byte offset, length, byte length]
+	Quantized8/Quantized16 - vertices, per axis (v - qmin) / (qmax - qmin) scaled to the bit depth
+	Color8 - colors, one byte per channel
+	Varint - index buffers, zigzag delta from the previous index as little endian base 128
+the decoder is generated by generate_javascript and returns flat Float32Array and Uint32Array
+like UserAPI.unpack_geometry does for the raw layout.
+'''
+
+def _flatten( geo, name, n ):
+	flat = geo[ name ]
+	if isinstance( flat, array.array ) or n == 1: return flat
+	return [ x for item in flat for x in item ]
+
+def get_bounds( vertices ):
+	'''
+	returns (min, max) as tuples of the flat vertex array
+	'''
+	if not len(vertices): return (0.0,0.0,0.0), (0.0,0.0,0.0)
+	if numpy:
+		v = numpy.asarray( vertices, dtype=numpy.float64 ).reshape( (-1,3) )
+		return tuple( v.min(axis=0).tolist() ), tuple( v.max(axis=0).tolist() )
+	return (
+		tuple( min(vertices[i::3]) for i in range(3) ),
+		tuple( max(vertices[i::3]) for i in range(3) ),
+	)
+
+def quantize( vertices, lo, hi, bits ):
+	'''
+	returns (bytes, error), error is the largest distance a decoded coordinate can be off by
+	'''
+	scale = (1 << bits) - 1
+	typecode = 'B' if bits <= 8 else 'H'
+	steps = [ (hi[i]-lo[i]) / scale for i in range(3) ]
+	error = max( steps ) * 0.5
+	if numpy:
+		v = numpy.asarray( vertices, dtype=numpy.float64 ).reshape( (-1,3) )
+		extent = numpy.array( [ hi[i]-lo[i] or 1.0 for i in range(3) ] )
+		q = numpy.rint( (v - lo) / extent * scale ).clip( 0, scale )
+		return q.astype( numpy.dtype(typecode).newbyteorder('<') ).tobytes(), error
+	q = array.array( typecode )
+	for i, x in enumerate( vertices ):
+		axis = i % 3
+		extent = hi[axis] - lo[axis] or 1.0
+		q.append( min( scale, max(0, int(round( (x-lo[axis]) / extent * scale ))) ) )
+	if q.itemsize > 1 and struct.pack('=H',1) != struct.pack('<H',1): q.byteswap()
+	return q.tobytes(), error
+
+def encode_colors( colors ):
+	return bytes( [ min(255, max(0, int(round(c*255)))) for c in colors ] )
+
+def encode_varint( indices ):
+	'''
+	zigzag delta from the previous index, 7 bits per byte, high bit set if more bytes follow
+	'''
+	out = bytearray()
+	prev = 0
+	for i in indices:
+		d = i - prev
+		prev = i
+		z = d*2 if d >= 0 else -d*2 - 1
+		while z > 0x7f:
+			out.append( (z & 0x7f) | 0x80 )
+			z >>= 7
+		out.append( z )
+	return bytes( out )
+
+def decode_varint( data, count ):
+	indices = []
+	prev = 0; offset = 0
+	for n in range( count ):
+		z = shift = 0
+		while True:
+			b = data[ offset ]; offset += 1
+			z |= (b & 0x7f) << shift
+			shift += 7
+			if not b & 0x80: break
+		prev += (z >> 1) if not z & 1 else -((z+1) >> 1)
+		indices.append( prev )
+	return indices
+
+def encode_geometry( geo, bits=16 ):
+	'''
+	same input as geometry_cache.pack_geometry, returns (buffer, layout, info),
+	info has the keys for the header: codec, bits, qmin, qmax, error and ratio (raw size over encoded size)
+	'''
+	assert 1 <= bits <= 16
+	parts = []; layout = []; offset = 0; raw = 0
+	lo = hi = None
+	for name, fmt, n in GEOMETRY_LAYOUT:
+		if name not in geo: continue
+		flat = _flatten( geo, name, n )
+		raw += len(flat) * 4
+		if name == 'vertices':
+			lo, hi = get_bounds( flat )
+			b, error = quantize( flat, lo, hi, bits )
+			encoding = 'Quantized8' if bits <= 8 else 'Quantized16'
+		elif name == 'colors':
+			b = encode_colors( flat ); encoding = 'Color8'
+		else:
+			assert fmt == 'I'
+			b = encode_varint( flat ); encoding = 'Varint'
+		parts.append( b )
+		layout.append( [name, encoding, offset, len(flat), len(b)] )
+		offset += len(b)
+
+	info = {'codec':'quantized', 'bits':bits, 'error':0.0, 'ratio':1.0}
+	if lo is not None:
+		info['qmin'] = lo; info['qmax'] = hi; info['error'] = error
+	if offset: info['ratio'] = raw / float(offset)
+	return b''.join( parts ), layout, info
+
+def decode_geometry( buff, layout, info ):
+	'''
+	python version of the generated javascript decoder, returns a dict of flat lists
+	'''
+	geo = {}
+	for name, encoding, offset, length, nbytes in layout:
+		data = buff[ offset : offset+nbytes ]
+		if encoding.startswith( 'Quantized' ):
+			typecode = 'B' if encoding == 'Quantized8' else 'H'
+			scale = (1 << info['bits']) - 1
+			lo = info['qmin']; hi = info['qmax']
+			q = struct.unpack( '<%s%s' %(length, typecode), data )
+			geo[ name ] = [ lo[i%3] + q[i] * (hi[i%3]-lo[i%3]) / scale for i in range(length) ]
+		elif encoding == 'Color8':
+			geo[ name ] = [ c / 255.0 for c in data ]
+		else:
+			geo[ name ] = decode_varint( data, length )
+	return geo
+
+
+def generate_javascript( global_name='_geometry_decoder_' ):
+	'''
+	javascript function( header, buffer ) that returns the same pak as UserAPI.unpack_geometry
+	'''
+	return GEOMETRY_DECODER_JAVASCRIPT.replace( '$NAME', global_name )
+
+GEOMETRY_DECODER_JAVASCRIPT = '''
+//generated geometry decoder, see geometry_codec.py //
+var $NAME = function ( header, buffer ) {
+  var pak = {triangles:[], quads:[], vertices:[], lines:[]};
+  for (var key in header) { pak[ key ] = header[ key ]; }
+  var view = new DataView( buffer );
+  var bytes = new Uint8Array( buffer );
+  var scale = Math.pow(2, header.bits) - 1;
+  for (var i=0; i < header.layout.length; i ++) {
+    var l = header.layout[i]; // name, encoding, byte offset, length, byte length
+    var offset = l[2];
+    var length = l[3];
+    if (l[1] == 'Quantized16' || l[1] == 'Quantized8') {
+      var arr = new Float32Array( length );
+      var wide = (l[1] == 'Quantized16');
+      var step = [];
+      for (var j=0; j<3; j++) { step.push( (header.qmax[j] - header.qmin[j]) / scale ); }
+      for (var j=0; j<length; j++) {
+        var q = wide ? view.getUint16(offset + j*2, true) : bytes[ offset + j ];
+        arr[j] = header.qmin[ j%3 ] + q * step[ j%3 ];
+      }
+    } else if (l[1] == 'Color8') {
+      var arr = new Float32Array( length );
+      for (var j=0; j<length; j++) { arr[j] = bytes[ offset + j ] / 255.0; }
+    } else { // Varint
+      var arr = new Uint32Array( length );
+      var prev = 0;
+      for (var j=0; j<length; j++) {
+        var z = 0; var mul = 1; var b;
+        do {
+          b = bytes[ offset++ ];
+          z += (b & 0x7f) * mul;
+          mul *= 128;
+        } while (b & 0x80);
+        prev += (z % 2) ? -(z+1)/2 : z/2;
+        arr[j] = prev;
+      }
+    }
+    pak[ l[0] ] = arr;
+  }
+  return pak;
+};
+'''
+
+
+if __name__ == '__main__':
+	import random
+	verts = [ (random.uniform(-5,5), random.uniform(0,20), random.uniform(-1,1)) for i in range(500) ]
+	geo = {
+		'vertices' : verts,
+		'colors'   : [ (random.random(), random.random(), random.random()) for v in verts ],
+		'triangles': [ (random.randrange(500), random.randrange(500), random.randrange(500)) for i in range(300) ],
+		'quads'    : array.array( 'I', [ i for i in range(400) ] ),
+		'lines'    : [ (0, 2**31), (499, 0) ],
+	}
+	for mode in (numpy, None):
+		numpy = mode
+		for bits in (16, 10, 8):
+			buff, layout, info = encode_geometry( geo, bits )
+			out = decode_geometry( buff, layout, info )
+			flat = [ x for v in verts for x in v ]
+			assert max( abs(a-b) for a,b in zip(flat, out['vertices']) ) <= info['error'] * 1.0001
+			assert out['triangles'] == [ x for t in geo['triangles'] for x in t ]
+			assert out['quads'] == list( geo['quads'] ) and out['lines'] == [ 0, 2**31, 499, 0 ]
+			assert max( abs(a-b) for a,b in zip([x for c in geo['colors'] for x in c], out['colors']) ) <= 0.5/255 + 1e-9
+	print('geometry codec test done', 'ratio %.2f' %info['ratio'], 'error %.5f' %info['error'], len(buff))
@@ -0,0 +1,123 @@
+# Material Cache - material configs and smooth shading flags, rebuilt only when something changed
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import array, itertools, threading
+try: import bpy
+except ImportError: bpy = None
+from geometry_cache import get_mesh_id
+
+
+def get_material_fingerprint( mat ):
+	'''
+	cheap tuple of every material setting read by Server.get_material_config, keep them in sync.
+	'''
+	rm = mat.raytrace_mirror
+	gs = mat.game_settings
+	return (
+		mat.name, tuple(mat.diffuse_color), mat.use_transparency, mat.alpha, mat.emit, mat.ambient,
+		rm.use, rm.fresnel, rm.reflect_factor, mat.get('cubemap'),
+		gs.alpha_blend, gs.use_backface_culling,
+		mat.use_shadeless, mat.use_tangent_shading, mat.specular_intensity, tuple(mat.specular_color),
+		mat.diffuse_shader, mat.type,
+	)
+
+
+class SmoothFlagsSingleton(object):
+	'''
+	per mesh use_smooth flags of all polygons, read with foreach_get and kept until
+	the mesh is updated (see _on_scene_update) or its polygon count changes.
+	'''
+	def __init__(self):
+		self.entries = {}  # mesh_id : (polygon count, flags, smooth)
+		self.lock = threading._allocate_lock()
+
+	def get(self, mesh):
+		'''
+		returns (flags, smooth), flags is an array of bytes, smooth is True if any polygon is smooth
+		'''
+		mesh_id = get_mesh_id( mesh )
+		n = len( mesh.polygons )
+		entry = self.entries.get( mesh_id )
+		if entry is None or entry[0] != n:
+			flags = array.array( 'B', [0] ) * n
+			if n: mesh.polygons.foreach_get( 'use_smooth', flags )
+			entry = ( n, flags, bool( flags.tobytes().strip(b'\x00') ) )
+			with self.lock: self.entries[ mesh_id ] = entry
+		return entry[1], entry[2]
+
+	def invalidate(self, mesh):
+		with self.lock: self.entries.pop( get_mesh_id(mesh), None )
+
+	def clear(self):
+		with self.lock: self.entries.clear()
+
+SmoothFlags = SmoothFlagsSingleton()
+
+def mesh_is_smooth( mesh ):
+	'''
+	if any face is smooth, the entire mesh is considered smooth
+	'''
+	return SmoothFlags.get( mesh )[1]
+
+
+class MaterialCacheSingleton(object):
+	'''
+	Material configs keyed by material, mesh and overlay, the config is only rebuilt when
+	the fingerprint (material settings, polygon and vertex color layer count, smooth flag) changes.
+	Each new config gets a new version, players compare versions instead of the stringified config.
+	note: the returned config is shared, do not modify it.
+	'''
+	def __init__(self):
+		self.entries = {}  # (material name, mesh_id, overlay) : (fingerprint, config, version)
+		self.lock = threading._allocate_lock()
+		self._versions = itertools.count(1)
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, mat, builder, mesh=None, wrapper=None):
+		'''
+		returns (config, version), builder is called as builder( mat, mesh=mesh, wrapper=wrapper ) on a miss.
+		'''
+		overlay = None
+		if wrapper and 'overlay' in wrapper: overlay = wrapper['overlay']
+		mesh_id = fingerprint = None
+		if mesh:
+			mesh_id = get_mesh_id( mesh )
+			fingerprint = ( len(mesh.polygons), len(mesh.vertex_colors), mesh_is_smooth(mesh) )
+		fingerprint = ( get_material_fingerprint(mat), fingerprint )
+
+		key = ( mat.name, mesh_id, overlay )
+		entry = self.entries.get( key )
+		if entry and entry[0] == fingerprint:
+			self.hits += 1
+			return entry[1], entry[2]
+
+		self.misses += 1
+		cfg = builder( mat, mesh=mesh, wrapper=wrapper )
+		with self.lock:
+			entry = self.entries[ key ] = ( fingerprint, cfg, next(self._versions) )
+		return entry[1], entry[2]
+
+	def clear(self):
+		with self.lock: self.entries.clear()
+
+	def get_stats(self):
+		return {'entries':len(self.entries), 'hits':self.hits, 'misses':self.misses}
+
+MaterialCache = MaterialCacheSingleton()
+
+
+if bpy and hasattr(bpy, 'app'):
+	@bpy.app.handlers.persistent
+	def _on_scene_update( *args ):
+		if bpy.data.meshes.is_updated:
+			for mesh in bpy.data.meshes:
+				if mesh.is_updated: SmoothFlags.invalidate( mesh )
+	bpy.app.handlers.scene_update_post.append( _on_scene_update )
+
+	@bpy.app.handlers.persistent
+	def _on_load( *args ):
+		SmoothFlags.clear()
+		MaterialCache.clear()
+	bpy.app.handlers.load_post.append( _on_load )
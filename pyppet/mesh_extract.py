@@ -0,0 +1,168 @@
+# Mesh Extract - bulk reads of mesh data with foreach_get into typed arrays
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import array
+try: import numpy
+except ImportError: numpy = None
+
+
+def read_array( collection, attr, typecode, size=1 ):
+	'''
+	one foreach_get call instead of a python loop over the collection
+	'''
+	arr = array.array( typecode, [0] ) * (len(collection) * size)
+	if len(arr): collection.foreach_get( attr, arr )
+	return arr
+
+def to_mesh( ob, scene, matrix=None, hide=None ):
+	'''
+	converts the modifier stack into a new mesh, the caller must remove it from bpy.data.meshes.
+	hide( modifier ) can return True to turn a modifier off for the conversion,
+	matrix is applied to the new mesh (in C, so this is a bulk operation).
+	'''
+	restore = []
+	if hide:
+		for mod in ob.modifiers:
+			if mod.show_viewport and hide( mod ):
+				mod.show_viewport = False
+				restore.append( mod )
+	try:
+		data = ob.to_mesh( scene, True, "PREVIEW" )
+	finally:
+		for mod in restore: mod.show_viewport = True
+	if matrix is not None: data.transform( matrix )
+	return data
+
+def get_tessfaces( mesh ):
+	'''
+	returns (triangles, quads) as flat uint32 arrays, calc_tessface must be called first.
+	vertices_raw always has 4 indices, blender keeps the 4th index of a quad non-zero,
+	so a zero there means a triangle.
+	'''
+	raw = read_array( mesh.tessfaces, 'vertices_raw', 'I', 4 )
+	if numpy:
+		faces = numpy.frombuffer( raw, dtype=numpy.uint32 ).reshape( (-1,4) )
+		is_quad = faces[ :, 3 ] != 0
+		return (
+			array.array( 'I', faces[ ~is_quad, :3 ].tobytes() ),
+			array.array( 'I', faces[ is_quad ].tobytes() ),
+		)
+	triangles = array.array( 'I' )
+	quads = array.array( 'I' )
+	for i in range( 0, len(raw), 4 ):
+		if raw[ i+3 ]: quads.extend( raw[ i:i+4 ] )
+		else: triangles.extend( raw[ i:i+3 ] )
+	return triangles, quads
+
+def get_vertex_colors( mesh ):
+	'''
+	flat float array of the colors of the layers used for rendering, or None
+	'''
+	layers = [ vc for vc in mesh.vertex_colors if vc.active_render ]
+	if not len( mesh.vertex_colors ): return None
+	colors = array.array( 'f' )
+	for vc in layers: colors.extend( read_array( vc.data, 'color', 'f', 3 ) )
+	return colors
+
+def set_edge_colors( mesh, edges, colors, palette ):
+	'''
+	colors both vertices of the given edges by their flags, palette has the keys SHARP, SEAM, CREASE and BEVEL.
+	'''
+	if not len( edges ): return
+	verts = read_array( mesh.edges, 'vertices', 'I', 2 )
+	flags = (
+		('SHARP', read_array( mesh.edges, 'use_edge_sharp', 'B' )),
+		('SEAM', read_array( mesh.edges, 'use_seam', 'B' )),
+		('CREASE', read_array( mesh.edges, 'crease', 'f' )),
+		('BEVEL', read_array( mesh.edges, 'bevel_weight', 'f' )),
+	)
+	for index in edges:
+		for name, values in flags:
+			if values[ index ] > 0:
+				clr = palette[ name ]
+				for v in verts[ index*2 : index*2+2 ]:
+					if v*3+3 <= len(colors): colors[ v*3 : v*3+3 ] = array.array( 'f', clr )
+				break
+
+def extract_mesh( mesh, palette=None ):
+	'''
+	returns a geometry dict of flat typed arrays for geometry_cache.pack_geometry:
+	vertices, triangles, quads, lines, points (if any) and colors (if the mesh has vertex colors),
+	palette is used to color the vertices of loose edges by their edge flags.
+	'''
+	mesh.calc_tessface()
+	triangles, quads = get_tessfaces( mesh )
+	geo = {
+		'vertices' : read_array( mesh.vertices, 'co', 'f', 3 ),
+		'triangles': triangles,
+		'quads'    : quads,
+	}
+	points, lines, loose = get_loose_geometry( mesh )
+	geo['lines'] = lines
+	if points: geo['points'] = points
+
+	colors = get_vertex_colors( mesh )
+	if colors is not None:
+		geo['colors'] = colors
+		if palette: set_edge_colors( mesh, loose, colors, palette )
+	return geo
+
+def get_loose_geometry( mesh ):
+	'''
+	returns (points, lines, loose) as uint32 arrays:
+		points - vertices not used by any edge (particles)
+		lines - flat vertex pairs of the loose edges
+		loose - indices of the loose edges
+	this is O(V+E), the old per vertex "in" test over a list of used vertices was O(V*E).
+	'''
+	nverts = len( mesh.vertices )
+	edges = read_array( mesh.edges, 'vertices', 'I', 2 )
+	is_loose = read_array( mesh.edges, 'is_loose', 'B' )
+
+	if numpy:
+		e = numpy.frombuffer( edges, dtype=numpy.uint32 ).reshape( (-1,2) )
+		used = numpy.zeros( nverts, dtype=bool )
+		used[ e.ravel() ] = True
+		loose = numpy.flatnonzero( numpy.frombuffer(is_loose, dtype=numpy.uint8) ).astype( numpy.uint32 )
+		points = array.array( 'I', numpy.flatnonzero( ~used ).astype(numpy.uint32).tobytes() )
+		lines = array.array( 'I', e[ loose ].tobytes() )
+		return points, lines, array.array( 'I', loose.tobytes() )
+
+	used = bytearray( nverts )
+	for v in edges: used[ v ] = 1
+	points = array.array( 'I', [ i for i,u in enumerate(used) if not u ] )
+	loose = array.array( 'I', [ i for i,flag in enumerate(is_loose) if flag ] )
+	lines = array.array( 'I' )
+	for i in loose: lines.extend( edges[ i*2 : i*2+2 ] )
+	return points, lines, loose
+
+
+if __name__ == '__main__':
+	class Collection(list):
+		def foreach_get(self, attr, arr):
+			flat = []
+			for item in self:
+				v = getattr( item, attr )
+				if type(v) is tuple: flat.extend( v )
+				else: flat.append( v )
+			arr[:] = array.array( arr.typecode, flat )
+
+	class Item(object):
+		def __init__(self, **kw): self.__dict__.update( kw )
+
+	class Mesh(object):
+		vertices = Collection( [Item() for i in range(8)] )
+		edges = Collection([
+			Item( vertices=(0,1), is_loose=False ),
+			Item( vertices=(1,2), is_loose=False ),
+			Item( vertices=(4,5), is_loose=True ),
+			Item( vertices=(2,0), is_loose=False ),
+		])
+
+	for mode in (numpy, None):
+		numpy = mode
+		points, lines, loose = get_loose_geometry( Mesh )
+		assert list(points) == [3,6,7], points
+		assert list(lines) == [4,5] and list(loose) == [2]
+	print('mesh extract test done')
@@ -0,0 +1,132 @@
+# Mesh Stream - progressive chunked transfer of packed geometry over the websocket
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import struct, heapq, itertools
+
+## a chunk frame is: null byte, format code byte, then chunk records ##
+GEOMETRY_CHUNK_CODE = 'g'
+## chunk record: UID (uint16), byte offset (uint32), length (uint32), then length bytes of the packed buffer ##
+_chunk_header = struct.Struct( '<HII' )
+
+MESH_CHUNK_SIZE = 16384     ## bytes, upper bound of a single chunk
+MESH_FRAME_BUDGET = 65536   ## bytes of geometry per player per frame, shared by all active transfers
+MESH_MAX_TRANSFERS = 4      ## meshes interleaved at once, the rest wait in the queue
+MIN_RADIUS = 0.01           ## keeps flat and empty bounds from getting an infinite priority
+
+def get_priority( distance, radius ):
+	'''
+	smaller is sooner, distance over bounding radius is proportional to one over the
+	screen-space size, so near and large objects go first.
+	'''
+	return distance / max( radius, MIN_RADIUS )
+
+
+class MeshStream(object):
+	'''
+	per player queue of mesh requests and the packed buffers (see geometry_cache.py) being sent,
+	the queue is reordered every frame by the priority of where the player is now.
+	'''
+	def __init__(self, chunk_size=MESH_CHUNK_SIZE, frame_budget=MESH_FRAME_BUDGET, max_transfers=MESH_MAX_TRANSFERS):
+		self.chunk_size = chunk_size
+		self.frame_budget = frame_budget
+		self.max_transfers = max_transfers
+		self.requests = {}   # object : order, the order breaks priority ties first come first served
+		self.transfers = []  # [ uid, memoryview, offset ]
+		self._order = itertools.count()
+		self.bytes_sent = 0
+		self.meshes_sent = 0
+
+	def __contains__(self, ob): return ob in self.requests
+	def __len__(self): return len(self.requests)
+
+	def request(self, ob):
+		if ob not in self.requests: self.requests[ ob ] = next( self._order )
+
+	def cancel(self, ob):
+		self.requests.pop( ob, None )
+
+	def select(self, candidates, get_priority):
+		'''
+		returns the requested objects in candidates with the best priority, at most one for each free
+		transfer slot, get_priority( ob ) is only called for requested objects.
+		objects stay in the queue until start is called for them.
+		'''
+		free = self.max_transfers - len(self.transfers)
+		if free <= 0 or not self.requests: return []
+		heap = [ (get_priority(ob), self.requests[ob], ob) for ob in candidates if ob in self.requests ]
+		heapq.heapify( heap )
+		return [ heapq.heappop(heap)[-1] for i in range( min(free, len(heap)) ) ]
+
+	def start(self, ob, uid, buff):
+		'''
+		removes ob from the queue and starts sending buff, the client knows the size from the json header
+		'''
+		self.requests.pop( ob, None )
+		self.transfers.append( [uid, memoryview(buff), 0] )
+
+	def pop_frame(self):
+		'''
+		returns a binary frame of chunks or None, one chunk from each active transfer per pass
+		until the frame budget is used, so one large mesh does not hold back the small ones.
+		'''
+		parts = []
+		budget = self.frame_budget
+		while self.transfers and budget > 0:
+			for t in list( self.transfers ):
+				uid, buff, offset = t
+				n = min( self.chunk_size, len(buff) - offset, budget )
+				parts.append( _chunk_header.pack(uid, offset, n) )
+				parts.append( buff[ offset : offset+n ] )
+				t[2] = offset = offset + n
+				budget -= n
+				self.bytes_sent += n
+				if offset >= len(buff):
+					self.transfers.remove( t )
+					self.meshes_sent += 1
+				if budget <= 0: break
+		if not parts: return None
+		return bytes( [0, ord(GEOMETRY_CHUNK_CODE)] ) + b''.join( parts )
+
+	def get_stats(self):
+		return {
+			'queued':len(self.requests), 'transfers':len(self.transfers),
+			'bytes':self.bytes_sent, 'meshes':self.meshes_sent,
+		}
+
+
+if __name__ == '__main__':
+	def unpack_frame( frame ):
+		assert frame[:2] == bytes( [0, ord(GEOMETRY_CHUNK_CODE)] )
+		chunks = []; offset = 2
+		while offset < len(frame):
+			uid, start, n = _chunk_header.unpack_from( frame, offset )
+			offset += _chunk_header.size
+			chunks.append( (uid, start, frame[offset:offset+n]) )
+			offset += n
+		return chunks
+
+	S = MeshStream( chunk_size=10, frame_budget=25, max_transfers=2 )
+	dist = {'far':100.0, 'near':1.0, 'mid':10.0}
+	for ob in ('far', 'near', 'mid'): S.request( ob )
+	assert S.select( ('far','mid','near','other'), lambda ob: get_priority(dist[ob], 1.0) ) == ['near', 'mid']
+	assert S.select( ('far',), lambda ob: 0 ) == ['far']
+
+	data = { 1:bytes(range(40)), 2:bytes(range(100,107)) }
+	S.start( 'near', 1, data[1] )
+	S.start( 'mid', 2, data[2] )
+	assert S.select( ('far',), lambda ob: 0 ) == [] and 'far' in S
+
+	received = { 1:bytearray(40), 2:bytearray(7) }
+	frames = 0
+	while True:
+		frame = S.pop_frame()
+		if frame is None: break
+		frames += 1
+		chunks = unpack_frame( frame )
+		assert sum( len(c) for u,s,c in chunks ) <= S.frame_budget
+		for uid, start, chunk in chunks: received[ uid ][ start:start+len(chunk) ] = chunk
+		if frames == 1: assert [c[0] for c in chunks] == [1, 2, 1]  ## interleaved
+	assert bytes(received[1]) == data[1] and bytes(received[2]) == data[2]
+	assert frames == 2 and S.get_stats()['meshes'] == 2
+	print('mesh stream test done', S.get_stats())
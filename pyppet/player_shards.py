@@ -0,0 +1,603 @@
+# Player Shards - worker processes that own player sockets and build their message streams
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+'''
+The Blender process keeps the scene, the actions and the callbacks, once per tick it writes
+the world snapshot into a shared memory ring (SnapshotRing), and sends the rarer changes
+(properties, materials, geometry headers) to the workers through their command queues.
+
+Each worker process is forked at startup, it runs a websocksimplify event loop for the
+sockets handed to it (over a unix socket with SCM_RIGHTS), does the interest filtering,
+json and binary encoding, compression and sending for its players, and forwards the frames
+its players send back to the Blender process through the event queue.
+
+Nothing in a worker touches bpy, the Blender state it needs is in the ring and the queues.
+'''
+
+import os, time, json, struct, socket, select, array, pickle, queue, traceback, threading
+import multiprocessing
+
+import api_gen
+import spatial_index
+from websocket import websocksimplify
+
+SNAPSHOT_SLOTS = 4              ## ring slots, a reader copies the newest complete one
+SNAPSHOT_SLOT_SIZE = 2 ** 20    ## bytes, about 8000 objects with short names
+STATS_INTERVAL = 1.0            ## seconds between worker stats events
+COMMAND_POLL = 0.02             ## seconds, how often a worker checks its command queue
+
+NO_PARENT = -2                  ## parent field of root objects, -1 is the camera (see world_snapshot.py)
+FLAG_MESH = 1
+FLAG_VISIBLE = 2
+FLAG_TEXT_SCALE = 4
+
+## seq (odd while the slot is written), tick, object count, time, payload bytes ##
+_slot_header = struct.Struct( '<QIIdI' )
+## uid, parent, flags, world location, loc, rot, scl, min, max, text_scale, props version, material version ##
+_record = struct.Struct( '<IiB3f3f3f3f3f3ffQI' )
+_name_length = struct.Struct( '<H' )
+
+def pack_object_record( state, wloc, visible, version, material_version=0 ):
+	'''
+	state is a world_snapshot.ObjectState, followed by the name and mesh_id as short strings
+	'''
+	flags = FLAG_VISIBLE if visible else 0
+	lo = hi = (0.0,0.0,0.0)
+	if state.type == 'MESH':
+		flags |= FLAG_MESH
+		lo = state.min; hi = state.max
+	text_scale = 0.0
+	if state.text_scale is not None:
+		flags |= FLAG_TEXT_SCALE
+		text_scale = state.text_scale
+	parent = NO_PARENT if state.parent is None else state.parent
+	name = state.name.encode('utf-8')
+	mesh_id = (state.mesh_id or '').encode('utf-8')
+	return b''.join((
+		_record.pack( state.uid, parent, flags, *(tuple(wloc) + state.loc + state.rot + state.scl + lo + hi + (text_scale, version, material_version)) ),
+		_name_length.pack( len(name) ), name,
+		bytes( [len(mesh_id)] ), mesh_id,
+	))
+
+
+class SnapshotRecord(object):
+	'''
+	the worker side of one object of the snapshot
+	'''
+	__slots__ = ('uid', 'key', 'parent', 'type', 'visible', 'wloc', 'loc', 'rot', 'scl', 'state',
+		'min', 'max', 'text_scale', 'version', 'material_version', 'name', 'mesh_id')
+
+def unpack_snapshot( payload, count ):
+	'''
+	returns a dict of uid : SnapshotRecord
+	'''
+	objects = {}
+	offset = 0
+	for i in range( count ):
+		v = _record.unpack_from( payload, offset )
+		offset += _record.size
+		r = SnapshotRecord()
+		r.uid, r.parent, flags = v[0], v[1], v[2]
+		r.key = '__%s__' %r.uid
+		r.type = 'MESH' if flags & FLAG_MESH else 'EMPTY'
+		r.visible = bool( flags & FLAG_VISIBLE )
+		r.wloc = v[3:6]; r.loc = v[6:9]; r.rot = v[9:12]; r.scl = v[12:15]
+		r.min = v[15:18]; r.max = v[18:21]
+		r.text_scale = v[21] if flags & FLAG_TEXT_SCALE else None
+		r.version = v[22]; r.material_version = v[23]
+		r.state = (  ## same rounding as world_snapshot.get_transform
+			tuple(round(x,3) for x in r.loc),
+			tuple(round(x,3) for x in r.scl),
+			tuple(round(x,3) for x in r.rot),
+		)
+		n = _name_length.unpack_from( payload, offset )[0]; offset += _name_length.size
+		r.name = bytes( payload[offset:offset+n] ).decode('utf-8'); offset += n
+		n = payload[ offset ]; offset += 1
+		r.mesh_id = bytes( payload[offset:offset+n] ).decode('utf-8') or None; offset += n
+		objects[ r.uid ] = r
+	return objects
+
+
+class SnapshotRing(object):
+	'''
+	Shared memory ring of world snapshots, one writer (the Blender process) and many readers.
+	Each slot is guarded by a sequence number that is odd while it is written, a reader
+	retries if the number changed while it copied the slot.
+	note: this must be created before the workers are forked.
+	'''
+	def __init__(self, slots=SNAPSHOT_SLOTS, slot_size=SNAPSHOT_SLOT_SIZE):
+		self.slots = slots
+		self.slot_size = slot_size
+		self.shared = multiprocessing.RawArray( 'B', slots * slot_size )
+		self.latest = multiprocessing.RawValue( 'l', -1 )  ## tick of the newest complete slot
+		self.buffer = memoryview( self.shared ).cast( 'B' )
+		self.overflows = 0
+
+	def write(self, tick, records):
+		'''
+		records is a list of packed records, the ones that do not fit are dropped (and counted)
+		'''
+		offset = (tick % self.slots) * self.slot_size
+		room = self.slot_size - _slot_header.size
+		size = count = 0
+		for rec in records:
+			if size + len(rec) > room:
+				self.overflows += 1
+				break
+			size += len(rec); count += 1
+		payload = b''.join( records[:count] )
+
+		seq = _slot_header.unpack_from( self.buffer, offset )[0] + 1 | 1  ## odd while it is written
+		_slot_header.pack_into( self.buffer, offset, seq, tick, 0, 0.0, 0 )
+		start = offset + _slot_header.size
+		self.buffer[ start : start+len(payload) ] = payload
+		_slot_header.pack_into( self.buffer, offset, seq+1, tick, count, time.time(), len(payload) )
+		self.latest.value = tick
+
+	def read(self, tick=None):
+		'''
+		returns (tick, time, count, payload) of the newest snapshot, or None if nothing was written yet,
+		if tick is given and it is still the newest, payload is None (the caller has it).
+		'''
+		for retry in range( 100 ):
+			latest = self.latest.value
+			if latest < 0: return None
+			offset = (latest % self.slots) * self.slot_size
+			seq, t, count, stamp, size = _slot_header.unpack_from( self.buffer, offset )
+			if seq & 1 or t != latest: continue  ## the writer is already at this slot again
+			if t == tick: return (t, stamp, count, None)
+			start = offset + _slot_header.size
+			payload = bytes( self.buffer[ start : start+size ] )
+			if _slot_header.unpack_from( self.buffer, offset )[0] == seq:
+				return (t, stamp, count, payload)
+		return None  ## the writer kept getting in the way, try again next frame
+
+
+def send_socket( chan, sock, info ):
+	'''
+	passes the file descriptor of sock and the pickled info over the unix socket chan,
+	with the address family, the listener can be ipv4 or ipv6
+	'''
+	fds = array.array( 'i', [sock.fileno()] )
+	chan.sendmsg( [pickle.dumps( (int(sock.family), info) )], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)] )
+
+def recv_socket( chan ):
+	'''
+	returns (socket, info) sent with send_socket
+	'''
+	data, ancdata, flags, addr = chan.recvmsg( 65536, socket.CMSG_LEN(array.array('i').itemsize) )
+	fds = array.array( 'i' )
+	for level, kind, cdata in ancdata:
+		if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+			fds.frombytes( cdata[ : len(cdata) - (len(cdata) % fds.itemsize) ] )
+	fd = fds[0]
+	family, info = pickle.loads( data )
+	sock = socket.fromfd( fd, family, socket.SOCK_STREAM )  ## fromfd dups the fd
+	os.close( fd )
+	return sock, info
+
+
+class ShardPlayer(object):
+	'''
+	The worker side of a player, the same message stream as Server.Player.create_message_stream,
+	built from the snapshot records and the properties the Blender process sent.
+	'''
+	def __init__(self, address, uid, config):
+		self.address = address
+		self.uid = uid  ## Player.uid in the Blender process
+		self.config = config
+		self.location = (0.0, 0.0, 0.0)
+		self.streaming = False
+		self.binary_stream = config['binary_stream']
+		self.cache = {}          # object uid : {'trans', 'props', 'material', 'header'}
+		self.invisibles = set()
+		self.sent_meshes = set()
+		self.geometry = {}       # object uid : (geometry header, model_config) waiting to be sent
+		self.eval_queue = []
+		self.binary_records = []
+		self.ticker = 0
+
+	def get_streaming_objects(self, world):
+		near = [ r for d,r in world.grid.query( self.location, self.config['max_distance'] ) ]
+		inside = set( r.uid for r in near )
+		for r in list( near ):
+			parent = world.objects.get( r.parent )
+			while parent and parent.uid not in inside:
+				inside.add( parent.uid )
+				near.append( parent )
+				parent = world.objects.get( parent.parent )
+
+		visible_empties = []; visible_meshes = []; turned_invisible = []
+		for r in near:
+			if not r.visible:
+				if r.uid in self.invisibles: turned_invisible.append( r )
+				else: self.invisibles.add( r.uid )
+			elif r.type == 'MESH':
+				self.invisibles.discard( r.uid )
+				visible_meshes.append( r )
+			else:
+				self.invisibles.discard( r.uid )
+				visible_empties.append( r )
+		return visible_empties + visible_meshes + turned_invisible
+
+	def pop_binary_stream(self):
+		if not self.binary_records: return None
+		frame = api_gen.TRANSFORM_STREAM.pack_frame( self.binary_records )
+		self.binary_records = []
+		return frame
+
+	def _strip_stream_header(self, uid, pak):
+		header = []
+		for key in self.config['header_keys']:
+			v = pak.get( key )
+			if type(v) is list: v = tuple( v )
+			header.append( v )
+		header = tuple( header )
+		if self.cache[uid]['header'] == header:
+			for key in self.config['header_keys']:
+				if key in pak: pak.pop( key )
+		else:
+			self.cache[uid]['header'] = header
+		return bool( pak )
+
+	def create_message_stream(self, world, shared):
+		msg = {'meshes':{}}
+		if self.eval_queue:
+			msg['eval'] = ';'.join( self.eval_queue )
+			self.eval_queue = []
+		if not self.streaming or world is None: return msg
+
+		special = self.config['special_keys']
+		selection = {}
+		for r in self.get_streaming_objects( world ):
+			uid = r.uid
+			if uid not in self.cache:
+				self.cache[ uid ] = {'trans':None, 'props':None, 'material':None, 'header':None}
+			cache = self.cache[ uid ]
+
+			pak = {'name':r.name}
+			if r.parent != NO_PARENT: pak['parent'] = r.parent
+
+			if self.binary_stream:
+				if cache['trans'] is None:
+					pak['pos'] = r.loc; pak['scl'] = r.scl; pak['rot'] = r.rot
+				else:
+					a,b,c = cache['trans']
+					rloc, rscl, rrot = r.state
+					keyframe = not self.ticker % self.config['keyframe']
+					fmt = api_gen.TRANSFORM_STREAM
+					mask = 0
+					if keyframe or rloc != a: mask |= fmt.bits['pos']
+					if keyframe or rrot != c: mask |= fmt.bits['rot']
+					if keyframe or rscl != b: mask |= fmt.bits['scl']
+					if mask: self.binary_records.append( fmt.pack(uid, mask, {'pos':r.loc, 'rot':r.rot, 'scl':r.scl}) )
+			else:
+				pak['pos'] = r.loc; pak['scl'] = r.scl; pak['rot'] = r.rot
+			cache['trans'] = r.state
+
+			if r.type == 'EMPTY':
+				pak['empty'] = True
+				if self.binary_stream and not self._strip_stream_header( uid, pak ): continue
+				msg['meshes'][ r.key ] = pak
+				continue
+
+			msg['meshes'][ r.key ] = pak
+			pak['min'] = r.min; pak['max'] = r.max
+
+			## the shared properties of the object, and the ones only this player sees ##
+			props_version, props, on_click, on_input = shared.props.get( uid, (0, {}, None, None) )
+			view_version, view_props = shared.views.get( (self.address, uid), (0, {}) )
+			send = uid in self.geometry
+			version = (props_version, view_version, r.text_scale)
+			changed = send or cache['props'] != version
+			cache['props'] = version
+			merged = dict( props ); merged.update( view_props )
+			merged['ob'] = uid; merged['user'] = self.uid
+
+			out = None
+			if changed:
+				out = dict( (k,v) for k,v in merged.items() if k not in special )
+				if 'text_scale' not in out and r.text_scale is not None: out['text_scale'] = r.text_scale
+				pak['properties'] = out
+			if merged.get( 'selected' ): selection[ merged['selected'] ] = out
+			if 'color' in merged: pak['color'] = merged['color']
+
+			pak['mesh_id'] = r.mesh_id
+			if send:
+				pak['geometry'], model_config = self.geometry.pop( uid )
+				if model_config: pak['model_config'] = model_config
+				self.sent_meshes.add( uid )
+			if uid in self.sent_meshes and uid in shared.materials:
+				mversion, mconfig = shared.materials[ uid ]
+				if cache['material'] != mversion:
+					cache['material'] = mversion
+					pak['active_material'] = mconfig
+
+			if on_click: pak['on_click'] = on_click
+			if on_input: pak['on_input'] = on_input
+
+			if self.binary_stream and not self._strip_stream_header( uid, pak ):
+				msg['meshes'].pop( r.key )
+
+		if len(selection) > 1:
+			times = sorted( selection.keys() ); times.reverse()
+			for T in times[ 1: ]:
+				p = selection[T]
+				if p: p.pop('selected')
+
+		self.ticker += 1
+		return msg
+
+
+class ShardWorld(object):
+	'''
+	one parsed snapshot and its spatial index, shared by all players of a worker
+	'''
+	def __init__(self, tick, stamp, objects, cell_size):
+		self.tick = tick
+		self.time = stamp
+		self.objects = objects
+		self.grid = spatial_index.UniformGrid( cell_size )
+		for r in objects.values(): self.grid.update( r.uid, r.wloc, payload=r )
+
+
+class ShardWorker(object):
+	'''
+	runs in the forked process, see the module docstring
+	'''
+	def __init__(self, index, ring, chan, commands, events, config):
+		self.index = index
+		self.ring = ring
+		self.chan = chan            ## unix socket the player sockets arrive on
+		self.commands = commands    ## queue from the Blender process
+		self.events = events        ## queue to the Blender process, shared by all workers
+		self.config = config
+		self.players = {}           ## socket : ShardPlayer
+		self.pending = {}           ## address : info of handed over sockets, until the event loop takes them
+		self.props = {}             ## object uid : (version, properties, on_click code, on_input code)
+		self.views = {}             ## (address, object uid) : (version, properties)
+		self.materials = {}         ## object uid : (version, config)
+		self.world = None
+		self.world_lock = threading._allocate_lock()
+		## players, props, views, materials and the player queues are changed by the command thread (run) ##
+		## and read by the event loop thread, both hold this ##
+		self.lock = threading._allocate_lock()
+		self.active = True
+
+	def get_world(self):
+		'''
+		the newest snapshot, parsed once per tick by whichever player gets here first
+		'''
+		tick = self.world.tick if self.world else None
+		snap = self.ring.read( tick )
+		if snap is None or snap[3] is None: return self.world
+		with self.world_lock:
+			if self.world is None or self.world.tick != snap[0]:
+				self.world = ShardWorld( snap[0], snap[1], unpack_snapshot(snap[3], snap[2]), self.config['cell_size'] )
+		return self.world
+
+	def on_new_client(self, sock):
+		address = sock.getpeername()
+		info = self.pending.pop( address )
+		with self.lock: self.players[ sock ] = ShardPlayer( address, info['player'], self.config )
+
+	def on_client_closed(self, sock):
+		with self.lock:
+			player = self.players.pop( sock, None )
+			if player:
+				for key in [ k for k in self.views if k[0] == player.address ]: self.views.pop( key )
+		if player: self.events.put( ('closed', self.index, player.address) )
+
+	def on_read(self, sock, frames):
+		player = self.players.get( sock )
+		if not player: return
+		forward = []
+		for frame in frames:
+			if not frame: continue
+			if frame[0] == 0 and len(frame) == 25:  ## camera location, see server_api.on_websocket_read_update
+				player.location = struct.unpack( '<fff', frame[1:13] )
+			elif len(frame) > 2 and chr(frame[0]) == '{' and chr(frame[-1]) == '}':
+				if b'start_object_stream' in frame and json.loads( frame.decode('utf-8') ).get('request') == 'start_object_stream':
+					player.streaming = True
+			forward.append( bytes(frame) )
+		if forward: self.events.put( ('frames', self.index, player.address, forward) )
+
+	def on_write(self, sock):
+		player = self.players.get( sock )
+		if not player: return None
+		world = self.get_world()
+		with self.lock: msg = player.create_message_stream( world, self )
+		frames = [ json.dumps( msg ).encode('utf-8') ]
+		binary = player.pop_binary_stream()
+		if binary: frames.append( binary )
+		return frames
+
+	def do_command(self, cmd):
+		with self.lock: self._do_command( cmd )
+
+	def _do_command(self, cmd):
+		kind = cmd[0]
+		if kind == 'props':
+			uid, version, props, on_click, on_input = cmd[1:]
+			self.props[ uid ] = (version, props, on_click, on_input)
+		elif kind == 'view':
+			address, uid, version, props = cmd[1:]
+			self.views[ (address, uid) ] = (version, props)
+		elif kind == 'material':
+			uid, version, config = cmd[1:]
+			self.materials[ uid ] = (version, config)
+		elif kind == 'player':
+			address, updates = cmd[1:]
+			for player in list( self.players.values() ):
+				if player.address != address: continue
+				player.eval_queue.extend( updates.get('eval', ()) )
+				player.geometry.update( updates.get('geometry', {}) )
+		elif kind == 'stop':
+			self.active = False
+
+	def run(self):
+		server = websocksimplify.WebSocketServer()
+		server.initialize(
+			read_callback=self.on_read,
+			write_callback=self.on_write,
+			new_client_callback=self.on_new_client,
+			close_callback=self.on_client_closed,
+			event_loop=True,
+			frame_rate=self.config['frame_rate'],
+			min_frame_rate=self.config['min_frame_rate'],
+			max_frame_rate=self.config['max_frame_rate'],
+		)
+		server.start_event_loop_thread()
+		last_stats = 0.0
+		while self.active:
+			if select.select( [self.chan], [], [], COMMAND_POLL )[0]:
+				sock, info = recv_socket( self.chan )
+				self.pending[ info['address'] ] = info
+				deflate = None
+				if info['deflate']: deflate = websocksimplify.PerMessageDeflate( **info['deflate'] )
+				server.adopt_client( sock, info['address'], base64=info['base64'], deflate=deflate )
+			while True:
+				try: cmd = self.commands.get_nowait()
+				except queue.Empty: break
+				try: self.do_command( cmd )
+				except Exception: traceback.print_exc()
+			now = time.time()
+			if now - last_stats > STATS_INTERVAL:
+				last_stats = now
+				self.events.put( ('stats', self.index, server.get_stats()) )
+		server.active = False
+
+def _worker_main( index, ring, chan, commands, events, config ):
+	try:
+		ShardWorker( index, ring, chan, commands, events, config ).run()
+	except Exception:
+		traceback.print_exc()
+	os._exit( 0 )  ## do not run the atexit handlers of the forked Blender process
+
+
+class ShardPool(object):
+	'''
+	the Blender process side: forks the workers, hands them sockets, publishes the snapshots
+	and collects what the players sent.
+	'''
+	def __init__(self, workers, config):
+		self.config = config
+		self.ring = SnapshotRing()
+		self.events = multiprocessing.Queue()
+		self.workers = []   # [ (process, unix socket, command queue) ]
+		self.players = {}   # address : worker index
+		self.counts = [0] * workers
+		self.stats = [{}] * workers
+		self.lock = threading._allocate_lock()
+		for i in range( workers ):
+			parent, child = socket.socketpair( socket.AF_UNIX, socket.SOCK_DGRAM )
+			commands = multiprocessing.Queue()
+			proc = multiprocessing.Process(
+				target=_worker_main,
+				args=(i, self.ring, child, commands, self.events, config),
+				name='player-shard-%s' %i,
+			)
+			proc.daemon = True
+			self.workers.append( (proc, parent, commands) )
+
+	def start(self):
+		for proc, chan, commands in self.workers: proc.start()
+		print('[player shards] started %s workers' %len(self.workers))
+
+	def stop(self):
+		for proc, chan, commands in self.workers: commands.put( ('stop',) )
+
+	def assign(self, sock, address, player_uid, base64=False, deflate=None):
+		'''
+		hands the connected websocket to the worker with the fewest players, and closes it here
+		'''
+		with self.lock:
+			index = self.counts.index( min(self.counts) )
+			self.counts[ index ] += 1
+			self.players[ address ] = index
+		info = {
+			'address':address, 'player':player_uid, 'base64':base64,
+			'deflate':deflate.get_settings() if deflate else None,
+		}
+		send_socket( self.workers[index][1], sock, info )
+		sock.close()
+		return index
+
+	def publish(self, tick, records):
+		self.ring.write( tick, records )
+
+	def broadcast(self, cmd):
+		for proc, chan, commands in self.workers: commands.put( cmd )
+
+	def send_to(self, address, cmd):
+		index = self.players.get( address )
+		if index is not None: self.workers[ index ][2].put( cmd )
+
+	def poll(self):
+		'''
+		returns the ('frames', worker, address, frames) events from the players,
+		stats and closed connections are handled here.
+		'''
+		frames = []
+		while True:
+			try: event = self.events.get_nowait()
+			except queue.Empty: break
+			if event[0] == 'frames': frames.append( event )
+			elif event[0] == 'stats': self.stats[ event[1] ] = event[2]
+			elif event[0] == 'closed':
+				with self.lock:
+					if self.players.pop( event[2], None ) is not None: self.counts[ event[1] ] -= 1
+		return frames
+
+	def get_stats(self):
+		stats = {}
+		for s in self.stats: stats.update( s )
+		return stats
+
+
+if __name__ == '__main__':
+	class State(object):
+		def __init__(self, uid, name, parent=None, type='MESH'):
+			self.uid = uid; self.name = name; self.parent = parent; self.type = type
+			self.loc = (uid*1.0, 0.0, 0.0); self.rot = (0.0, 0.5, 0.0); self.scl = (1.0, 1.0, 1.0)
+			self.min = (-1.0,-1.0,-1.0); self.max = (1.0,1.0,1.0)
+			self.mesh_id = 'abc%s' %uid if type == 'MESH' else None
+			self.text_scale = None
+
+	ring = SnapshotRing( slots=2, slot_size=4096 )
+	assert ring.read() is None
+	states = [ State(1, 'root', type='EMPTY'), State(2, u'm\xe9sh', parent=1), State(3, 'far') ]
+	records = [ pack_object_record( s, s.loc if s.uid != 3 else (1000.0,0,0), True, s.uid*10 ) for s in states ]
+	ring.write( 7, records )
+	tick, stamp, count, payload = ring.read()
+	assert tick == 7 and count == 3 and ring.read( 7 )[3] is None
+	objects = unpack_snapshot( payload, count )
+	assert objects[2].name == u'm\xe9sh' and objects[2].parent == 1 and objects[1].parent == NO_PARENT
+	assert objects[2].mesh_id == 'abc2' and objects[1].mesh_id is None and objects[3].version == 30
+
+	ring.write( 8, records * 100 )  ## does not fit, the rest is dropped
+	assert ring.overflows == 1 and ring.read()[0] == 8
+
+	config = {
+		'binary_stream':False, 'max_distance':400.0, 'keyframe':60, 'cell_size':100.0,
+		'header_keys':('name',), 'special_keys':('location','scale','rotation_euler','color'),
+	}
+	class Shared(object):
+		props = { 2:(5, {'clickable':True, 'color':[1,0,0,1]}, 'a', None) }
+		views = {}
+		materials = { 2:(1, {'diffuse':1}) }
+	world = ShardWorld( 7, stamp, objects, config['cell_size'] )
+	p = ShardPlayer( ('127.0.0.1', 5000), 1, config )
+	p.streaming = True
+	p.geometry[ 2 ] = ({'url':'/geometry/x.bin'}, None)
+	msg = p.create_message_stream( world, Shared )
+	assert set( msg['meshes'] ) == set( ['__1__', '__2__'] )  ## the far object is filtered out
+	m = msg['meshes']['__2__']
+	assert m['properties'] == {'clickable':True, 'ob':2, 'user':1} and m['color'] == [1,0,0,1]
+	assert m['geometry'] and m['active_material'] and m['on_click'] == 'a' and m['parent'] == 1
+	m = p.create_message_stream( world, Shared )['meshes']['__2__']
+	assert 'properties' not in m and 'active_material' not in m
+	Shared.views[ (p.address, 2) ] = (6, {'selected':1.0})
+	assert p.create_message_stream( world, Shared )['meshes']['__2__']['properties']['selected'] == 1.0
+	print('player shards test done')
@@ -0,0 +1,510 @@
+# Proxy Cache - cached, coalesced and connection pooled fetches for the /proxy/ url
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import os, time, json, socket, hashlib, tempfile, threading, collections, email.utils
+import http.client, urllib.parse
+
+'''
+the browser can not load images from other domains into webgl textures, so overlays and other
+remote data go through /proxy/<url>. Responses are kept by url in two tiers:
+	memory - the most recently used responses, up to MAX_MEMORY_BYTES
+	disk - every cacheable response, up to MAX_DISK_BYTES, the least recently used files are removed first
+how long a response is fresh comes from its Cache-Control or Expires header, stale responses are
+revalidated with If-None-Match/If-Modified-Since, and served stale if the upstream server is down.
+'''
+
+MAX_MEMORY_BYTES = 32 * 1024 * 1024
+MAX_MEMORY_ITEM = 2 * 1024 * 1024      ## larger responses are only kept on disk
+MAX_DISK_BYTES = 256 * 1024 * 1024
+MAX_RESPONSE_BYTES = 32 * 1024 * 1024  ## larger upstream responses are refused
+DEFAULT_TTL = 300.0      ## seconds, for responses without any cache headers
+MAX_HEURISTIC_TTL = 86400.0
+TIMEOUT = 10.0           ## seconds, connect and read timeout of upstream requests
+MAX_REDIRECTS = 5
+MAX_IDLE_PER_HOST = 4    ## keep-alive connections kept open for each upstream host
+CACHEABLE_STATUS = (200, 203, 300, 301, 404, 410)
+
+class ProxyError(Exception):
+	def __init__(self, status, reason):
+		Exception.__init__( self, '%s %s' %(status, reason) )
+		self.status = status
+		self.reason = reason
+
+
+def get_key( url ):
+	return hashlib.sha1( url.encode('utf-8') ).hexdigest()
+
+def parse_cache_control( value ):
+	'''
+	returns a dict of the directives, directives without a value map to True
+	'''
+	d = {}
+	for item in (value or '').split(','):
+		item = item.strip().lower()
+		if not item: continue
+		if '=' in item:
+			k, v = item.split('=', 1)
+			d[ k.strip() ] = v.strip().strip('"')
+		else: d[ item ] = True
+	return d
+
+def _parse_date( value ):
+	if not value: return None
+	t = email.utils.parsedate_tz( value )
+	if t is None: return None
+	return email.utils.mktime_tz( t )
+
+def get_freshness( headers, now=None ):
+	'''
+	returns seconds the response can be served without asking upstream, or None if it must not be stored.
+	headers is a dict with lower case keys.
+	'''
+	if now is None: now = time.time()
+	cc = parse_cache_control( headers.get('cache-control') )
+	if 'no-store' in cc or 'private' in cc: return None
+	if 'no-cache' in cc: return 0.0
+	for k in ('s-maxage', 'max-age'):
+		if k in cc:
+			try: return max( 0.0, float(cc[k]) - float(headers.get('age') or 0) )
+			except ValueError: return 0.0
+	date = _parse_date( headers.get('date') ) or now
+	if 'expires' in headers:
+		expires = _parse_date( headers['expires'] )
+		return max( 0.0, expires - date ) if expires else 0.0
+	modified = _parse_date( headers.get('last-modified') )
+	if modified:  ## heuristic freshness, a tenth of the age of the document
+		return min( MAX_HEURISTIC_TTL, max(0.0, (date - modified) * 0.1) )
+	return DEFAULT_TTL
+
+
+class ProxyEntry(object):
+	'''
+	a cached response, data is None if the entry was loaded from the disk index and not read yet
+	'''
+	__slots__ = ('key', 'url', 'status', 'content_type', 'etag', 'last_modified', 'expires', 'size', 'data')
+
+	def __init__(self, key, url, status, content_type, etag, last_modified, expires, size, data=None):
+		self.key = key
+		self.url = url
+		self.status = status
+		self.content_type = content_type
+		self.etag = etag
+		self.last_modified = last_modified
+		self.expires = expires
+		self.size = size
+		self.data = data
+
+	def is_fresh(self, now=None):
+		return (now or time.time()) < self.expires
+
+	def get_meta(self):
+		return dict( (k, getattr(self,k)) for k in self.__slots__ if k != 'data' )
+
+	def get_etag(self):
+		'''
+		the etag given to the browser, from the data so it does not depend on the upstream server
+		'''
+		return hashlib.sha1( self.data ).hexdigest()[:16]
+
+
+class Fetch(object):
+	'''
+	an upstream request in flight, callers of the same url wait on it instead of fetching again
+	'''
+	def __init__(self):
+		self.done = threading.Event()
+		self.entry = None
+		self.error = None
+
+
+class ConnectionPool(object):
+	'''
+	idle keep-alive connections by (scheme, host, port), a connection is only used by one thread at a time
+	'''
+	def __init__(self, max_idle=MAX_IDLE_PER_HOST, timeout=TIMEOUT):
+		self.max_idle = max_idle
+		self.timeout = timeout
+		self.idle = {}  # (scheme, host, port) : [ connection ]
+		self.lock = threading._allocate_lock()
+		self.created = 0
+		self.reused = 0
+
+	def get(self, scheme, host, port):
+		with self.lock:
+			conns = self.idle.get( (scheme, host, port) )
+			if conns:
+				self.reused += 1
+				return conns.pop(), True
+			self.created += 1
+		if scheme == 'https': conn = http.client.HTTPSConnection( host, port, timeout=self.timeout )
+		else: conn = http.client.HTTPConnection( host, port, timeout=self.timeout )
+		return conn, False
+
+	def put(self, scheme, host, port, conn):
+		with self.lock:
+			conns = self.idle.setdefault( (scheme, host, port), [] )
+			if len(conns) < self.max_idle:
+				conns.append( conn )
+				return
+		conn.close()
+
+	def request(self, url, headers):
+		'''
+		returns (status, reason, headers with lower case keys, data), if the server closed an idle
+		connection the request is sent again on the next one.
+		'''
+		u = urllib.parse.urlsplit( url )
+		scheme = u.scheme.lower()
+		port = u.port or (443 if scheme == 'https' else 80)
+		path = u.path or '/'
+		if u.query: path += '?' + u.query
+		while True:
+			conn, reused = self.get( scheme, u.hostname, port )
+			try:
+				conn.request( 'GET', path, headers=headers )
+				r = conn.getresponse()
+				length = r.getheader( 'Content-Length' )
+				if length and int(length) > MAX_RESPONSE_BYTES:
+					conn.close()
+					raise ProxyError( 502, 'upstream response too large' )
+				data = r.read( MAX_RESPONSE_BYTES + 1 )
+				if len(data) > MAX_RESPONSE_BYTES:
+					conn.close()
+					raise ProxyError( 502, 'upstream response too large' )
+			except (http.client.HTTPException, socket.error):
+				conn.close()
+				if reused: continue  ## stale keep-alive connection
+				raise
+			rheaders = dict( (k.lower(), v) for k,v in r.getheaders() )
+			if r.will_close: conn.close()
+			else: self.put( scheme, u.hostname, port, conn )
+			return r.status, r.reason, rheaders, data
+
+	def close(self):
+		with self.lock:
+			for conns in self.idle.values():
+				for conn in conns: conn.close()
+			self.idle.clear()
+
+	def get_stats(self):
+		return {'created':self.created, 'reused':self.reused, 'idle':sum( len(c) for c in list(self.idle.values()) )}
+
+
+class ProxyCacheSingleton(object):
+	'''
+	get( url ) returns a ProxyEntry with data, from memory, from disk, or from upstream.
+	Concurrent requests for the same url share one upstream fetch.
+	The disk index is rebuilt from the files on start, ordered by their access time.
+	'''
+	def __init__(self, path=None, max_memory=MAX_MEMORY_BYTES, max_disk=MAX_DISK_BYTES):
+		self.path = path or os.path.join( tempfile.gettempdir(), 'pyppet-proxy-cache' )
+		self.max_memory = max_memory
+		self.max_disk = max_disk
+		self.memory = collections.OrderedDict()  # key : ProxyEntry, least recently used first
+		self.memory_bytes = 0
+		self.disk = None  # key : size, least recently used first, loaded on first use
+		self.disk_bytes = 0
+		self.inflight = {}  # key : Fetch
+		self.lock = threading._allocate_lock()
+		self.pool = ConnectionPool()
+		self.hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+		self.revalidated = 0
+		self.coalesced = 0
+		self.stale = 0
+
+	def get_path(self, key):
+		return os.path.join( self.path, '%s.bin' %key )
+
+	def _load_index(self):
+		self.disk = collections.OrderedDict()
+		self.disk_bytes = 0
+		if not os.path.isdir( self.path ): return
+		files = []
+		for name in os.listdir( self.path ):
+			if not name.endswith( '.bin' ): continue
+			p = os.path.join( self.path, name )
+			st = os.stat( p )
+			files.append( (st.st_mtime, name[:-4], st.st_size) )
+		for mtime, key, size in sorted( files ):
+			self.disk[ key ] = size
+			self.disk_bytes += size
+
+	## the file is a line of json meta data, then the response body ##
+	def _read(self, key):
+		try:
+			with open( self.get_path(key), 'rb' ) as f:
+				meta = json.loads( f.readline().decode('utf-8') )
+				data = f.read()
+		except (IOError, OSError, ValueError):
+			return None
+		return ProxyEntry( data=data, **meta )
+
+	def _write(self, entry):
+		if not os.path.isdir( self.path ): os.makedirs( self.path )
+		path = self.get_path( entry.key )
+		tmp = '%s.%s.tmp' %(path, threading.get_ident())
+		with open( tmp, 'wb' ) as f:
+			f.write( json.dumps( entry.get_meta() ).encode('utf-8') + b'\n' )
+			f.write( entry.data )
+		os.replace( tmp, path )  ## readers never see a partial file
+		return os.path.getsize( path )
+
+	def _remember(self, entry, size=None):
+		'''
+		puts entry in both tiers, and evicts the least recently used entries over the limits.
+		'''
+		remove = []
+		with self.lock:
+			if size is not None:
+				if entry.key in self.disk: self.disk_bytes -= self.disk.pop( entry.key )
+				self.disk[ entry.key ] = size
+				self.disk_bytes += size
+				while self.disk_bytes > self.max_disk and len(self.disk) > 1:
+					key, n = self.disk.popitem( last=False )
+					self.disk_bytes -= n
+					remove.append( key )
+			old = self.memory.pop( entry.key, None )
+			if old: self.memory_bytes -= old.size
+			if entry.size <= MAX_MEMORY_ITEM:
+				self.memory[ entry.key ] = entry
+				self.memory_bytes += entry.size
+			while self.memory_bytes > self.max_memory and self.memory:
+				key, e = self.memory.popitem( last=False )
+				self.memory_bytes -= e.size
+		for key in remove:
+			try: os.remove( self.get_path(key) )
+			except OSError: pass
+
+	def _forget(self, key):
+		with self.lock:
+			e = self.memory.pop( key, None )
+			if e: self.memory_bytes -= e.size
+			if key in self.disk: self.disk_bytes -= self.disk.pop( key )
+		try: os.remove( self.get_path(key) )
+		except OSError: pass
+
+	def _lookup(self, key):
+		'''
+		returns the cached entry from memory or disk and marks it as recently used
+		'''
+		with self.lock:
+			if self.disk is None: self._load_index()
+			entry = self.memory.get( key )
+			if entry:
+				self.memory.move_to_end( key )
+				if key in self.disk: self.disk.move_to_end( key )
+				return entry
+			if key not in self.disk: return None
+		entry = self._read( key )
+		if entry is None:
+			self._forget( key )
+			return None
+		self.disk_hits += 1
+		try: os.utime( self.get_path(key), None )  ## the access time survives restarts
+		except OSError: pass
+		self._remember( entry )
+		with self.lock:
+			if key in self.disk: self.disk.move_to_end( key )
+		return entry
+
+	def get(self, url):
+		'''
+		returns a ProxyEntry with data, raises ProxyError if upstream fails and nothing is cached
+		'''
+		u = urllib.parse.urlsplit( url )
+		if u.scheme.lower() not in ('http', 'https') or not u.hostname:
+			raise ProxyError( 400, 'only http and https urls can be proxied' )
+		key = get_key( url )
+		entry = self._lookup( key )
+		if entry and entry.is_fresh():
+			self.hits += 1
+			if entry.status != 200: raise ProxyError( entry.status, 'cached upstream error' )
+			return entry
+
+		with self.lock:
+			fetch = self.inflight.get( key )
+			owner = fetch is None
+			if owner: fetch = self.inflight[ key ] = Fetch()
+			else: self.coalesced += 1
+		if not owner:
+			fetch.done.wait( TIMEOUT * (MAX_REDIRECTS + 1) )
+			if fetch.entry: return fetch.entry
+			if entry: return entry
+			raise fetch.error or ProxyError( 504, 'upstream timeout' )
+
+		try:
+			fetch.entry = self._fetch( url, key, entry )
+			return fetch.entry
+		except Exception as err:
+			if entry and entry.status == 200 and (not isinstance(err, ProxyError) or err.status >= 500):  ## stale is better than nothing
+				self.stale += 1
+				fetch.entry = entry
+				return entry
+			if not isinstance( err, ProxyError ): err = ProxyError( 502, str(err) )
+			fetch.error = err
+			raise err
+		finally:
+			with self.lock: self.inflight.pop( key, None )
+			fetch.done.set()
+
+	def _fetch(self, url, key, cached=None):
+		headers = {'User-Agent':'pyppet-proxy', 'Accept-Encoding':'identity'}
+		if cached:  ## revalidate
+			if cached.etag: headers['If-None-Match'] = cached.etag
+			if cached.last_modified: headers['If-Modified-Since'] = cached.last_modified
+		location = url
+		for i in range( MAX_REDIRECTS + 1 ):
+			status, reason, rheaders, data = self.pool.request( location, headers )
+			if status in (301, 302, 303, 307, 308) and 'location' in rheaders:
+				location = urllib.parse.urljoin( location, rheaders['location'] )
+				continue
+			break
+		else: raise ProxyError( 502, 'too many redirects' )
+
+		now = time.time()
+		ttl = get_freshness( rheaders, now )
+		if status == 304 and cached:
+			self.revalidated += 1
+			cached.expires = now + (ttl or 0.0)
+			self._write_meta( cached )
+			return cached
+
+		self.misses += 1
+		if status != 200 and status not in CACHEABLE_STATUS: raise ProxyError( status, reason )
+		entry = ProxyEntry(
+			key, url, status, rheaders.get('content-type') or 'application/octet-stream',
+			rheaders.get('etag'), rheaders.get('last-modified'),
+			now + (ttl or 0.0), len(data), data,
+		)
+		if ttl is None:  ## no-store or private
+			self._forget( key )
+		else:
+			self._remember( entry, self._write(entry) )
+		if status != 200: raise ProxyError( status, reason )
+		return entry
+
+	def _write_meta(self, entry):
+		if entry.data is not None and entry.key in self.disk: self._write( entry )
+
+	def clear(self):
+		with self.lock:
+			self.memory.clear()
+			self.memory_bytes = 0
+			keys = list( self.disk or () )
+			self.disk = collections.OrderedDict()
+			self.disk_bytes = 0
+		for key in keys:
+			try: os.remove( self.get_path(key) )
+			except OSError: pass
+
+	def get_stats(self):
+		return {
+			'memory':len(self.memory), 'memory_bytes':self.memory_bytes,
+			'disk':len(self.disk or ()), 'disk_bytes':self.disk_bytes,
+			'hits':self.hits, 'disk_hits':self.disk_hits, 'misses':self.misses,
+			'revalidated':self.revalidated, 'coalesced':self.coalesced, 'stale':self.stale,
+			'connections':self.pool.get_stats(),
+		}
+
+ProxyCache = ProxyCacheSingleton()
+
+
+if __name__ == '__main__':
+	import http.server, socketserver, shutil
+	requests = collections.Counter()
+	connections = set()
+
+	class Upstream( http.server.BaseHTTPRequestHandler ):
+		protocol_version = 'HTTP/1.1'  ## keep-alive
+		def log_message(self, *args): pass
+		def do_GET(self):
+			requests[ self.path ] += 1
+			connections.add( self.client_address )
+			headers = {}
+			if self.path.startswith('/slow'): time.sleep( 0.2 )
+			if self.path.startswith('/etag'):
+				headers['ETag'] = '"v1"'; headers['Cache-Control'] = 'no-cache'
+				if self.headers.get('If-None-Match') == '"v1"':
+					self.send_response( 304 )
+					for k,v in headers.items(): self.send_header( k, v )
+					self.send_header( 'Content-Length', '0' )
+					self.end_headers()
+					return
+			if self.path.startswith('/nostore'): headers['Cache-Control'] = 'no-store'
+			if self.path.startswith('/fresh'): headers['Cache-Control'] = 'max-age=3600'
+			if self.path == '/moved':
+				self.send_response( 302 ); self.send_header( 'Location', '/fresh-target' )
+				self.send_header( 'Content-Length', '0' ); self.end_headers()
+				return
+			if self.path == '/missing':
+				self.send_error( 404 )
+				return
+			data = ( 'data of %s ' %self.path ).encode('utf-8') * 100
+			self.send_response( 200 )
+			self.send_header( 'Content-Type', 'image/png' )
+			self.send_header( 'Content-Length', str(len(data)) )
+			for k,v in headers.items(): self.send_header( k, v )
+			self.end_headers()
+			self.wfile.write( data )
+
+	class UpstreamServer( socketserver.ThreadingMixIn, http.server.HTTPServer ):
+		daemon_threads = True
+
+	server = UpstreamServer( ('127.0.0.1', 0), Upstream )
+	threading.Thread( target=server.serve_forever, daemon=True ).start()
+	base = 'http://127.0.0.1:%s' %server.server_address[1]
+
+	assert get_freshness( {'cache-control':'max-age=60', 'age':'10'} ) == 50
+	assert get_freshness( {'cache-control':'private, max-age=60'} ) is None
+	assert get_freshness( {} ) == DEFAULT_TTL
+
+	root = tempfile.mkdtemp()
+	P = ProxyCacheSingleton( root, max_memory=4000, max_disk=12000 )
+	a = P.get( base + '/fresh-a' )
+	assert a.status == 200 and a.content_type == 'image/png' and a.data.startswith( b'data of /fresh-a' )
+	assert P.get( base + '/fresh-a' ) is a and requests['/fresh-a'] == 1 and P.hits == 1
+
+	## concurrent requests for the same url go upstream once ##
+	results = []
+	threads = [ threading.Thread( target=lambda: results.append(P.get(base + '/slow')) ) for i in range(8) ]
+	for t in threads: t.start()
+	for t in threads: t.join()
+	assert len(results) == 8 and requests['/slow'] == 1 and P.coalesced >= 1
+
+	## revalidation, no-store and redirects ##
+	for i in range(3): P.get( base + '/etag' )
+	assert requests['/etag'] == 3 and P.revalidated == 2
+	for i in range(2): P.get( base + '/nostore' )
+	assert requests['/nostore'] == 2 and not os.path.exists( P.get_path(get_key(base + '/nostore')) )
+	assert P.get( base + '/moved' ).data.startswith( b'data of /fresh-target' )
+	for i in range(2):
+		try: P.get( base + '/missing' ); raise AssertionError
+		except ProxyError as err: assert err.status == 404
+	assert requests['/missing'] == 1  ## errors are cached too
+	try: P.get( 'file:///etc/passwd' ); raise AssertionError
+	except ProxyError as err: assert err.status == 400
+
+	## keep-alive connections are reused ##
+	assert P.pool.reused > 0 and len(connections) < sum( requests.values() )
+
+	## the disk is bounded, least recently used first ##
+	assert P.disk_bytes <= P.max_disk and P.memory_bytes <= P.max_memory
+	for i in range(10): P.get( base + '/fresh-%s' %i )
+	assert P.disk_bytes <= P.max_disk and len(os.listdir( root )) == len(P.disk)
+	assert get_key( base + '/fresh-0' ) not in P.disk and get_key( base + '/fresh-9' ) in P.disk
+
+	## a new cache on the same directory finds the files, and serves stale if upstream is gone ##
+	Q = ProxyCacheSingleton( root, max_memory=4000, max_disk=12000 )
+	n = requests['/fresh-9']
+	assert Q.get( base + '/fresh-9' ).data == P.get( base + '/fresh-9' ).data and requests['/fresh-9'] == n
+	assert Q.disk_hits == 1
+	server.shutdown(); server.server_close()
+	P.pool.close(); Q.pool.close()
+	entry = Q._lookup( get_key(base + '/fresh-9') )
+	entry.expires = 0
+	assert Q.get( base + '/fresh-9' ) is entry and Q.stale == 1
+	shutil.rmtree( root )
+	print('proxy cache test done', P.get_stats())
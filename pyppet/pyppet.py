@@ -69,6 +69,8 @@ else: USE_OPENAL = False
 
 
 import fftw
+try: import numpy
+except ImportError: numpy = None
 #import cv
 #import highgui as gui
 
@@ -530,7 +532,9 @@ class Audio(object):
 		self.bands = [ .0 for i in range(n) ]
 
 		self.beats_buffer_samples = 128
-		self.beats_buffer = [ [0.0]*self.beats_buffer_samples for i in range(n) ]
+		self.beats_buffer = [ [0.0]*self.beats_buffer_samples for i in range(n) ]	# ring buffers
+		self.beats_sums = [ 0.0 for i in range(n) ]	# running sums of the ring buffers
+		self.beats_index = 0
 		self.beats = [ False for i in range(n) ]
 		self.beats_buttons = []
 		self.beats_threshold = 2.0
@@ -543,6 +547,55 @@ class Audio(object):
 		self.adjustments = [ gtk.Adjustment( value=0, lower=0, upper=1 ) for i in range(n) ]
 
 		self.index = 0
+		self._fft_size = None	# the plan and buffers are created on first update
+
+	def _setup_fft(self):
+		'''
+		aligned buffers and the fftw plan are created once per buffer size and reused,
+		planning is expensive and was done on every update.
+		'''
+		if self._fft_size:
+			fftw.destroy_plan( self._fft_plan )
+			fftw.free( ctypes.addressof(self._fft_in) )
+			fftw.free( ctypes.addressof(self._fft_out) )
+		size = self.buffersize
+		self.fftw_buffer_type = ( ctypes.c_double * 2 * size )
+		nbytes = ctypes.sizeof( self.fftw_buffer_type )
+		self._fft_in = ctypes.cast( fftw.malloc(nbytes), ctypes.POINTER(self.fftw_buffer_type) ).contents
+		self._fft_out = ctypes.cast( fftw.malloc(nbytes), ctypes.POINTER(self.fftw_buffer_type) ).contents
+		ctypes.memset( self._fft_in, 0, nbytes )
+		self._fft_plan = fftw.plan_dft_1d( size, self._fft_in, self._fft_out, fftw.FORWARD, fftw.ESTIMATE )
+		if numpy:	# views share memory with the ctypes buffers
+			self._np_in = numpy.ctypeslib.as_array( self._fft_in ).reshape( (size,2) )
+			self._np_out = numpy.ctypeslib.as_array( self._fft_out ).reshape( (size,2) )
+			self._np_samples = numpy.ctypeslib.as_array( self.input_buffer )
+			self._np_beats = numpy.zeros( (len(self.raw_bands), self.beats_buffer_samples) )
+		self._fft_size = size
+
+	def _get_raw_bands(self):
+		'''
+		runs the fft on the input buffer, returns the average power of each band
+		'''
+		size = self.buffersize
+		half = int( size/2 )
+		if numpy:
+			self._np_in[ :, 0 ] = self._np_samples
+			fftw.execute( self._fft_plan )
+			out = self._np_out
+			self.power = math.hypot( out[0][0], out[0][1] )
+			power = numpy.hypot( out[ 1:half+1, 0 ], out[ 1:half+1, 1 ] )
+			return power.reshape( (-1, self.band_chunk) ).mean( axis=1 )
+
+		inbuff = self._fft_in
+		for i,v in enumerate( self.input_buffer ): inbuff[ i ][0] = v
+		fftw.execute( self._fft_plan )
+		outbuff = self._fft_out
+		self.power = math.hypot( outbuff[0][0], outbuff[0][1] )
+		raw = []
+		chunk = self.band_chunk
+		for start in range( 1, half+1, chunk ):
+			raw.append( sum( [math.hypot(real,imag) for real,imag in outbuff[start:start+chunk]] ) / float(chunk) )
+		return raw
 
 	def get_analysis_widget(self):
 		root = gtk.VBox()
@@ -618,27 +671,8 @@ class Audio(object):
 		#for speaker in self.speakers: speaker.update()
 
 		if self.analysis:
-			complex = ctypes.c_double*2
-			inbuff = self.fftw_buffer_type( *[complex(v,.0) for v in self.input_buffer] )
-			outbuff = self.fftw_buffer_type()
-			plan = fftw.plan_dft_1d( self.buffersize, inbuff, outbuff, fftw.FORWARD, fftw.ESTIMATE )
-			fftw.execute( plan )
-
-			real   = outbuff[ 0 ][0]
-			imag = outbuff[ 0 ][1]
-			self.power = math.sqrt( (real**2)+(imag**2) )
-
-			raw = []
-			bar = []
-			for i in range( int(self.buffersize/2) ):
-				real   = outbuff[ i+1 ][0]
-				imag = outbuff[ i+1 ][1]
-				power = math.sqrt( (real**2)+(imag**2) )
-				bar.append( power )
-				if len(bar) == self.band_chunk:
-					raw.append( sum(bar) / float(self.band_chunk) )
-					bar = []
-
+			if self._fft_size != self.buffersize: self._setup_fft()
+			raw = self._get_raw_bands()
 
 			#h = max(raw)
 			#if h > self.max_raw: self.max_raw = h; print('new max raw', h)
@@ -646,17 +680,25 @@ class Audio(object):
 			#if self.max_raw > 1.0: self.max_raw *= 0.99	# TODO better normalizer
 			mult = 1.0 / (self.normalize * 100000)		# values range from 200,000 to 2M
 
-			for i,power in enumerate( raw ):
-				power *= mult
-				self.raw_bands[ i ] = power
-				self.beats_buffer[ i ].insert( 0, power )
-				self.beats_buffer[ i ].pop()
-				avg = sum( self.beats_buffer[i] ) / float( self.beats_buffer_samples )
-				#print('pow',power,'avg',avg)
-				if power > avg * self.beats_threshold:
-					self.beats[ i ] = True
-				else:
-					self.beats[ i ] = False
+			## beat history is a ring buffer, the oldest sample is overwritten ##
+			index = self.beats_index
+			self.beats_index = (index + 1) % self.beats_buffer_samples
+			if numpy:
+				power = raw * mult
+				history = self._np_beats
+				history[ :, index ] = power
+				beats = power > history.mean( axis=1 ) * self.beats_threshold
+				self.raw_bands[:] = power.tolist()	# drivers fail if the lists are replaced
+				self.beats[:] = beats.tolist()
+			else:
+				for i,power in enumerate( raw ):
+					power *= mult
+					self.raw_bands[ i ] = power
+					buff = self.beats_buffer[ i ]
+					self.beats_sums[ i ] += power - buff[ index ]
+					buff[ index ] = power
+					avg = self.beats_sums[ i ] / float( self.beats_buffer_samples )
+					self.beats[ i ] = power > avg * self.beats_threshold
 
 			high = max( self.raw_bands )
 			mult = 1.0
@@ -5,6 +5,8 @@
 import os, sys, ctypes, time, json, struct, inspect
 import random
 import bpy
+try: import ssl
+except ImportError: ssl = None
 
 ## make sure we can import and load data from same directory ##
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -14,6 +16,7 @@ import core
 import Server
 import simple_action_api
 import api_gen
+import player_shards
 from api_gen import BlenderProxy, UserProxy, Animation, Animations
 from websocket import websocksimplify
 
@@ -23,14 +26,29 @@ class UserServer( websocksimplify.WebSocketServer ):
 
 
 class BlenderServer( core.BlenderHack ):
+	shards = None  ## player_shards.ShardPool with --player-shards=N
 
 	def start_server(self):
 		self.websocket_server = s = UserServer()
 		host = Server.HOST_NAME
 		port = 8080
+		fps = 10
+		min_fps = 5; max_fps = 60  ## the send scheduler adapts each player between these
+		compression_level = 6
+		shards = 0
 		for arg in sys.argv:
 			if arg.startswith('--port='):
 				port = int( arg.split('=')[-1] )
+			if arg.startswith('--fps='):
+				fps = float( arg.split('=')[-1] )
+			if arg.startswith('--min-fps='):
+				min_fps = float( arg.split('=')[-1] )
+			if arg.startswith('--max-fps='):
+				max_fps = float( arg.split('=')[-1] )
+			if arg.startswith('--compression-level='):
+				compression_level = int( arg.split('=')[-1] )
+			if arg.startswith('--player-shards='):  ## worker processes that stream to the players
+				shards = int( arg.split('=')[-1] )
 			if arg.startswith('--ip='):
 				a = arg.split('=')
 				if len(a) == 2 and a[-1]:
@@ -38,12 +56,31 @@ class BlenderServer( core.BlenderHack ):
 
 		Server.set_host_and_port( host, port )
 
+		if shards:  ## forked before the listener threads start
+			self.shards = player_shards.ShardPool( shards, {
+				'frame_rate':fps, 'min_frame_rate':min_fps, 'max_frame_rate':max_fps,
+				'max_distance':Server.DEFAULT_STREAMING_LEVEL_OF_INTEREST_MAX_DISTANCE,
+				'cell_size':Server.SPATIAL_INDEX_CELL_SIZE,
+				'binary_stream':Server.USE_BINARY_STREAM,
+				'keyframe':Server.BINARY_STREAM_KEYFRAME,
+				'header_keys':Server.BINARY_STREAM_HEADER_KEYS,
+				'special_keys':Server.VIEW_SPECIAL_KEYS,
+			})
+			self.shards.start()
+
 		s.initialize(
 			listen_host=host, 
 			listen_port=port,
 			read_callback=self.on_websocket_read_update,
 			write_callback=self.on_websocket_write_update,
 			new_client_callback=self.on_new_client,
+			handoff_callback=self.on_handoff_client if shards else None,
+			event_loop='--websocket-threads' not in sys.argv,  ## one thread per client is the old mode
+			frame_rate=fps,
+			min_frame_rate=min_fps,
+			max_frame_rate=max_fps,
+			compression='--no-websocket-compression' not in sys.argv,  ## permessage-deflate, if the browser offers it
+			compression_level=compression_level,
 		)
 		lsock = s.create_listener_socket()
 		s.start_listener_thread()
@@ -63,17 +100,36 @@ class BlenderServer( core.BlenderHack ):
 
 
 
+	def on_handoff_client(self, sock, address, base64, deflate):
+		'''
+		player shards mode: the player is made here, its socket is given to a worker process,
+		returns False to keep the socket in this process (ssl sockets can not be handed over).
+		'''
+		if ssl and isinstance( sock, ssl.SSLSocket ): return False
+		addr = sock.getpeername()
+		if addr in Server.GameManager.clients:
+			print('[websocket] RELOADING CLIENT:', addr )
+			raise SystemExit
+		player = Server.GameManager.add_player( addr )
+		player.shard = self.shards.assign( sock, addr, player.uid, base64=base64, deflate=deflate )
+		print('[player shards] client %s:%s -> worker %s' %(addr[0], addr[1], player.shard))
+		return True
+
 	def on_websocket_read_update(self, sock, frames):
+		player = Server.GameManager.get_player_by_socket( sock )
+		if not player: return
+		self.on_player_frames( player, frames )
+
+	def on_player_frames(self, player, frames):
 		'''
 		protocol:
 			if first byte is null, then the next 24 bytes is the camera location as packed floats,
 			if its a single byte then its a keystroke,
 			if it begins with "{" and ends with "}" then its a json message/request,
+			if the first byte is CallbackFunction.BATCH_MARKER then it is many packed actions,
 			otherwise it is part of the generated websocket api.
+		in player shards mode the frames are forwarded here by the worker that owns the socket.
 		'''
-
-		player = Server.GameManager.get_player_by_socket( sock )
-		if not player: return
 		addr = player.address
 
 		for frame in frames:
@@ -103,11 +159,16 @@ class BlenderServer( core.BlenderHack ):
 				print('client sent json data', jmsg)
 				player.on_websocket_json_message( jmsg )
 
+			elif frame[0] == api_gen.CallbackFunction.BATCH_MARKER:
+				## many actions packed in one frame by the generated javascript ##
+				for code, args in api_gen.CallbackFunction.decode_batch( frame ):
+					action = player.new_action( code, args )
+					if action: action.do()
+
 			else:
-				print('doing custom action...', frame)
 				## action api ##
 				code = chr( frame[0] )
-				action = player.new_action(code, frame[1:])
+				action = player.new_action(code, memoryview(frame)[1:])
 				## logic here can check action before doing it.
 				if action:
 					#assert action.calling_object
@@ -119,22 +180,37 @@ class BlenderServer( core.BlenderHack ):
 	_debug_kbps = True
 	def on_websocket_write_update(self, sock):
 		player = Server.GameManager.get_player_by_socket( sock )
+		player.last_update = time.time()
 		msg = player.create_message_stream( bpy.context )
 		if msg is None:
 			#return None
 			return bytes(0)
 
 		rawbytes = json.dumps( msg ).encode('utf-8')
+		frames = [ rawbytes ]
+		binary = player.pop_binary_stream()  ## transform records, sent after the json that creates new objects
+		if binary: frames.append( binary )
+		geometry = player.pop_geometry_stream()  ## mesh chunks, after the json header that starts each mesh
+		if geometry: frames.append( geometry )
+
 		if self._debug_kbps:
 			now = time.time()
-			self._bps += len( rawbytes )
+			for frame in frames: self._bps += len( frame )
 			#print('frame Kbytes', len(rawbytes)/1024 )
 			if self._bps_start is None or now-self._bps_start > 1.0:
 				print('kilobytes per second', self._bps/1024)
 				self._bps_start = now
 				self._bps = 0
-		return rawbytes
+		return frames
+
 
+	def get_websocket_stats(self):
+		'''
+		per player send rate, queue depth and bytes per second
+		'''
+		stats = self.websocket_server.get_stats()
+		if self.shards: stats.update( self.shards.get_stats() )
+		return stats
 
 	def setup_websocket_callback_api(self, api):
 		simple_action_api.create_callback_api( api )
@@ -176,6 +252,14 @@ class App( BlenderServer ):
 
 			api_gen.AnimationManager.tick()
 			bpy.context.scene.update()  ## required for headless mode
+			if Server.GameManager.clients:
+				Server.GameManager.update_world_snapshot()  ## shared by all players this tick
+				if self.shards:
+					Server.GameManager.publish_shards( self.shards )
+					for event, index, addr, frames in self.shards.poll():
+						player = Server.GameManager.clients.get( addr )
+						if player: self.on_player_frames( player, frames )
+			Server.ExportCache.process_jobs()  ## collada exports requested by the http threads
 
 			fully_updated = self.update_blender()
 			self.mainloop_poll(now, dt)
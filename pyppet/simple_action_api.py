@@ -21,18 +21,17 @@ def new_action( code, args, user=None ):
 	assert user ## require actions be taken by users
 	wrapper = api_gen.CallbackFunction.CALLBACKS[code]
 	kwargs = wrapper.decode_args( args )
-	print('new_action', code, args)
 	return Action( user, wrapper.callback, kwargs )
 
 
 class Action(object):
+	__slots__ = ('user', 'callback', 'arguments')
 	def __init__(self, user, callback, kw):
 		self.user = user
 		self.callback = callback
 		self.arguments = kw
 
 	def do(self):
-		print('doing action', self.callback, self.arguments)
 		self.callback(
 			**self.arguments
 		)
@@ -0,0 +1,114 @@
+# Spatial Index for streaming level of interest
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import math, threading
+
+
+class UniformGrid(object):
+	'''
+	Objects are bucketed into cubic cells by their world position,
+	a radius query only visits the cells that overlap the query sphere.
+	Items are keyed on a unique ID (the blender object UID), and carry a payload (the object).
+
+	update() only moves an item between cells if it crossed a cell border,
+	so refreshing static objects every tick is cheap.
+	query() holds self.lock, a thread that updates many items should hold it as well.
+	'''
+	def __init__(self, cell_size=100.0):
+		self.cell_size = float(cell_size)
+		self.cells = {}  # (i,j,k) : set of uids
+		self.items = {}  # uid : [ (x,y,z), cell, payload ]
+		self.lock = threading._allocate_lock()
+
+	def __len__(self): return len(self.items)
+
+	def __contains__(self, uid): return uid in self.items
+
+	def get_cell(self, pos):
+		s = self.cell_size
+		return ( int(math.floor(pos[0]/s)), int(math.floor(pos[1]/s)), int(math.floor(pos[2]/s)) )
+
+	def update(self, uid, pos, payload=None):
+		'''
+		insert a new item, or move an existing one.
+		'''
+		pos = tuple(pos)
+		cell = self.get_cell( pos )
+		if uid in self.items:
+			item = self.items[ uid ]
+			item[0] = pos
+			item[2] = payload
+			if item[1] == cell: return
+			self._remove_from_cell( uid, item[1] )
+			item[1] = cell
+		else:
+			self.items[ uid ] = [ pos, cell, payload ]
+
+		if cell not in self.cells: self.cells[ cell ] = set()
+		self.cells[ cell ].add( uid )
+
+	def remove(self, uid):
+		if uid in self.items:
+			item = self.items.pop( uid )
+			self._remove_from_cell( uid, item[1] )
+
+	def _remove_from_cell(self, uid, cell):
+		bucket = self.cells[ cell ]
+		bucket.discard( uid )
+		if not bucket: self.cells.pop( cell )
+
+	def query(self, center, radius):
+		'''
+		returns a list of (distance, payload) within the radius of center, nearest first.
+		'''
+		cx,cy,cz = center[0], center[1], center[2]
+		r2 = radius * radius
+		lo = self.get_cell( (cx-radius, cy-radius, cz-radius) )
+		hi = self.get_cell( (cx+radius, cy+radius, cz+radius) )
+		span = (hi[0]-lo[0]+1) * (hi[1]-lo[1]+1) * (hi[2]-lo[2]+1)
+
+		res = []
+		with self.lock:
+			## for a large radius over a sparse grid, it is faster to walk the occupied cells ##
+			if span > len(self.cells):
+				buckets = [ b for c,b in self.cells.items() if lo[0]<=c[0]<=hi[0] and lo[1]<=c[1]<=hi[1] and lo[2]<=c[2]<=hi[2] ]
+			else:
+				buckets = []
+				for i in range( lo[0], hi[0]+1 ):
+					for j in range( lo[1], hi[1]+1 ):
+						for k in range( lo[2], hi[2]+1 ):
+							if (i,j,k) in self.cells: buckets.append( self.cells[(i,j,k)] )
+
+			for bucket in buckets:
+				for uid in bucket:
+					pos, cell, payload = self.items[ uid ]
+					dx = pos[0]-cx; dy = pos[1]-cy; dz = pos[2]-cz
+					d2 = dx*dx + dy*dy + dz*dz
+					if d2 <= r2: res.append( (d2, uid, payload) )
+
+		res.sort( key=lambda a: a[0] )
+		return [ (math.sqrt(d2), payload) for d2, uid, payload in res ]
+
+
+if __name__ == '__main__':
+	import random
+	grid = UniformGrid( cell_size=10.0 )
+	points = {}
+	for uid in range(1, 2001):
+		p = (random.uniform(-500,500), random.uniform(-500,500), random.uniform(-50,50))
+		points[ uid ] = p
+		grid.update( uid, p, payload=uid )
+
+	center = (0,0,0); radius = 120.0
+	a = [ uid for d,uid in grid.query( center, radius ) ]
+	b = [ uid for uid in points if math.sqrt(sum(v*v for v in points[uid])) <= radius ]
+	assert set(a) == set(b)
+	d = [ math.sqrt(sum(v*v for v in points[uid])) for uid in a ]
+	assert d == sorted(d)
+
+	grid.update( a[0], (1000,1000,1000), payload=a[0] )  ## move out of range
+	assert a[0] not in [ uid for d,uid in grid.query( center, radius ) ]
+	grid.remove( a[0] )
+	assert a[0] not in grid
+	print('spatial index test done', len(a))
@@ -0,0 +1,177 @@
+# Static Assets - files served by the webserver, read, hashed and compressed once
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import os, gzip, hashlib, mimetypes, threading, collections
+
+## gzip is only kept for these, images and sounds are already compressed ##
+COMPRESSIBLE = ('.js', '.css', '.html', '.json', '.svg', '.dae', '.obj', '.txt', '.glsl')
+MAX_CACHED_SIZE = 16 * 1024 * 1024  ## larger files are still served, but read every time
+LONG_CACHE = 'public, max-age=31536000'  ## fingerprinted urls never change content
+MAX_GENERATED = 64  ## generated pages kept, the url can come from the client (/zone?NAME)
+
+def get_content_type( path ):
+	if path.endswith( '.js' ): return 'text/javascript; charset=utf-8'
+	ctype = mimetypes.guess_type( path )[0] or 'application/octet-stream'
+	if ctype.startswith( 'text/' ): ctype += '; charset=utf-8'
+	return ctype
+
+
+class Asset(object):
+	'''
+	the data of a file, its etag, and a precompressed variant if gzip makes it smaller
+	'''
+	__slots__ = ('data', 'gzip', 'etag', 'mtime', 'content_type', 'cache_control')
+
+	def __init__(self, data, content_type, mtime, compress=True, cache_control='no-cache'):
+		self.data = data
+		self.content_type = content_type
+		self.mtime = mtime
+		self.cache_control = cache_control  ## no-cache revalidates with the etag, the url is the same when the content changes
+		self.etag = hashlib.sha1( data ).hexdigest()[:16]
+		self.gzip = None
+		if compress and len(data) > 256:
+			z = gzip.compress( data, 9 )
+			if len(z) < len(data) * 0.9: self.gzip = z
+
+	def get_data(self, accepts_gzip=False):
+		'''
+		returns (data, content encoding or None)
+		'''
+		if accepts_gzip and self.gzip: return self.gzip, 'gzip'
+		return self.data, None
+
+
+class StaticAssetsSingleton(object):
+	'''
+	Files under root are loaded on the first request and kept in memory, the file is only
+	read again if its mtime changes (one stat per request instead of a read).
+	Bundles are many files joined into a single fingerprinted url that can be cached forever.
+	'''
+	def __init__(self, root=None):
+		self.root = root or os.path.dirname( os.path.abspath(__file__) )
+		self.assets = {}   # url : Asset
+		self.bundles = {}  # name : (etags of the parts, url)
+		self.generated = collections.OrderedDict()  # url : Asset of a generated page, least recently used first
+		self.lock = threading._allocate_lock()
+		self.hits = 0
+		self.loads = 0
+
+	def get_file_path(self, url):
+		'''
+		returns the path for url, or None if it is outside of root
+		'''
+		path = os.path.normpath( os.path.join(self.root, url.lstrip('/')) )
+		if not path.startswith( os.path.join(self.root, '') ): return None
+		return path
+
+	def get(self, url):
+		'''
+		returns the Asset for url or None if there is no such file
+		'''
+		asset = self.assets.get( url )
+		if asset and asset.cache_control == LONG_CACHE:  ## bundle, not a file on disk
+			self.hits += 1
+			return asset
+		path = self.get_file_path( url )
+		if path is None or not os.path.isfile( path ): return None
+		mtime = os.path.getmtime( path )
+		if asset and asset.mtime == mtime:
+			self.hits += 1
+			return asset
+
+		self.loads += 1
+		with open( path, 'rb' ) as f: data = f.read()
+		asset = Asset(
+			data, get_content_type( path ), mtime,
+			compress=path.endswith( COMPRESSIBLE ),
+		)
+		if len(data) <= MAX_CACHED_SIZE:
+			with self.lock: self.assets[ url ] = asset
+		return asset
+
+	def put(self, url, data, content_type):
+		'''
+		for generated pages, the asset (and its gzip) is only rebuilt when the data changes
+		'''
+		with self.lock:
+			asset = self.generated.get( url )
+			if asset and asset.data == data:
+				self.generated.move_to_end( url )
+				self.hits += 1
+				return asset
+		asset = Asset( data, content_type, None )
+		with self.lock:
+			self.generated[ url ] = asset
+			self.generated.move_to_end( url )
+			while len(self.generated) > MAX_GENERATED: self.generated.popitem( last=False )
+		return asset
+
+	def get_text(self, url):
+		return self.get( url ).data.decode('utf-8')
+
+	def bundle(self, name, urls):
+		'''
+		joins the files at urls into one script and returns its url, /javascripts/bundle-<name>-<hash>.js
+		a new url is made when any of the files change.
+		'''
+		parts = [ self.get(url) for url in urls ]
+		for url, a in zip(urls, parts):
+			if a is None: raise IOError( 'bundle %s: missing file %s' %(name, url) )
+		etags = tuple( a.etag for a in parts )
+		entry = self.bundles.get( name )
+		if entry and entry[0] == etags: return entry[1]
+
+		data = b'\n;\n'.join( a.data for a in parts )
+		asset = Asset( data, 'text/javascript; charset=utf-8', max(a.mtime for a in parts), cache_control=LONG_CACHE )
+		url = '/javascripts/bundle-%s-%s.js' %(name, asset.etag)
+		with self.lock:
+			if entry: self.assets.pop( entry[1], None )
+			self.assets[ url ] = asset
+			self.bundles[ name ] = (etags, url)
+		return url
+
+	def clear(self):
+		with self.lock:
+			self.assets.clear()
+			self.bundles.clear()
+			self.generated.clear()
+
+	def get_stats(self):
+		return {
+			'assets':len(self.assets), 'hits':self.hits, 'loads':self.loads,
+			'bytes':sum( len(a.data) for a in list(self.assets.values()) ),
+		}
+
+StaticAssets = StaticAssetsSingleton()
+
+
+if __name__ == '__main__':
+	import tempfile, time
+	root = tempfile.mkdtemp()
+	os.mkdir( os.path.join(root, 'javascripts') )
+	for name in ('a.js', 'b.js'):
+		with open( os.path.join(root, 'javascripts', name), 'w' ) as f: f.write( 'var %s = 1;\n' %name[0] * 100 )
+
+	S = StaticAssetsSingleton( root )
+	a = S.get( '/javascripts/a.js' )
+	assert S.get( '/javascripts/a.js' ) is a and S.loads == 1 and S.hits == 1
+	assert gzip.decompress( a.get_data(True)[0] ) == a.data and a.get_data(False)[1] is None
+	assert S.get( '/javascripts/../../etc/passwd' ) is None and S.get( '/javascripts/none.js' ) is None
+
+	url = S.bundle( 'test', ['/javascripts/a.js', '/javascripts/b.js'] )
+	assert S.bundle( 'test', ['/javascripts/a.js', '/javascripts/b.js'] ) == url
+	assert S.get( url ).cache_control == LONG_CACHE and b'var b' in S.get( url ).data
+
+	time.sleep( 0.01 )
+	path = os.path.join( root, 'javascripts', 'a.js' )
+	with open( path, 'w' ) as f: f.write( 'var changed;' )
+	os.utime( path, (time.time()+1, time.time()+1) )
+	assert S.get( '/javascripts/a.js' ).data == b'var changed;'
+	url2 = S.bundle( 'test', ['/javascripts/a.js', '/javascripts/b.js'] )
+	assert url2 != url and url not in S.assets
+	page = S.put( '/', b'<html>' * 100, 'text/html' )
+	assert S.put( '/', b'<html>' * 100, 'text/html' ) is page and page.gzip
+	for i in range( MAX_GENERATED * 2 ): S.put( '/zone?%s' %i, b'<html>', 'text/html' )
+	assert len(S.generated) == MAX_GENERATED and '/' not in S.generated
+	print('static assets test done', S.get_stats())
@@ -0,0 +1,136 @@
+# UID Registry - constant time lookups between blender objects and their UID
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import threading
+try: import bpy
+except ImportError: bpy = None
+
+
+class UID_RegistrySingleton(object):
+	'''
+	Object.UID is the ID used by the webGL client, zero is a dead object.
+	The registry keeps a dict of UID : object and object : UID, and allocates new UID's
+	from a counter that only goes up.
+
+	note: copy object duplicates the UID, and appending from another blend file can bring in
+	UID's that collide, so when the number of objects changes the registry resyncs and gives
+	the newcomer a fresh UID. Deleted objects are dropped on the same resync.
+	'''
+	MAX_UID = 2**14  ## must match the max of bpy.types.Object.UID
+
+	def __init__(self):
+		self.objects = {}  # UID : blender object
+		self.uids = {}     # blender object : UID
+		self._next = 1
+		self._num_objects = None
+		self.lock = threading._allocate_lock()
+
+	def reset(self):
+		with self.lock:
+			self.objects.clear()
+			self.uids.clear()
+			self._num_objects = None
+
+	def _is_alive(self, ob):
+		try:
+			return ob.name in bpy.data.objects and bpy.data.objects[ ob.name ] == ob
+		except ReferenceError:  ## blender raises this for removed ID's
+			return False
+
+	def _allocate(self):
+		if self._next >= self.MAX_UID:  ## wrap around and reuse a free UID
+			for uid in range( 1, self.MAX_UID ):
+				if uid not in self.objects: return uid
+			raise RuntimeError('out of object UIDs')
+		uid = self._next
+		self._next += 1
+		return uid
+
+	def _register(self, ob, uid):
+		self.objects[ uid ] = ob
+		self.uids[ ob ] = uid
+		if uid >= self._next: self._next = uid + 1
+
+	def sync(self):
+		'''
+		rebuild the registry from bpy.data.objects, this is only done when objects are created or removed.
+		'''
+		with self.lock:
+			old = self.objects
+			self.objects = {}
+			self.uids = {}
+			duplicates = []
+			for ob in bpy.data.objects:
+				uid = ob.UID
+				if not uid: continue  ## assigned lazily by get_uid
+				if uid in self.objects:
+					## keep the UID on the object that had it before ##
+					if uid in old and old[ uid ] == ob:
+						duplicates.append( self.objects[uid] )
+						self._register( ob, uid )
+					else:
+						duplicates.append( ob )
+				else:
+					self._register( ob, uid )
+
+			for ob in duplicates:
+				uid = self._allocate()
+				print('[UID registry] duplicate UID on %s - reassigned: %s -> %s' %(ob.name, ob.UID, uid))
+				ob.UID = uid
+				self._register( ob, uid )
+
+			self._num_objects = len( bpy.data.objects )
+
+	def check(self):
+		if self._num_objects != len( bpy.data.objects ): self.sync()
+
+	def get_uid(self, ob):
+		'''
+		sets and returns the UID for object
+		'''
+		uid = ob.UID
+		if uid and self.uids.get( ob ) == uid: return uid  ## fast path
+
+		self.check()
+		with self.lock:
+			uid = ob.UID
+			if uid:
+				other = self.objects.get( uid )
+				if other is None or other == ob or not self._is_alive( other ):
+					self._register( ob, uid )
+					return uid
+				print('[UID registry] duplicate UID on %s - reassigning' %ob.name)
+
+			uid = self._allocate()
+			ob.UID = uid
+			self._register( ob, uid )
+			return uid
+
+	def get_object(self, uid):
+		'''
+		returns the object with the UID, or None
+		'''
+		ob = self.objects.get( uid )
+		if ob is None:
+			self.check()
+		else:
+			try:
+				if ob.UID == uid: return ob
+			except ReferenceError: pass
+			self.sync()  ## stale entry
+		return self.objects.get( uid )
+
+
+UID_Registry = UID_RegistrySingleton()
+
+if bpy and hasattr(bpy, 'app'):
+	## hook object creation and deletion ##
+	@bpy.app.handlers.persistent
+	def _on_scene_update( scene ): UID_Registry.check()
+
+	@bpy.app.handlers.persistent
+	def _on_load( *args ): UID_Registry.reset()
+
+	bpy.app.handlers.scene_update_post.append( _on_scene_update )
+	bpy.app.handlers.load_post.append( _on_load )
@@ -23,7 +23,9 @@ by Brett Hartshorn 2013
 '''
 import threading
 import os, sys, time, errno, signal, socket, traceback, select
-import array, struct
+import array, struct, collections, zlib
+try:    import selectors
+except: selectors = None
 from base64 import b64encode, b64decode
 
 # Imports that vary by python version
@@ -77,9 +79,14 @@ class WebSocketServer( threading.local ):
     local. They are shared across threads.
 
     """
-    __slots__ = ('verbose', 'listen_socket', 'ssl_only', 'on_client_read_ready', 'on_client_write_ready', 'on_new_client')
+    __slots__ = ('verbose', 'listen_socket', 'ssl_only', 'on_client_read_ready', 'on_client_write_ready', 'on_new_client',
+        'on_client_closed', 'handoff',
+        'event_loop', 'frame_rate', 'min_frame_rate', 'max_frame_rate', 'ws_clients', 'schedulers',
+        'compression', 'compression_level', 'compression_threshold', 'compression_context_takeover',
+        '_selector', '_wake_r', '_wake_w', '_new_clients')
 
     buffer_size = 65536
+    send_buffer_size = 262144  # small kernel send buffers let the SendScheduler see a slow client
 
     server_handshake_hybi = """HTTP/1.1 101 Switching Protocols\r
 Upgrade: websocket\r
@@ -107,11 +114,34 @@ Sec-WebSocket-Accept: %s\r
 
     def initialize(self, listen_host='', listen_port=None, source_is_ipv6=False,
             verbose=False, cert='', key='', ssl_only=None, web='',
-            run_once=False, timeout=0, idle_timeout=0, read_callback=None, write_callback=None, new_client_callback=None):
+            run_once=False, timeout=0, idle_timeout=0, read_callback=None, write_callback=None, new_client_callback=None,
+            close_callback=None, handoff_callback=None,
+            event_loop=False, frame_rate=10, min_frame_rate=5, max_frame_rate=60,
+            compression=True, compression_level=6, compression_threshold=256, compression_context_takeover=True):
 
         self.on_client_write_ready = write_callback
         self.on_client_read_ready = read_callback
         self.on_new_client = new_client_callback
+        self.on_client_closed = close_callback  # event loop mode, called with the socket before it is closed
+
+        # handoff_callback(sock, address, base64, deflate) is called after the handshake,
+        # if it returns True another process owns the connection (see pyppet/player_shards.py)
+        self.handoff = handoff_callback
+
+        # event loop mode: all clients are multiplexed in a single thread,
+        # otherwise each client gets its own thread (see new_client)
+        self.event_loop     = event_loop
+        self.frame_rate     = frame_rate  # initial target frames per second for each client
+        self.min_frame_rate = min_frame_rate  # the SendScheduler adapts each client between these
+        self.max_frame_rate = max_frame_rate
+        self.ws_clients     = {}          # socket : WebSocketClient (event loop mode)
+        self.schedulers     = {}          # socket : SendScheduler (both modes)
+
+        # permessage-deflate (RFC 7692), used when the client offers it
+        self.compression    = compression
+        self.compression_level = compression_level
+        self.compression_threshold = compression_threshold  # smaller frames are sent uncompressed
+        self.compression_context_takeover = compression_context_takeover
 
         # settings
         self.verbose        = verbose
@@ -145,6 +175,8 @@ Sec-WebSocket-Accept: %s\r
         print("  - Listen on %s:%s" % (
                 self.listen_host, self.listen_port))
         print("  - Flash security policy server")
+        if self.compression:
+            print("  - permessage-deflate, level %s" % self.compression_level)
         if self.web:
             print("  - Web server. Web root: %s" % self.web)
         if ssl:
@@ -238,7 +270,7 @@ Sec-WebSocket-Accept: %s\r
             return data.tostring()
 
     @staticmethod
-    def encode_hybi(buf, opcode, base64=False):
+    def encode_hybi(buf, opcode, base64=False, deflate=None):
         """ Encode a HyBi style WebSocket frame.
         Optional opcode:
             0x0 - continuation
@@ -247,11 +279,15 @@ Sec-WebSocket-Accept: %s\r
             0x8 - connection close
             0x9 - ping
             0xA - pong
+        If deflate is a PerMessageDeflate data frames may be compressed.
         """
         if base64:
             buf = b64encode(buf)
 
         b1 = 0x80 | (opcode & 0x0f) # FIN + opcode
+        if deflate and opcode in (1, 2):
+            buf, compressed = deflate.compress(buf)
+            if compressed: b1 |= 0x40 # RSV1
         payload_len = len(buf)
         if payload_len <= 125:
             header = pack('>BB', b1, payload_len)
@@ -265,10 +301,11 @@ Sec-WebSocket-Accept: %s\r
         return header + buf, len(header), 0
 
     @staticmethod
-    def decode_hybi(buf, base64=False):
+    def decode_hybi(buf, base64=False, deflate=None):
         """ Decode HyBi style WebSocket packets.
         Returns:
             {'fin'          : 0_or_1,
+             'rsv1'         : 0_or_1 (compressed),
              'opcode'       : number,
              'masked'       : boolean,
              'hlen'         : header_bytes_number,
@@ -280,6 +317,7 @@ Sec-WebSocket-Accept: %s\r
         """
 
         f = {'fin'          : 0,
+             'rsv1'         : 0,
              'opcode'       : 0,
              'masked'       : False,
              'hlen'         : 2,
@@ -298,6 +336,7 @@ Sec-WebSocket-Accept: %s\r
         b1, b2 = unpack_from(">BB", buf)
         f['opcode'] = b1 & 0x0f
         f['fin'] = (b1 & 0x80) >> 7
+        f['rsv1'] = (b1 & 0x40) >> 6
         f['masked'] = (b2 & 0x80) >> 7
 
         f['length'] = b2 & 0x7f
@@ -330,6 +369,11 @@ Sec-WebSocket-Accept: %s\r
             print("Unmasked frame: %s" % repr(buf))
             f['payload'] = buf[(f['hlen'] + f['masked'] * 4):full_len]
 
+        if f['rsv1'] and f['opcode'] in [1, 2]:
+            if not deflate:
+                raise Exception("Compressed frame without permessage-deflate")
+            f['payload'] = deflate.decompress(f['payload'])
+
         if base64 and f['opcode'] in [1, 2]:
             try:
                 f['payload'] = b64decode(f['payload'])
@@ -376,13 +420,15 @@ Sec-WebSocket-Accept: %s\r
         ready. """
 
         tdelta = int(time.time()*1000) - self.start_time
+        scheduler = self.send_scheduler
 
         if bufs:
             for buf in bufs:
                 if self.base64:
-                    encbuf, lenhead, lentail = self.encode_hybi(buf, opcode=1, base64=True)
+                    encbuf, lenhead, lentail = self.encode_hybi(buf, opcode=1, base64=True, deflate=self.deflate)
                 else:
-                    encbuf, lenhead, lentail = self.encode_hybi(buf, opcode=2, base64=False)
+                    encbuf, lenhead, lentail = self.encode_hybi(buf, opcode=2, base64=False, deflate=self.deflate)
+                if scheduler: scheduler.queued(time.time(), len(encbuf))
 
                 if self.rec:
                     self.rec.write("%s,\n" %
@@ -395,6 +441,7 @@ Sec-WebSocket-Accept: %s\r
             # Send pending frames
             buf = self.send_parts.pop(0)
             sent = self.client.send(buf)
+            if scheduler: scheduler.sent(time.time(), sent)
 
             if sent == len(buf):
                 self.traffic("<")
@@ -427,7 +474,7 @@ Sec-WebSocket-Accept: %s\r
             self.recv_part = None
 
         while buf:
-            frame = self.decode_hybi(buf, base64=self.base64)
+            frame = self.decode_hybi(buf, base64=self.base64, deflate=self.deflate)
             #print("Received buf: %s, frame: %s" % (repr(buf), frame))
 
             if frame['payload'] == None:
@@ -511,6 +558,17 @@ Sec-WebSocket-Accept: %s\r
                 response += "Sec-WebSocket-Protocol: base64\r\n"
             else:
                 response += "Sec-WebSocket-Protocol: binary\r\n"
+
+            self.deflate = None
+            if self.compression:
+                if hasattr(h, 'get_all'): offers = h.get_all('Sec-WebSocket-Extensions') or []
+                else: offers = [h.get('Sec-WebSocket-Extensions', '')]
+                self.deflate = PerMessageDeflate.negotiate(', '.join(offers),
+                    level=self.compression_level,
+                    threshold=self.compression_threshold,
+                    context_takeover=self.compression_context_takeover)
+                if self.deflate:
+                    response += "Sec-WebSocket-Extensions: %s\r\n" % self.deflate.response
             response += "\r\n"
 
         else:
@@ -645,6 +703,8 @@ Sec-WebSocket-Accept: %s\r
         self.base64     = False
         self.rec        = None
         self.start_time = int(time.time()*1000)
+        self.send_scheduler = None
+        self.deflate    = None
         print('START-TIME', self.start_time)
         # handler process
         self.ws_connection = False
@@ -656,7 +716,12 @@ Sec-WebSocket-Accept: %s\r
         if self._ws_connection:
             print('<<new websocket connection>>', self.client)
             self.ws_connection = True
-            self.new_client()
+            if self.handoff and self.handoff(self.client, address, self.base64, self.deflate):
+                pass  # handed over, the handshake thread exits here
+            elif self.event_loop:
+                self.add_event_loop_client(self.client, address)  # handshake thread exits here
+            else:
+                self.new_client()
         elif self.client and self.client != startsock:
             self.client.close() # close normal http request
         elif self.client:
@@ -667,17 +732,27 @@ Sec-WebSocket-Accept: %s\r
         """ Do something with a WebSockets client connection. """
         assert self.client != self.listen_socket
         self.on_new_client( self.client )
+        self.client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        self.send_scheduler = scheduler = self.new_scheduler( self.client.getpeername() )
+        scheduler.deflate = self.deflate
+        self.schedulers[ self.client ] = scheduler
 
         self.websocket_active = True
         while self.websocket_active:
-            ins, outs, excepts = select.select([self.client], [self.client], [self.client], 10)
+            now = time.time()
+            timeout = max(0.0, scheduler.next_write - now)
+            wlist = [self.client] if self.send_parts else []  # pending data is flushed when writable
+            ins, outs, excepts = select.select([self.client], wlist, [self.client], timeout)
             if excepts: self.websocket_active = False
 
             if outs:
+                self.send_frames()
+
+            if scheduler.ready( time.time() ):  # skipped while the last frame is still pending
                 data = self.on_client_write_ready( self.client )
                 if data is not None:
-                    pending = self.send_frames( [data] )  ## TODO raise some error if pending
-                    if pending: print('[websocket error] failed to send data', data)
+                    if type(data) is not list: data = [data]  # the write callback can return a list of frames
+                    self.send_frames( data )
 
             if ins:
                 frames, closed = self.recv_frames()
@@ -686,7 +761,7 @@ Sec-WebSocket-Accept: %s\r
                 else:
                     self.on_client_read_ready( self.client, frames )
 
-            time.sleep(0.1)
+        self.schedulers.pop( self.client, None )
         print('[websocket client thread exit]')
 
     def create_listener_socket(self):
@@ -696,8 +771,173 @@ Sec-WebSocket-Accept: %s\r
     def start_listener_thread(self):
         assert self.listen_socket
         #self.lock = threading._allocate_lock()
+        if self.event_loop:
+            self.start_event_loop_thread()
         threading._start_new_thread( self._listener_thread_loop, ())
 
+    #
+    # Event loop mode
+    #
+    def start_event_loop_thread(self):
+        assert selectors  # requires python3.4
+        self._selector = selectors.DefaultSelector()  # epoll on linux
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._new_clients = collections.deque()
+        threading._start_new_thread( self._event_loop_thread, ())
+
+    def add_event_loop_client(self, sock, address):
+        """ Called from the handshake thread, the event loop takes
+        over the socket and calls new_client_callback. """
+        self.adopt_client(sock, address, base64=self.base64, deflate=self.deflate)
+
+    def adopt_client(self, sock, address, base64=False, deflate=None):
+        """ Gives the event loop a socket that already did the
+        websocket handshake, from any thread or another process. """
+        client = WebSocketClient(sock, address, base64=base64, scheduler=self.new_scheduler(address),
+            deflate=deflate)
+        self._new_clients.append(client)
+        self._wake_w.send(b'x')
+
+    def new_scheduler(self, address):
+        return SendScheduler(address, self.frame_rate, self.min_frame_rate, self.max_frame_rate)
+
+    def set_frame_rate(self, sock, frame_rate):
+        """ Set the target frames per second for a single client,
+        the scheduler keeps adapting from there. """
+        if sock in self.schedulers:
+            self.schedulers[sock].set_rate(frame_rate)
+
+    def get_stats(self, sock=None):
+        """ Send rate, queue depth and throughput of one client,
+        or of all clients by address. """
+        if sock is not None:
+            return self.schedulers[sock].get_stats()
+        return dict( ('%s:%s' % s.address[:2], s.get_stats()) for s in list(self.schedulers.values()) )
+
+    def _event_loop_thread(self):
+        self.active = True
+        while self.active:
+            timeout = 1.0
+            now = time.time()
+            for client in self.ws_clients.values():
+                timeout = min(timeout, max(0.0, client.scheduler.next_write - now))
+
+            for key, mask in self._selector.select(timeout):
+                if key.fileobj is self._wake_r:
+                    self._event_loop_accept()
+                    continue
+                client = key.data
+                if client.closed: continue
+                if mask & selectors.EVENT_WRITE:
+                    self._event_loop_flush(client)
+                if mask & selectors.EVENT_READ and not client.closed:
+                    self._event_loop_read(client)
+
+            now = time.time()
+            for client in list(self.ws_clients.values()):
+                # backpressure: the scheduler skips the frame while parts are pending
+                if client.closed: continue
+                if client.scheduler.ready(now):
+                    self._event_loop_write(client, now)
+
+        print('[websocket event loop exit]')
+
+    def _event_loop_accept(self):
+        try:
+            while self._wake_r.recv(1024): pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        while self._new_clients:
+            client = self._new_clients.popleft()
+            try:
+                self.on_new_client(client.sock)
+            except BaseException:  # SystemExit is used to reject clients
+                traceback.print_exc()
+                client.sock.close()
+                continue
+            client.sock.setblocking(False)
+            client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+            self.ws_clients[client.sock] = client
+            self.schedulers[client.sock] = client.scheduler
+            self._selector.register(client.sock, selectors.EVENT_READ, client)
+
+    def _event_loop_close(self, client):
+        print('[websocket] closing client', client.address)
+        if self.on_client_closed and not client.closed:
+            try: self.on_client_closed(client.sock)
+            except Exception: traceback.print_exc()
+        client.closed = True
+        self.ws_clients.pop(client.sock, None)
+        self.schedulers.pop(client.sock, None)
+        try: self._selector.unregister(client.sock)
+        except (KeyError, ValueError): pass
+        client.sock.close()
+
+    def _event_loop_read(self, client):
+        # recv_frames works on the per thread state, so point it at this client
+        self.client = client.sock
+        self.recv_part = client.recv_part
+        self.base64 = client.base64
+        self.deflate = client.deflate
+        self.rec = None
+        self.start_time = client.start_time
+        try:
+            frames, closed = self.recv_frames()
+            client.recv_part = self.recv_part
+            if closed:
+                self._event_loop_close(client)
+            elif frames:
+                self.on_client_read_ready(client.sock, frames)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except Exception:
+            traceback.print_exc()
+            self._event_loop_close(client)
+        self.client = None
+
+    def _event_loop_write(self, client, now):
+        try:
+            data = self.on_client_write_ready(client.sock)
+        except Exception:
+            traceback.print_exc()
+            self._event_loop_close(client)
+            return
+        if data is None: return
+        if type(data) is not list: data = [data]
+        for buf in data:
+            encbuf, lenhead, lentail = self.encode_hybi(buf, opcode=(1 if client.base64 else 2), base64=client.base64,
+                deflate=client.deflate)
+            client.send_parts.append(encbuf)
+            client.scheduler.queued(now, len(encbuf))
+        self._event_loop_flush(client)
+
+    def _event_loop_flush(self, client):
+        while client.send_parts:
+            buf = client.send_parts[0]
+            try:
+                sent = client.sock.send(buf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self._event_loop_close(client)
+                return
+            if sent: client.scheduler.sent(time.time(), sent)
+            if sent == len(buf):
+                client.send_parts.pop(0)
+            else:
+                client.send_parts[0] = buf[sent:]
+                break
+
+        # only ask for write events while there is something pending
+        events = selectors.EVENT_READ
+        if client.send_parts: events |= selectors.EVENT_WRITE
+        if events != client.events:
+            client.events = events
+            self._selector.modify(client.sock, events, client)
+
     def _listener_thread_loop(self):
         self.active = True
         while self.active:
@@ -716,6 +956,217 @@ Sec-WebSocket-Accept: %s\r
                 #self.lock.release()
             print('listening...')
 
+class WebSocketClient(object):
+    """ Per client state for the event loop mode of WebSocketServer. """
+    def __init__(self, sock, address, base64=False, scheduler=None, deflate=None):
+        self.sock = sock
+        self.address = address
+        self.base64 = base64
+        self.deflate = deflate         # PerMessageDeflate or None
+        self.scheduler = scheduler or SendScheduler(address)
+        self.scheduler.deflate = deflate
+        self.send_parts = []           # encoded frames waiting for the socket
+        self.recv_part = None
+        self.start_time = int(time.time()*1000)
+        self.events = selectors.EVENT_READ
+        self.closed = False
+
+class SendScheduler(object):
+    """ Picks the update rate of one client from how fast its socket drains.
+
+    A new frame is only generated once the previous one is fully sent, ticks
+    that find data still pending are skipped, so the next frame carries the
+    latest state instead of a slow client falling behind on a queue of stale
+    ones.  Skipped ticks back the rate off, frames that drain well within
+    the frame interval let it creep back up to max_rate.
+    """
+    smoothing = 0.2   # weight of new samples in the moving averages
+
+    def __init__(self, address, frame_rate=10, min_rate=5, max_rate=60):
+        self.address = address
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = 0
+        self.set_rate(frame_rate)
+        self.next_write = 0
+        self.pending_bytes = 0        # encoded bytes waiting for the socket
+        self.frame_bytes = 0.0        # average bytes per frame
+        self.bytes_per_second = 0.0   # achieved throughput
+        self.link_bytes_per_second = 0.0  # estimated when a frame had to wait on the socket
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.bytes_sent = 0
+        self._frame_start = None
+        self._frame_mark = 0
+        self.deflate = None           # compression counters are included in the stats
+        self._window_start = time.time()
+        self._window_bytes = 0
+
+    def set_rate(self, rate):
+        self.rate = max(self.min_rate, min(self.max_rate, rate))
+
+    def ready(self, now):
+        """ True when a new frame should be generated for this tick. """
+        if now < self.next_write: return False
+        if self.pending_bytes:
+            self.frames_skipped += 1
+            self.set_rate(self.rate * 0.75)
+            self.next_write = now + 1.0 / self.rate
+            return False
+        self.next_write = now + 1.0 / self.rate
+        return True
+
+    def queued(self, now, nbytes):
+        if not self.pending_bytes:
+            self._frame_start = now
+            self._frame_mark = self.bytes_sent
+        self.pending_bytes += nbytes
+
+    def sent(self, now, nbytes):
+        self.pending_bytes = max(0, self.pending_bytes - nbytes)
+        self.bytes_sent += nbytes
+        self._window_bytes += nbytes
+        if not self.pending_bytes and self._frame_start is not None:
+            self._drained(self.bytes_sent - self._frame_mark, now - self._frame_start)
+            self._frame_start = None
+
+        elapsed = now - self._window_start
+        if elapsed >= 1.0:
+            self.bytes_per_second += (self._window_bytes / elapsed - self.bytes_per_second) * self.smoothing
+            self._window_start = now
+            self._window_bytes = 0
+
+    def _drained(self, nbytes, seconds):
+        self.frames_sent += 1
+        self.frame_bytes += (nbytes - self.frame_bytes) * self.smoothing
+        interval = 1.0 / self.rate
+        if seconds < 0.005:
+            # the socket took the frame at once
+            self.set_rate(self.rate + 1)
+            return
+
+        # the frame had to wait on the socket, which measures the link
+        self.link_bytes_per_second += (nbytes / seconds - self.link_bytes_per_second) * self.smoothing
+        if seconds > interval:
+            self.set_rate(self.rate * 0.75)
+        elif seconds < interval * 0.5:
+            cap = 0.8 * self.link_bytes_per_second / max(1.0, self.frame_bytes)
+            self.set_rate(max(self.rate, min(self.rate + 1, cap)))
+
+    def get_stats(self):
+        stats = {
+            'rate' : round(self.rate, 2),
+            'queue_bytes' : self.pending_bytes,
+            'bytes_per_second' : int(self.bytes_per_second),
+            'link_bytes_per_second' : int(self.link_bytes_per_second),
+            'frame_bytes' : int(self.frame_bytes),
+            'frames_sent' : self.frames_sent,
+            'frames_skipped' : self.frames_skipped,
+        }
+        if self.deflate: stats['compression'] = self.deflate.get_stats()
+        return stats
+
+class PerMessageDeflate(object):
+    """ permessage-deflate extension (RFC 7692) for one connection.
+
+    With context takeover the compressor keeps its window between
+    messages, so keys and names repeated in every frame of the json
+    stream compress to a few bytes.  Messages smaller than threshold
+    are sent as they are.
+    """
+    def __init__(self, level=6, threshold=256, context_takeover=True,
+            server_max_window_bits=15, client_max_window_bits=15, response='permessage-deflate'):
+        self.level = level
+        self.threshold = threshold
+        self.context_takeover = context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.response = response
+        self._compressor = None
+        self._decompressor = zlib.decompressobj(-client_max_window_bits)
+        self.raw_bytes = 0          # data frame payloads before compression
+        self.compressed_bytes = 0   # and after, including frames below the threshold
+        self.messages = 0
+        self.compressed_messages = 0
+
+    @classmethod
+    def negotiate(cls, header, level=6, threshold=256, context_takeover=True):
+        """ Returns a PerMessageDeflate for the first acceptable offer
+        in a Sec-WebSocket-Extensions header, or None. """
+        for offer in header.split(','):
+            params = [p.strip() for p in offer.split(';')]
+            if params[0] != 'permessage-deflate': continue
+            options = {}
+            for p in params[1:]:
+                if not p: continue
+                k, _, v = p.partition('=')
+                options[k.strip()] = v.strip().strip('"')
+
+            server_bits = client_bits = 15
+            response = ['permessage-deflate']
+            ok = True
+            for k, v in options.items():
+                if k == 'server_no_context_takeover':
+                    context_takeover = False
+                elif k == 'client_no_context_takeover':
+                    response.append(k)
+                elif k == 'server_max_window_bits':
+                    if not v.isdigit() or not 9 <= int(v) <= 15: ok = False  # zlib can not do 8
+                    else: server_bits = int(v); response.append('%s=%s' % (k, v))
+                elif k == 'client_max_window_bits':
+                    if v:
+                        if not v.isdigit() or not 8 <= int(v) <= 15: ok = False
+                        else: client_bits = int(v); response.append('%s=%s' % (k, v))
+                else:
+                    ok = False  # unknown parameter, decline this offer
+            if not ok: continue
+            if not context_takeover and 'server_no_context_takeover' not in response:
+                response.append('server_no_context_takeover')
+            return cls(level, threshold, context_takeover, server_bits, client_bits, '; '.join(response))
+
+    def get_settings(self):
+        """ Keyword arguments for a new PerMessageDeflate with the same
+        negotiated settings, to move a fresh connection to another process. """
+        return {
+            'level' : self.level,
+            'threshold' : self.threshold,
+            'context_takeover' : self.context_takeover,
+            'server_max_window_bits' : self.server_max_window_bits,
+            'client_max_window_bits' : self.client_max_window_bits,
+            'response' : self.response,
+        }
+
+    def compress(self, buf):
+        """ Returns (payload, compressed) """
+        self.messages += 1
+        self.raw_bytes += len(buf)
+        if len(buf) < self.threshold:
+            self.compressed_bytes += len(buf)
+            return buf, False
+
+        if self._compressor is None or not self.context_takeover:
+            self._compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.server_max_window_bits)
+        data = self._compressor.compress(buf) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(b'\x00\x00\xff\xff'): data = data[:-4]
+        self.compressed_messages += 1
+        self.compressed_bytes += len(data)
+        return data, True
+
+    def decompress(self, payload):
+        return self._decompressor.decompress(bytes(payload) + b'\x00\x00\xff\xff')
+
+    def get_stats(self):
+        ratio = 1.0
+        if self.compressed_bytes: ratio = self.raw_bytes / float(self.compressed_bytes)
+        return {
+            'level' : self.level,
+            'messages' : self.messages,
+            'compressed_messages' : self.compressed_messages,
+            'raw_bytes' : self.raw_bytes,
+            'compressed_bytes' : self.compressed_bytes,
+            'ratio' : round(ratio, 2),
+        }
+
 # HTTP handler with WebSocket upgrade support
 class WSRequestHandler(SimpleHTTPRequestHandler):
     def __init__(self, req, addr, only_upgrade=False):
@@ -0,0 +1,108 @@
+# World Snapshot - viewer independent object state, built once per tick and shared by all players
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import time
+from uid_registry import UID_Registry
+from geometry_cache import get_mesh_id
+
+
+def is_streamable( ob ):
+	if ob.name.startswith('_'): return False
+	if ob.type not in ('MESH', 'EMPTY'): return False
+	if ob.type == 'EMPTY' and not ob.children: return False  ## skip empty empties
+	return True
+
+def get_transform( matrix, swap=None ):
+	'''
+	returns (loc, rot, scl, state) from a local matrix, rot is euler ZXY,
+	state is the rounded tuple players compare to see if anything moved.
+	'''
+	if swap is not None: matrix = swap * matrix
+	loc, rot, scl = matrix.decompose()
+	loc = loc.to_tuple()
+	scl = scl.to_tuple()
+	rot = tuple( rot.to_euler("ZXY") ) #'XYZ', 'XZY', 'YXZ', 'YZX', 'ZXY', 'ZYX']
+	state = (
+		tuple(round(v,3) for v in loc),
+		tuple(round(v,3) for v in scl),
+		tuple(round(v,3) for v in rot),
+	)
+	return loc, rot, scl, state
+
+
+class ObjectState(object):
+	'''
+	the part of an object's message that is the same for every viewer
+	'''
+	__slots__ = ('ob', 'uid', 'key', 'name', 'type', 'parent', 'loc', 'rot', 'scl', 'state',
+		'min', 'max', 'mesh_id', 'text_scale', '_material', '_material_key')
+
+	def __init__(self, ob, swap=None):
+		self.ob = ob
+		self.uid = UID_Registry.get_uid( ob )
+		self.key = '__%s__' %self.uid
+		self.name = ob.name
+		self.type = ob.type
+		self.parent = None
+		if ob.parent:
+			if ob.parent.type == 'CAMERA': self.parent = -1
+			else:
+				assert ob.parent.type in ('MESH', 'EMPTY')
+				self.parent = UID_Registry.get_uid( ob.parent )
+			swap = None  # do not swap children
+
+		self.loc, self.rot, self.scl, self.state = get_transform( ob.matrix_local, swap )
+
+		self.min = self.max = self.mesh_id = None
+		if ob.type == 'MESH':
+			self.min = tuple( ob.bound_box[0] )
+			self.max = tuple( ob.bound_box[6] )
+			self.mesh_id = get_mesh_id( ob.data )
+
+		self.text_scale = None
+		if ob.slow_parent_offset != 0.0:
+			self.text_scale = ob.slow_parent_offset * 0.0035
+
+		self._material = self._material_key = None
+
+	def get_material_config(self):
+		'''
+		returns (config, version) or (None, None), only done the first time a player needs it this tick.
+		'''
+		if self._material is None and self.type == 'MESH':
+			mats = self.ob.data.materials
+			if mats and mats[0] and WorldSnapshot.material_config:
+				self._material, self._material_key = WorldSnapshot.material_config( self.ob )
+		return self._material, self._material_key
+
+
+class WorldSnapshot(object):
+	'''
+	Transforms, bounds, mesh ids and material configs are computed once per tick here,
+	players only add their view overlays and interest filtering on top,
+	so the cost is objects + players instead of objects * players.
+	A snapshot is never changed after it is built, the GameManager swaps in a new one.
+	'''
+	swap = None             ## matrix applied to root objects, set by Server.py
+	material_config = None  ## function( ob ) that returns (config dict, version), set by Server.py
+
+	def __init__(self, objects=(), tick=0):
+		self.tick = tick
+		self.time = time.time()
+		self.objects = {}  # blender object : ObjectState
+		for ob in objects:
+			if is_streamable( ob ): self.objects[ ob ] = ObjectState( ob, self.swap )
+
+	def get(self, ob):
+		'''
+		returns the ObjectState or None if the object is not streamed,
+		objects created after the snapshot was built get a fresh state.
+		'''
+		state = self.objects.get( ob )
+		if state is None and is_streamable( ob ):
+			state = ObjectState( ob, self.swap )
+		return state
+
+	def get_stats(self):
+		return {'tick':self.tick, 'objects':len(self.objects), 'age':time.time()-self.time}
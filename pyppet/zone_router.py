@@ -0,0 +1,284 @@
+# Zone Router - one server instance per zone, a front process sends clients to the right one
+# Copyright Brett Hartshorn 2012-2013
+# License: "New" BSD
+
+import os, sys, time, json, binascii, threading
+import http.server, http.client, socketserver, urllib.parse
+
+'''
+each zone is its own server_api.py process started with --zone=NAME (it only serves the objects in
+the blender group of that name) and --zone-router=HOST:PORT, the router is this module run with python3:
+
+	python3 zone_router.py --port=8080 --zones=forest=8081,desert=otherhost:8082
+
+router urls:
+	/ and /zone?NAME - redirect to the page of the zone instance, / goes to the first zone
+	/endpoint?NAME - json {name, host, port, path} of the websocket of the zone
+	/zones - json of the zone table and stats
+	POST /handoff - json {zone, state} from the instance the player leaves, returns {token, endpoint}
+	/handoff?TOKEN - the state for the instance the player joins, it can only be taken once
+'''
+
+HANDOFF_TIMEOUT = 60.0  ## seconds, a state that is not taken by then is dropped
+REQUEST_TIMEOUT = 2.0   ## seconds, instances block on the router while a player is handed off
+
+def parse_zones( spec ):
+	'''
+	"name=host:port,name=port" returns [ (name, host or None, port) ], without a host the zone
+	is on the same host the client reached the router with.
+	'''
+	zones = []
+	for item in spec.split(','):
+		if not item.strip(): continue
+		name, address = item.strip().split('=')
+		host = None
+		if ':' in address: host, address = address.split(':')
+		zones.append( (name, host or None, int(address)) )
+	return zones
+
+def split_host( host ):
+	'''
+	the host of a Host header without the port, keeps the brackets of an ipv6 address
+	'''
+	host = host or ''
+	if host.startswith('['): return host.split(']')[0] + ']'
+	return host.split(':')[0]
+
+def new_token():
+	return binascii.hexlify( os.urandom(16) ).decode('ascii')
+
+
+class ZoneRouterSingleton(object):
+	'''
+	the zone table and the player states waiting to be taken by the next zone,
+	used by the front process, nothing here touches blender.
+	'''
+	def __init__(self):
+		self.zones = []     # [ (name, host, port) ] in order, the first is the default zone
+		self.handoffs = {}  # token : (time, zone, state)
+		self.lock = threading._allocate_lock()
+		self.redirects = 0
+		self.handoffs_taken = 0
+		self.handoffs_expired = 0
+
+	def add_zone(self, name, host, port):
+		assert self.get_zone( name ) is None
+		self.zones.append( (name, host, port) )
+
+	def get_zone(self, name=None):
+		'''
+		returns (name, host, port) or None, the default zone if name is None
+		'''
+		if name is None: return self.zones[0] if self.zones else None
+		for zone in self.zones:
+			if zone[0] == name: return zone
+		return None
+
+	def get_endpoint(self, name=None, default_host=None):
+		zone = self.get_zone( name )
+		if zone is None: return None
+		name, host, port = zone
+		return {'name':name, 'host':host or default_host, 'port':port, 'path':name}
+
+	def put_handoff(self, zone, state):
+		'''
+		returns the token the client gives to the instance of zone, or None if there is no such zone
+		'''
+		if self.get_zone( zone ) is None: return None
+		token = new_token()
+		with self.lock:
+			self.expire()
+			self.handoffs[ token ] = (time.time(), zone, state)
+		return token
+
+	def pop_handoff(self, token):
+		with self.lock:
+			self.expire()
+			item = self.handoffs.pop( token, None )
+		if item is None: return None
+		self.handoffs_taken += 1
+		return item[-1]
+
+	def expire(self):
+		now = time.time()
+		for token in [ t for t,item in self.handoffs.items() if now - item[0] > HANDOFF_TIMEOUT ]:
+			self.handoffs.pop( token )
+			self.handoffs_expired += 1
+
+	def get_stats(self):
+		return {
+			'zones':dict( (name, [host, port]) for name,host,port in self.zones ),
+			'redirects':self.redirects, 'handoffs_waiting':len(self.handoffs),
+			'handoffs_taken':self.handoffs_taken, 'handoffs_expired':self.handoffs_expired,
+		}
+
+ZoneRouter = ZoneRouterSingleton()
+
+
+class ZoneRouterRequestHandler( http.server.BaseHTTPRequestHandler ):
+	router = ZoneRouter
+
+	def get_request_host(self):
+		## a zone without a host is on the host the client used to reach us ##
+		return split_host( self.headers.get('Host') ) or self.server.server_address[0]
+
+	def send_data(self, data, content_type='application/json; charset=utf-8', code=200):
+		self.send_response( code )
+		self.send_header( 'Content-type', content_type )
+		self.send_header( 'Content-Length', str(len(data)) )
+		self.send_header( 'Cache-Control', 'no-cache' )
+		self.end_headers()
+		self.wfile.write( data )
+
+	def send_json(self, ob, code=200):
+		self.send_data( json.dumps(ob).encode('utf-8'), code=code )
+
+	def do_GET(self):
+		path = urllib.parse.unquote( self.path )
+		arg = None
+		if '?' in path: path, arg = path.split('?', 1)
+
+		if path in ('/', '/zone'):
+			e = self.router.get_endpoint( arg, self.get_request_host() )
+			if e is None: return self.send_error( 404, 'unknown zone' )
+			self.router.redirects += 1
+			self.send_response( 302 )  ## not 301, browsers would remember the zone
+			self.send_header( 'Location', 'http://%s:%s/zone?%s' %(e['host'], e['port'], e['name']) )
+			self.send_header( 'Content-Length', '0' )
+			self.end_headers()
+
+		elif path == '/endpoint':
+			e = self.router.get_endpoint( arg, self.get_request_host() )
+			if e is None: return self.send_error( 404, 'unknown zone' )
+			self.send_json( e )
+
+		elif path == '/zones':
+			self.send_json( self.router.get_stats() )
+
+		elif path == '/handoff':
+			state = self.router.pop_handoff( arg )
+			if state is None: return self.send_error( 404, 'no such handoff' )
+			self.send_json( state )
+
+		else: self.send_error( 404, 'File not found' )
+
+	def do_POST(self):
+		if self.path != '/handoff': return self.send_error( 404, 'File not found' )
+		length = int( self.headers.get('Content-Length') or 0 )
+		msg = json.loads( self.rfile.read(length).decode('utf-8') )
+		token = self.router.put_handoff( msg['zone'], msg['state'] )
+		if token is None: return self.send_error( 404, 'unknown zone' )
+		self.send_json( {'token':token, 'endpoint':self.router.get_endpoint(msg['zone'])} )
+
+	def log_message(self, format, *args):
+		if '--verbose' in sys.argv: http.server.BaseHTTPRequestHandler.log_message( self, format, *args )
+
+
+class ZoneRouterServer( socketserver.ThreadingMixIn, http.server.HTTPServer ):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+class ZoneClient(object):
+	'''
+	used by a zone instance (Server.py --zone-router=HOST:PORT) to ask the router where a zone is,
+	and to leave and take player states, every call blocks for at most REQUEST_TIMEOUT.
+	address is how the instance reaches the router, public is the url browsers use (--zone-router-public=URL).
+	'''
+	def __init__(self, address, public=None):
+		self.host, port = address.split(':')
+		self.port = int( port )
+		self.public = public.rstrip('/') if public else None
+
+	def request(self, method, url, body=None):
+		'''
+		returns the json reply, or None if the router answered 404, raises IOError if it can not be reached
+		'''
+		conn = http.client.HTTPConnection( self.host, self.port, timeout=REQUEST_TIMEOUT )
+		try:
+			headers = {}
+			if body is not None:
+				body = json.dumps( body ).encode('utf-8')
+				headers['Content-Type'] = 'application/json'
+			conn.request( method, url, body, headers )
+			r = conn.getresponse()
+			data = r.read()
+		finally:
+			conn.close()
+		if r.status == 404: return None
+		if r.status != 200: raise IOError( 'zone router %s %s: %s' %(method, url, r.status) )
+		return json.loads( data.decode('utf-8') )
+
+	def get_endpoint(self, zone):
+		return self.request( 'GET', '/endpoint?%s' %urllib.parse.quote(zone) )
+
+	def get_url(self, zone, host=None):
+		'''
+		the router page of zone for a browser, without a public url the router is assumed to be on host
+		(the host the browser reached this instance with) and not on self.host, which is often localhost.
+		'''
+		base = self.public or 'http://%s:%s' %(host or self.host, self.port)
+		return '%s/zone?%s' %(base, urllib.parse.quote(zone))
+
+	def put_handoff(self, zone, state):
+		'''
+		returns (token, endpoint) or None if the router does not know the zone,
+		the host of the endpoint is None if the zone is on the same host as the router.
+		'''
+		reply = self.request( 'POST', '/handoff', {'zone':zone, 'state':state} )
+		if reply is None: return None
+		return reply['token'], reply['endpoint']
+
+	def pop_handoff(self, token):
+		return self.request( 'GET', '/handoff?%s' %urllib.parse.quote(token) )
+
+
+def serve( host='', port=8080 ):
+	server = ZoneRouterServer( (host, port), ZoneRouterRequestHandler )
+	print('[zone router] listening on %s:%s' %(host or '*', port))
+	for name, zhost, zport in ZoneRouter.zones:
+		print('	%s -> %s:%s' %(name, zhost or '<request host>', zport))
+	return server
+
+
+if __name__ == '__main__':
+	if [ arg for arg in sys.argv if arg.startswith('--zones=') ]:
+		host = ''; port = 8080
+		for arg in sys.argv:
+			if arg.startswith('--zones='):
+				for zone in parse_zones( arg.split('=',1)[-1] ): ZoneRouter.add_zone( *zone )
+			if arg.startswith('--port='): port = int( arg.split('=')[-1] )
+			if arg.startswith('--ip='): host = arg.split('=')[-1]
+		serve( host, port ).serve_forever()
+
+	else:  ## self test
+		assert parse_zones( 'a=8081, b=otherhost:8082,' ) == [ ('a',None,8081), ('b','otherhost',8082) ]
+		for zone in parse_zones( 'forest=8081,desert=127.0.0.1:8082' ): ZoneRouter.add_zone( *zone )
+		server = serve( '127.0.0.1', 0 )
+		threading.Thread( target=server.serve_forever, daemon=True ).start()
+		port = server.server_address[1]
+		client = ZoneClient( '127.0.0.1:%s' %port )
+		assert split_host( 'example.com:8081' ) == 'example.com' and split_host( '[::1]:8081' ) == '[::1]'
+		assert client.get_url( 'forest', 'example.com' ) == 'http://example.com:%s/zone?forest' %port
+		assert ZoneClient( 'localhost:8080', 'http://example.com/' ).get_url( 'forest', 'x' ) == 'http://example.com/zone?forest'
+
+		conn = http.client.HTTPConnection( '127.0.0.1', port )
+		conn.request( 'GET', '/' ); r = conn.getresponse(); r.read()
+		assert r.status == 302 and r.getheader('Location') == 'http://127.0.0.1:8081/zone?forest'
+		conn.request( 'GET', '/zone?nowhere' ); r = conn.getresponse(); r.read()
+		assert r.status == 404
+		conn.close()
+
+		assert client.get_endpoint( 'desert' ) == {'name':'desert', 'host':'127.0.0.1', 'port':8082, 'path':'desert'}
+		assert client.get_endpoint( 'nowhere' ) is None
+		state = {'name':'player1', 'mesh_ids':['a','b'], 'location':[1.0,2.0,3.0]}
+		token, endpoint = client.put_handoff( 'forest', state )
+		assert endpoint['host'] is None and endpoint['port'] == 8081
+		assert client.put_handoff( 'nowhere', state ) is None
+		assert client.pop_handoff( token ) == state and client.pop_handoff( token ) is None  ## only once
+
+		token, endpoint = client.put_handoff( 'desert', state )
+		ZoneRouter.handoffs[ token ] = (time.time() - HANDOFF_TIMEOUT - 1,) + ZoneRouter.handoffs[ token ][1:]
+		assert client.pop_handoff( token ) is None and ZoneRouter.handoffs_expired == 1
+		server.shutdown()
+		print('zone router test done', ZoneRouter.get_stats())
@@ -0,0 +1,12 @@
+#!/bin/bash
+## one blender per zone (the objects in the group of the same name), and the zone router in front on port 8080
+## usage: ./run-zones.sh world.blend forest desert ...
+BLEND=$1; shift
+ZONES=""
+PORT=8081
+for ZONE in "$@"; do
+	~/blender2.63/blender $BLEND --background --python ./pyppet/server_api.py --port=$PORT --zone=$ZONE --zone-router=localhost:8080 &
+	ZONES="$ZONES$ZONE=$PORT,"
+	PORT=$((PORT+1))
+done
+python3 ./pyppet/zone_router.py --port=8080 --zones=$ZONES